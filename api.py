@@ -3,37 +3,231 @@
 
 import streamlit as st
 import requests
-from config import base_url
+from config import base_url, cache_version_max_age, pagination_workers, ticket_ttl, reference_ttl, rollup_close_after_days, tickets_sync_interval, tickets_full_sync_interval, ticket_cache_max_bytes, tickets_list_cache_max_bytes, requester_cache_max_bytes, ticket_description_cache_max_bytes
+from freshdesk_client import get_client, get_request_priority, set_request_priority
+from metrics import cache_resource, record_cache_lookup
+from singleflight import single_flight
+from memory_cache import memory_cache
+from store import get_store
+import os
 import urllib.parse
 import datetime
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-api_key = st.secrets["api_key"]
 
+def get_api_key():
+    """Returns the FreshDesk API key from FRESHDESK_API_KEY if set, so we can run outside Streamlit, or else from Streamlit's secrets."""
+    return os.environ.get("FRESHDESK_API_KEY") or st.secrets["api_key"]
 
-@st.cache_resource(ttl=60*60, show_spinner=False)
+
+@single_flight
+def get_stored_entity(kind, entity_id, url, max_age):
+    """
+    Get one record from the local store, or from FreshDesk if we don't have a fresh copy
+
+    Concurrent calls for the same record, e.g. from several sessions opening the same client at once,
+    share one lookup and fetch.
+
+    Args:
+        kind (str): The kind of record, e.g. "ticket"
+        entity_id (int): The record's ID
+        url (str): Where to fetch it from FreshDesk
+        max_age (float): The oldest stored copy to accept, in seconds
+
+    Returns:
+        data (dict or None): The record, or None if FreshDesk doesn't have it
+    """
+    store = get_store()
+    data = store.get(kind, entity_id, max_age)
+    record_cache_lookup(f'store:{kind}', hit=data is not None)
+    if data is None:
+        data, _ = get_data_from_api(url, get_api_key())
+        if data is not None:
+            store.put(kind, entity_id, data)
+    return data
+
+
+@single_flight
+def get_stored_list(kind, url, max_age, parallel=False):
+    """
+    Get every record from a paginated list endpoint, from the local store if we have a fresh copy
+
+    Concurrent calls for the same list share one lookup and fetch.
+
+    Args:
+        kind (str): The kind of record, e.g. "ticket"
+        url (str): The first page of the list
+        max_age (float): The oldest stored copy to accept, in seconds
+        parallel (bool): Whether the endpoint accepts a page number, so pages can be fetched in parallel
+
+    Returns:
+        records (list): The records, in the order FreshDesk returned them
+    """
+    store = get_store()
+    records = store.get_query(url, max_age)
+    record_cache_lookup(f'store:{kind}_list', hit=records is not None)
+    if records is None:
+        records = get_all_pages(url, parallel)
+        store.put_query(url, kind, records)
+    return records
+
+
+def cache_version(*scopes):
+    """
+    Returns the current cache versions of some scopes, e.g. "ticket:123", plus the "all" scope; see invalidation.py
+
+    Every cached accessor calls this, so versions are read from the store at most once every
+    `cache_version_max_age` seconds per set of scopes.
+    """
+    return get_store().get_versions(['all', *scopes], cache_version_max_age)
+
+
+def months_between(start_date, end_date):
+    """
+    Lists the months a date range takes in
+
+    Args:
+        start_date (str): The first day of the range, in the format YYYY-MM-DD
+        end_date (str): The day after the range, in the format YYYY-MM-DD
+
+    Returns:
+        months (list): The months, in the format YYYY-MM
+    """
+    month = datetime.datetime.strptime(start_date[:7], '%Y-%m')
+    last_day = datetime.datetime.strptime(end_date[:10], '%Y-%m-%d') - datetime.timedelta(days=1)
+    months = []
+    while month <= last_day:
+        months.append(month.strftime('%Y-%m'))
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+    return months
+
+
+def month_is_final(month):
+    """
+    Whether a month ended long enough ago that nobody should still be logging time against it
+
+    Args:
+        month (str): The month, in the format YYYY-MM
+
+    Returns:
+        final (bool): True if the month's rollups can be treated as closed
+    """
+    month_end = (datetime.datetime.strptime(month, '%Y-%m') + datetime.timedelta(days=32)).replace(day=1)
+    return datetime.datetime.now() > month_end + datetime.timedelta(days=rollup_close_after_days)
+
+
+def time_entries_scopes(start_date, end_date, company_id=None):
+    """
+    The cache scopes a list of time entries depends on: each of its months, for everyone and for its company
+
+    A list for every company uses "*" in place of the company ID, so invalidating one company's month
+    also invalidates the lists for everyone, but not the lists for other companies.
+    """
+    company_scope = '*' if company_id is None else company_id
+    return [scope for month in months_between(start_date, end_date)
+            for scope in (f'time_entries:{month}', f'time_entries:{month}:{company_scope}')]
+
+
+def get_all_pages(url, parallel=False):
+    return [record for page_data in get_paginated(url, get_api_key(), parallel) for record in page_data]
+
+
+@memory_cache(ticket_cache_max_bytes, ttl=ticket_ttl, version=lambda ticket_id: cache_version(f'ticket:{ticket_id}'))
 def get_ticket_data(ticket_id):
-    ticket_url = f'{base_url}/tickets/{ticket_id}'
-    ticket_data, _ = get_data_from_api(ticket_url, api_key)
-    return ticket_data
+    # Every 'ticket' record in the store has its requester and stats embedded, as the tickets list has
+    ticket_url = f'{base_url}/tickets/{ticket_id}?include=requester,stats'
+    return get_stored_entity('ticket', ticket_id, ticket_url, ticket_ttl)
 
 
-@st.cache_resource(ttl=60*60, show_spinner=False)
-def get_tickets_data(updated_since=None, per_page=100, order_by='updated_at', order_type='desc', include='stats,requester,description'):
+@memory_cache(tickets_list_cache_max_bytes, ttl=tickets_sync_interval, version=lambda *args, **kwargs: cache_version('tickets'))
+def get_tickets_data(updated_since=None, per_page=100, order_by='updated_at', order_type='desc', include='stats,requester'):
     if updated_since is None:
         # Get tickets from the last 90 days
         date = datetime.datetime.now() - datetime.timedelta(days=90)
         date = date.replace(year=date.year, month=1, day=1, hour=16, minute=20)
         date_utc = date.astimezone(datetime.timezone.utc)
         updated_since = date_utc.strftime('%Y-%m-%dT%H:%M:%SZ')
-    tickets_url = f'{base_url}/tickets/?per_page={per_page}&order_by={order_by}&order_type={order_type}&include={include}&updated_since={updated_since}'
-    tickets_data = []
-    for page_data in get_paginated(tickets_url, api_key):
-        tickets_data.extend(page_data)
+    tickets_data = sync_tickets(updated_since, per_page, include)
+    return sorted(tickets_data, key=lambda ticket: ticket[order_by], reverse=order_type == 'desc')
+
+
+@single_flight
+def sync_tickets(updated_since, per_page=100, include='stats,requester'):
+    """
+    Keep the local copy of every ticket updated since a date in step with FreshDesk
+
+    The first sync downloads the whole window. After that we remember the newest `updated_at` we've
+    seen and only ask FreshDesk for tickets changed since then, merging them into the local set and
+    dropping any that have been deleted or marked as spam. Merged tickets need no special handling:
+    FreshDesk closes the secondary ticket, which bumps its `updated_at`. The whole window is still
+    re-downloaded every `tickets_full_sync_interval` seconds, as a backstop.
+
+    Args:
+        updated_since (str): The start of the window, in the format YYYY-MM-DDTHH:MM:SSZ
+        per_page (int): How many tickets to ask FreshDesk for per page
+        include (str): The extra fields to embed in each ticket
+
+    Returns:
+        tickets_data (list): Every ticket in the window
+    """
+    store = get_store()
+    sync_key = f'tickets_sync?include={include}'
+    sync_state = store.get_meta(sync_key, {})
+    watermark = sync_state.get('watermark')
+    local_tickets = store.get_query(sync_key)
+
+    needs_full_sync = (
+        local_tickets is None
+        or watermark is None
+        or sync_state.get('updated_since') != updated_since
+        or time.time() - sync_state.get('full_sync_at', 0) > tickets_full_sync_interval
+    )
+
+    if needs_full_sync:
+        tickets_url = f'{base_url}/tickets/?per_page={per_page}&include={include}&updated_since={updated_since}'
+        tickets_data = get_all_pages(tickets_url, parallel=True)
+        sync_state = {'updated_since': updated_since, 'full_sync_at': time.time()}
+    else:
+        tickets_by_id = {ticket['id']: ticket for ticket in local_tickets}
+        changes_url = f'{base_url}/tickets/?per_page={per_page}&include={include}&updated_since={watermark}'
+        for ticket in get_all_pages(changes_url):
+            tickets_by_id[ticket['id']] = ticket
+        for removed_filter in ('deleted', 'spam'):
+            removed_url = f'{base_url}/tickets/?per_page={per_page}&filter={removed_filter}&updated_since={watermark}'
+            for ticket in get_all_pages(removed_url):
+                tickets_by_id.pop(ticket['id'], None)
+        tickets_data = [ticket for ticket in tickets_by_id.values() if ticket['updated_at'] >= updated_since]
+
+    # Timestamps are all UTC in the same format, so they sort as strings
+    seen_updated_at = [ticket['updated_at'] for ticket in tickets_data]
+    if not needs_full_sync:
+        seen_updated_at.append(watermark)
+    sync_state['watermark'] = max(seen_updated_at, default=updated_since)
+    store.put_query(sync_key, 'ticket', tickets_data)
+    store.set_meta(sync_key, sync_state)
     return tickets_data
 
 
+@memory_cache(ticket_description_cache_max_bytes, ttl=ticket_ttl, version=lambda ticket_id: cache_version(f'ticket:{ticket_id}'))
+def get_ticket_description(ticket_id):
+    """
+    Get a ticket's description, which get_tickets_data leaves out to keep the list small
+
+    Args:
+        ticket_id (int): The ID of the ticket
+
+    Returns:
+        description (str or None): The description's HTML, or None if the ticket can't be found
+    """
+    # Kept apart from the 'ticket' records, which come from the list and embed the requester instead
+    ticket_url = f'{base_url}/tickets/{ticket_id}'
+    ticket_data = get_stored_entity('ticket_description', ticket_id, ticket_url, ticket_ttl)
+    return ticket_data.get('description') if ticket_data is not None else None
+
 
-@st.cache_resource(ttl=60*60, show_spinner=False)
+@cache_resource(version=lambda query: cache_version('tickets'), ttl=ticket_ttl, show_spinner=False)
 def search_tickets(query):
     """
     More information: https://developers.freshdesk.com/api/#filter_tickets
@@ -41,31 +235,53 @@ def search_tickets(query):
     encoded_query = urllib.parse.quote(query) 
     search_url = f'{base_url}/search/tickets?query="{encoded_query}"'
     tickets_data = []
-    for page_data in get_paginated(search_url, api_key):
-        tickets_data.extend(page_data)
+    for page_data in get_paginated(search_url, get_api_key()):
+        # The search endpoint wraps each page's tickets in a `results` object
+        tickets_data.extend(page_data['results'] if isinstance(page_data, dict) else page_data)
+    # Search results can't embed the requester or stats, so they aren't stored as 'ticket' records
     return tickets_data
 
 
-@st.cache_resource(ttl=60*60*24*7, show_spinner=False)
+@cache_resource(version=lambda agent_id: cache_version('agents'), ttl=reference_ttl, show_spinner=False)
 def get_agent_data(agent_id):
     agent_url = f'{base_url}/agents/{agent_id}'
-    agent_data, _ = get_data_from_api(agent_url, api_key)
-    return agent_data
+    return get_stored_entity('agent', agent_id, agent_url, reference_ttl)
 
 
-@st.cache_resource(ttl=60*60*24*7, show_spinner=False)
+@cache_resource(version=lambda group_id: cache_version('groups'), ttl=reference_ttl, show_spinner=False)
 def get_group_data(group_id):
     group_url = f'{base_url}/groups/{group_id}'
-    group_data, _ = get_data_from_api(group_url, api_key)
-    return group_data
+    return get_stored_entity('group', group_id, group_url, reference_ttl)
+
+
+@cache_resource(version=lambda: cache_version('agents'), ttl=reference_ttl, show_spinner=False)
+def get_agents_data():
+    agents_url = f'{base_url}/agents?per_page=100'
+    return get_stored_list('agent', agents_url, reference_ttl)
 
 
-@st.cache_resource(ttl=60*60*24*7, show_spinner=False)
+def get_agent_options(agents_data):
+    agent_options = {agent['id']: agent['contact']['name']
+                     for agent in agents_data}
+    return agent_options
+
+
+@cache_resource(version=lambda: cache_version('groups'), ttl=reference_ttl, show_spinner=False)
+def get_groups_data():
+    groups_url = f'{base_url}/groups?per_page=100'
+    return get_stored_list('group', groups_url, reference_ttl)
+
+
+def get_group_options(groups_data):
+    group_options = {group['id']: group['name']
+                     for group in groups_data}
+    return group_options
+
+
+@cache_resource(version=lambda: cache_version('products'), ttl=reference_ttl, show_spinner=False)
 def get_products_data():
     products_url = f'{base_url}/products'
-    products_data = [page_data for sublist in get_paginated(
-        products_url, api_key) for page_data in sublist]
-    return products_data
+    return get_stored_list('product', products_url, reference_ttl)
 
 
 def get_product_options(products_data):
@@ -74,16 +290,15 @@ def get_product_options(products_data):
     return product_options
 
 
-@st.cache_resource(ttl=60*60*24*7, show_spinner=False)
+@memory_cache(requester_cache_max_bytes, ttl=reference_ttl, version=lambda requester_id: cache_version(f'contact:{requester_id}'))
 def get_requester_data(requester_id):
     requester_url = f'{base_url}/contacts/{requester_id}'
-    requester_data, _ = get_data_from_api(requester_url, api_key)
-    return requester_data
+    return get_stored_entity('contact', requester_id, requester_url, reference_ttl)
 
 
 def get_data_from_api(url, api_key):
-    response = requests.get(url, auth=(api_key, 'X'))
-    if response.ok:
+    response = get_client(api_key).get(url)
+    if response is not None and response.ok:
         data = response.json()
         link_header = response.headers.get('link')
         return data, link_header
@@ -91,22 +306,89 @@ def get_data_from_api(url, api_key):
         return None, None
 
 
-def get_paginated(url, api_key):
-    data, link_header = get_data_from_api(url, api_key)
-    if data is not None:
-        yield data
-        if link_header:
-            next_url = link_header.split(';')[0].strip('<').strip('>')
-            yield from get_paginated(next_url, api_key)
+def get_paginated(url, api_key, parallel=False):
+    """
+    Yields each page of a paginated FreshDesk list, in order
+
+    Pages are fetched one after another by following the `link` header, but the next page is always
+    being fetched in the background while the caller works on the current one. With `parallel`, the
+    URL must accept a `page` parameter, and once the first page shows there are more, `pagination_workers`
+    pages are kept in flight at once.
 
+    If a page can't be fetched, even after retries, `requests.RequestException` is raised rather than
+    the list ending early, so a truncated list is never cached as if it were complete.
 
-@st.cache_resource(ttl=60*60*24*7, show_spinner=False)
+    Args:
+        url (str): The first page of the list
+        api_key (str): The FreshDesk API key
+        parallel (bool): Whether to request several pages at once by number
+
+    Yields:
+        page_data (list): The records on each page
+    """
+    if parallel:
+        yield from get_paginated_in_parallel(url, api_key)
+        return
+    # The worker sends its requests at our priority
+    with ThreadPoolExecutor(max_workers=1, initializer=set_request_priority, initargs=(get_request_priority(),)) as executor:
+        next_page = executor.submit(get_data_from_api, url, api_key)
+        while next_page is not None:
+            data, link_header = next_page.result()
+            if data is None:
+                raise requests.RequestException(f"Couldn't fetch a page of {url}")
+            next_url = get_next_url(link_header)
+            next_page = executor.submit(get_data_from_api, next_url, api_key) if next_url else None
+            yield data
+
+
+def get_paginated_in_parallel(url, api_key, workers=pagination_workers):
+    separator = '&' if '?' in url else '?'
+    # Most lists fit on one page, so only fan out once the first page says there's another
+    data, link_header = get_data_from_api(f'{url}{separator}page=1', api_key)
+    if data is None:
+        raise requests.RequestException(f"Couldn't fetch a page of {url}")
+    if not data:
+        return
+    yield data
+    if not get_next_url(link_header):
+        return
+
+    with ThreadPoolExecutor(max_workers=workers, initializer=set_request_priority, initargs=(get_request_priority(),)) as executor:
+        in_flight = deque(
+            executor.submit(get_data_from_api, f'{url}{separator}page={page}', api_key)
+            for page in range(2, workers + 2))
+        next_page = workers + 2
+        while in_flight:
+            data, link_header = in_flight.popleft().result()
+            if data is None:
+                for page in in_flight:
+                    page.cancel()
+                raise requests.RequestException(f"Couldn't fetch a page of {url}")
+            if not data:
+                break
+            yield data
+            if not get_next_url(link_header):
+                # That was the last page, so anything still in flight is past the end
+                break
+            in_flight.append(executor.submit(get_data_from_api, f'{url}{separator}page={next_page}', api_key))
+            next_page += 1
+        for page in in_flight:
+            page.cancel()
+
+
+def get_next_url(link_header):
+    if not link_header:
+        return None
+    for link in requests.utils.parse_header_links(link_header):
+        if link.get('rel') == 'next':
+            return link['url']
+    return None
+
+
+@cache_resource(version=lambda: cache_version('companies'), ttl=reference_ttl, show_spinner=False)
 def get_companies_data():
-    companies_url = f'{base_url}/companies'
-    companies_data = []
-    for page_data in get_paginated(companies_url, api_key):
-        companies_data.extend(page_data)
-    return companies_data
+    companies_url = f'{base_url}/companies?per_page=100'
+    return get_stored_list('company', companies_url, reference_ttl, parallel=True)
 
 
 def get_companies_options(companies_data):
@@ -116,11 +398,19 @@ def get_companies_options(companies_data):
     return companies_options
 
 
-@st.cache_resource(ttl=60*60*24*7, show_spinner=False)
+def get_companies_by_id(companies_data):
+    companies_by_id = {company_data['id']: company_data
+                       for company_data in companies_data}
+    return companies_by_id
+
+
+# Kept in memory only as long as a list for an open month stays fresh; lists for closed months are then read from the store
+@cache_resource(version=lambda start_date, end_date, selected_value=None: cache_version(*time_entries_scopes(start_date, end_date, selected_value)), ttl=tickets_sync_interval, show_spinner=False)
 def get_time_entries_data(start_date, end_date, selected_value=None):
-    time_entries_url = f'{base_url}/time_entries?executed_before={end_date}&executed_after={start_date}'
+    time_entries_url = f'{base_url}/time_entries?per_page=100&executed_before={end_date}&executed_after={start_date}'
     if selected_value is not None:
         time_entries_url += f'&company_id={selected_value}'
-    time_entries_data = [page_data for sublist in get_paginated(
-        time_entries_url, api_key) for page_data in sublist]
-    return time_entries_data
+    # Time is still being logged against open months, so their lists are refetched as often as the tickets list
+    months_are_final = all(month_is_final(month) for month in months_between(start_date, end_date))
+    max_age = reference_ttl if months_are_final else tickets_sync_interval
+    return get_stored_list('time_entry', time_entries_url, max_age, parallel=True)
@@ -2,12 +2,20 @@ import pandas as pd
 import streamlit as st
 import datetime
 import streamlit_authenticator as stauth
+from dateutil.relativedelta import relativedelta
 
 
-from config import base_url, status_mapping
-from api import get_ticket_data, get_tickets_data, get_agent_data, get_requester_data, get_group_data, get_paginated, get_products_data, get_product_options, get_companies_data, get_companies_options, get_time_entries_data
-from utils import date_range_selector, get_currency_symbol, setup_google_sheets, open_google_sheet, get_client_data, get_contract_renews_date, display_columns, get_product_options, prepare_tickets_details, prepare_tickets_details_from_time_entries, calculate_billable_time
+from config import base_url, status_mapping, ticket_search_page_size
+from api import get_ticket_data, get_tickets_data, get_ticket_description, get_agent_data, get_requester_data, get_group_data, get_paginated, get_products_data, get_product_options, get_companies_data, get_companies_options, get_companies_by_id, get_time_entries_data
+from utils import date_range_selector, get_currency_symbol, display_columns, get_product_options, prepare_tickets_details, prepare_tickets_details_from_time_entries, prepare_monthly_trend, filter_tickets_by_client
+from billing import calculate_month_summary, calculate_overview
+from rollups import get_month_tickets_details, get_month_company_totals
+from sheets import get_client_sheet
 from xero import display_xero_exporter
+from metrics import display_metrics_panel, start_exporter
+from webhooks import start_webhook_receiver
+from invalidation import display_invalidation_panel
+from warmer import start_warmer
 
 api_key = st.secrets["api_key"]
 
@@ -32,7 +40,7 @@ def display_company_summary(company_data, start_date):
 
     client_code = company_cfs['company_code']
     global client_info
-    client_info = get_client_data(worksheet, client_code)
+    client_info = client_sheet.get_client_data(client_code)
 
     contract_renews = client_info.get('contract_renews')
 
@@ -70,13 +78,12 @@ def display_time_summary(tickets_details_df, company_data, start_date):
     key = f"{year}_{month}_carryover"
     carryover_value = client_info.get(key)
 
-    total_time = f"{tickets_details_df['time_spent_this_month'].sum():.1f} h"
-    billable_time = f"{tickets_details_df['billable_time_this_month'].sum():.1f} h"
+    summary = calculate_month_summary(tickets_details_df, company_data, carryover_value)
 
-    rollover_time = "{:.1f} h".format(float(carryover_value)) if carryover_value is not None and str(
-        carryover_value).replace(".", "", 1).isdigit() else None
-    net_time = "{:.1f} h".format(tickets_details_df['billable_time_this_month'].sum(
-    ) - (float(carryover_value) if carryover_value is not None and str(carryover_value).replace('.', '', 1).isdigit() else 0)) if carryover_value is not None else None
+    total_time = f"{summary['total_hours']:.1f} h"
+    billable_time = f"{summary['billable_hours']:.1f} h"
+
+    rollover_time = "{:.1f} h".format(summary['carryover_hours']) if summary['carryover_hours'] is not None else None
 
     now = datetime.datetime.now()
     start_date_year, start_date_month = map(int, start_date.split("-")[:2])
@@ -84,10 +91,8 @@ def display_time_summary(tickets_details_df, company_data, start_date):
         now.year == start_date_year and abs(now.month - start_date_month) <= 1)
     currency_symbol = get_currency_symbol(
         company_data['custom_fields']['currency'])
-    total_billable_hours = tickets_details_df['billable_time_this_month'].sum(
-    ) - float(company_data['custom_fields'].get('inclusive_hours') or 0)
 
-    estimated_cost = f"{currency_symbol}{max(total_billable_hours - (float(carryover_value) if carryover_value is not None and str(carryover_value).replace('.', '', 1).isdigit() else 0), 0) * (company_data['custom_fields']['contract_hourly_rate']) if is_current_or_adjacent_month and company_data['custom_fields']['contract_hourly_rate'] is not None else 0.00:,.2f}"
+    estimated_cost = f"{currency_symbol}{summary['estimated_cost'] if is_current_or_adjacent_month and summary['hourly_rate'] is not None else 0.00:,.2f}"
 
     inclusive_hours = company_data['custom_fields'].get('inclusive_hours')
 
@@ -130,23 +135,17 @@ def display_time_summary(tickets_details_df, company_data, start_date):
 
 
 def display_monthly_dashboard(client_code=None):
-    client = setup_google_sheets()
-    sheet = open_google_sheet(client, st.secrets["private_gsheets_url"])
-    global worksheet
-    worksheet = sheet.get_worksheet(0)
+    global client_sheet
+    client_sheet = get_client_sheet(st.secrets["private_gsheets_url"])
 
     companies_data = get_companies_data()
     companies_options = get_companies_options(companies_data)
-    products_data = get_products_data()
-    product_options = get_product_options(products_data)
 
     global selected_value
     selected_client, selected_value, start_date, end_date = display_client_selector(
         companies_options, client_code)
-    selected_company = next(
-        (company for company in companies_data if company["id"] == selected_value), None)
-    time_entries_df = pd.DataFrame()
-    time_entries_data = []
+    selected_company = get_companies_by_id(companies_data).get(selected_value)
+    tickets_details = []
     company_data = []
 
     if selected_company is not None:
@@ -154,26 +153,19 @@ def display_monthly_dashboard(client_code=None):
                         for key in selected_company.keys()}
         display_company_summary(company_data, start_date)
 
-        time_entries_data = get_time_entries_data(
-            start_date, end_date, selected_value)
-        time_entries_df = pd.DataFrame(time_entries_data)
-    else:
-        print("No company found with the selected value.")
-
-    if not time_entries_df.empty:
-        time_entries_df = time_entries_df.astype({
-            'id': 'str',
-            'agent_id': 'str',
-            'ticket_id': 'str',
-            'company_id': 'str',
-            'time_spent_in_seconds': 'str'
-        })
+        if st.toggle("Show the trend over several months", key="trend_mode"):
+            display_trend(company_data, selected_value, end_date)
+            return
 
+        # Past months come straight from the rollups; the open month is fetched and rolled up
         progress_text = "Getting time entries for this month…"
         progress_bar = st.progress(0, text=progress_text)
-        tickets_details = prepare_tickets_details_from_time_entries(time_entries_data, product_options, progress=progress_bar, progress_text=progress_text)
+        tickets_details = get_month_tickets_details(start_date, end_date, selected_value, progress=progress_bar)
         progress_bar.progress(1.0, text="Your ticket details are ready!").empty()
+    else:
+        print("No company found with the selected value.")
 
+    if tickets_details:
         tickets_details_df = pd.DataFrame(tickets_details)
 
         if not tickets_details_df.empty:
@@ -202,12 +194,101 @@ def display_monthly_dashboard(client_code=None):
         st.write("No time tracked for this month")
 
 
+def display_admin_overview():
+    client_sheet = get_client_sheet(st.secrets["private_gsheets_url"])
+    companies_data = get_companies_data()
+
+    start_date, end_date = date_range_selector('Month', datetime.datetime.now(
+    ) - datetime.timedelta(days=1095), datetime.datetime.now(), key='overview_month')
+
+    # Every tab runs on every rerun, so only work the overview out when asked, and keep it for the session
+    overviews = st.session_state.setdefault("overview_totals", {})
+    if st.button("Work out the overview", key="overview_button"):
+        # One unfiltered pass over the month's time entries covers every client at once
+        progress_text = "Getting time entries for every client this month…"
+        progress_bar = st.progress(0, text=progress_text)
+        overviews[start_date] = get_month_company_totals(start_date, end_date, progress=progress_bar)
+        progress_bar.progress(1.0, text="Your overview is ready!").empty()
+    company_totals = overviews.get(start_date)
+    if company_totals is None:
+        st.write("Choose a month, then work out the overview to see every client's time for it.")
+        return
+
+    year, month, _ = start_date.split("-")
+    key = f"{year}_{month}_carryover"
+    carryover_values = {
+        company['custom_fields']['company_code']: client_sheet.get_client_data(company['custom_fields']['company_code']).get(key)
+        for company in companies_data if company['custom_fields'].get('company_code')
+    }
+    overview = calculate_overview(company_totals, companies_data, carryover_values)
+    overview = overview.sort_values(by=["billable_hours", "client_code"], ascending=[False, True])
+
+    display_columns({
+        "Total time tracked": f"{overview['total_hours'].sum():.1f} h",
+        "Of which potentially billable": f"{overview['billable_hours'].sum():.1f} h",
+        "Clients with time tracked": f"{(overview['total_hours'] > 0).sum()}",
+        "Clients over their inclusive hours": f"{(overview['overage_hours'] > 0).sum()}",
+    })
+
+    st.dataframe(
+        overview[["client_code", "company", "total_hours", "billable_hours", "inclusive_hours",
+                  "carryover_hours", "overage_hours", "hourly_rate", "currency", "estimated_cost"]],
+        column_config={
+            "client_code": "Client Code",
+            "company": "Client",
+            "total_hours": st.column_config.NumberColumn("Time tracked", format="%.1f h"),
+            "billable_hours": st.column_config.NumberColumn("Potentially billable", format="%.1f h"),
+            "inclusive_hours": st.column_config.NumberColumn("Inclusive hours", format="%.0f h"),
+            "carryover_hours": st.column_config.NumberColumn("Rollover", format="%.1f h"),
+            "overage_hours": st.column_config.NumberColumn("Estimated overage", format="%.1f h"),
+            "hourly_rate": st.column_config.NumberColumn("Overage rate", format="%.0f"),
+            "currency": "Currency",
+            "estimated_cost": st.column_config.NumberColumn("Estimated cost", format="%.2f"),
+        },
+        hide_index=True
+    )
+
+
+def display_trend(company_data, selected_value, end_date):
+    num_months = st.select_slider("Months", options=[3, 6, 12, 24], value=12)
+    trend_start_date = (datetime.datetime.strptime(end_date, '%Y-%m-%d') - relativedelta(months=num_months)).strftime('%Y-%m-%d')
+
+    # One fetch for the whole range; tickets with time in several months are only looked up once
+    progress_text = "Getting time entries for these months…"
+    progress_bar = st.progress(0, text=progress_text)
+    time_entries_data = get_time_entries_data(trend_start_date, end_date, selected_value)
+    product_options = get_product_options(get_products_data())
+    trend = prepare_monthly_trend(time_entries_data, product_options, trend_start_date, end_date, progress=progress_bar)
+    progress_bar.progress(1.0, text="Your trend is ready!").empty()
+
+    inclusive_hours = company_data['custom_fields'].get('inclusive_hours')
+    chart_data = trend.rename(columns={"total_hours": "Time tracked", "billable_hours": "Potentially billable"})
+    if inclusive_hours is not None:
+        chart_data["Included in contract"] = float(inclusive_hours)
+
+    st.markdown(f"#### Time tracked per month for {company_data['name']}")
+    st.line_chart(chart_data)
+
+    display_columns({
+        "Total time tracked": f"{trend['total_hours'].sum():.1f} h",
+        "Of which potentially billable": f"{trend['billable_hours'].sum():.1f} h",
+        "Average billable per month": f"{trend['billable_hours'].mean():.1f} h",
+    })
+
+
 def display_ticket_search(client_code=None):
-    tickets_data = get_tickets_data()
-    tickets_details = prepare_tickets_details(tickets_data, client_code)
+    tickets_data = filter_tickets_by_client(get_tickets_data(), client_code)
+    st.info("This view is a work in progress. It currently displays tickets that have been updated in the last 90 days. Select a ticket to read its description.")
+
+    # Only the tickets on this page are looked up and rendered
+    num_pages = max((len(tickets_data) + ticket_search_page_size - 1) // ticket_search_page_size, 1)
+    page = 1
+    if num_pages > 1:
+        page = st.number_input(f"Page (of {num_pages})", min_value=1, max_value=num_pages, value=1, key="ticket_search_page")
+    page_tickets = tickets_data[(page - 1) * ticket_search_page_size:page * ticket_search_page_size]
+    tickets_details = prepare_tickets_details(page_tickets, client_code)
     tickets_details_df = pd.DataFrame(tickets_details)
-    st.info("This view is a work in progress. It currently displays tickets that have been updated in the last 90 days.")
-    st.dataframe(
+    event = st.dataframe(
         tickets_details_df,
         column_config = {
             "Ticket ID": st.column_config.NumberColumn(
@@ -223,12 +304,29 @@ def display_ticket_search(client_code=None):
                 format="DD MMM YY HH:mm"
             ),
         },
-        hide_index=True
+        hide_index=True,
+        on_select="rerun",
+        selection_mode="single-row",
+        key=f"ticket_search_{page}"
 )
 
+    # Descriptions are left out of the list, so fetch the selected ticket's now
+    for row in event.selection.rows:
+        ticket = tickets_details_df.iloc[row]
+        with st.expander(f"#{ticket['Ticket ID']}: {ticket['Title']}", expanded=True):
+            with st.spinner("Getting the description…"):
+                description = get_ticket_description(int(ticket["Ticket ID"]))
+            if description:
+                st.html(description)
+            else:
+                st.write("This ticket has no description.")
+
 
 def main():
     st.set_page_config(layout="wide", page_icon=":bar_chart:")
+    start_exporter()
+    start_webhook_receiver()
+    start_warmer()
 
     import yaml
     from yaml.loader import SafeLoader
@@ -252,11 +350,17 @@ def main():
 
     if st.session_state.get("authentication_status", False):
         if client_code == "admin":
-            tab1, tab2, tab3 = st.tabs(["Tickets by tracked time", "Tickets by status", "Export for Xero"])
+            tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["Tickets by tracked time", "Tickets by status", "All clients", "Export for Xero", "Metrics", "Caches"])
             with tab1:
                 display_monthly_dashboard(name)
             with tab3:
+                display_admin_overview()
+            with tab4:
                 display_xero_exporter()
+            with tab5:
+                display_metrics_panel()
+            with tab6:
+                display_invalidation_panel()
             with tab2:
                 display_ticket_search(client_code)
             
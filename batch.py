@@ -0,0 +1,117 @@
+# batch.py
+"""
+Month-end reporting without the Streamlit UI: every client's monthly summary, plus the Xero CSV.
+
+Usage:
+    FRESHDESK_API_KEY=... python batch.py --month 2024-05 --output-dir reports/
+
+Reads the FreshDesk API key from FRESHDESK_API_KEY (or .streamlit/secrets.toml), and the client sheet
+for carryover hours from .streamlit/secrets.toml unless --no-sheets is given.
+"""
+
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from api import get_companies_data
+from billing import calculate_month_summary
+from freshdesk_client import set_request_priority
+from rollups import get_month_tickets_details
+from xero import iter_xero_frames, write_xero_csv
+
+
+def summarise_client(company_data, start_date, end_date, carryover_value=None):
+    """
+    Work out one client's monthly summary; runs in a worker thread
+
+    Args:
+        company_data (dict): The client's company from the FreshDesk API
+        start_date (str): The first day of the month, in the format YYYY-MM-DD
+        end_date (str): The first day of the next month, in the format YYYY-MM-DD
+        carryover_value: The hours carried over into this month, from the client sheet, if any
+
+    Returns:
+        summary (dict): See `billing.calculate_month_summary`
+    """
+    tickets_details = get_month_tickets_details(start_date, end_date, company_data['id'])
+    return calculate_month_summary(tickets_details, company_data, carryover_value)
+
+
+def get_carryover_values(companies, selected_date):
+    import streamlit as st
+    from sheets import get_client_sheet
+
+    client_sheet = get_client_sheet(st.secrets["private_gsheets_url"])
+    key = selected_date.strftime("%Y_%m_carryover")
+    return {company['id']: client_sheet.get_client_data(company['custom_fields']['company_code']).get(key)
+            for company in companies}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--month', required=True, help="the month to report on, as YYYY-MM")
+    parser.add_argument('--output-dir', default='.', help="where to write the CSV files")
+    parser.add_argument('--client', action='append', help="only report on this client code; can be repeated")
+    parser.add_argument('--territory', action='append', help="only export invoices for this territory; can be repeated")
+    parser.add_argument('--workers', type=int, default=4, help="how many clients to work on at once")
+    parser.add_argument('--no-sheets', action='store_true', help="don't read carryover hours from Google Sheets")
+    parser.add_argument('--no-xero', action='store_true', help="don't write the Xero CSV")
+    args = parser.parse_args(argv)
+
+    # Streamlit's caches work without the app, but warn on every thread that isn't running a script
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+
+    selected_date = datetime.strptime(args.month, "%Y-%m")
+    start_date = selected_date.strftime("%Y-%m-%d")
+    end_date = (selected_date + relativedelta(months=1)).strftime("%Y-%m-%d")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    companies = [company for company in get_companies_data() if company['custom_fields'].get('company_code')]
+    if args.client:
+        companies = [company for company in companies if company['custom_fields']['company_code'] in args.client]
+    carryover_values = {} if args.no_sheets else get_carryover_values(companies, selected_date)
+
+    summaries = []
+    # Month-end reporting runs at "export" priority. Dashboards are served by other processes, so they can't
+    # jump this one's queue, but the export leaves them `request_priority_reserves` of FreshDesk's budget
+    set_request_priority("export")
+    # Threads rather than processes, so every worker draws on this process's one rate limit budget
+    with ThreadPoolExecutor(max_workers=args.workers, initializer=set_request_priority, initargs=("export",)) as executor:
+        futures = {
+            executor.submit(summarise_client, company, start_date, end_date, carryover_values.get(company['id'])): company
+            for company in companies
+        }
+        for future in as_completed(futures):
+            company = futures[future]
+            try:
+                summaries.append(future.result())
+            except Exception as error:
+                print(f"Couldn't summarise {company['name']}: {error}", file=sys.stderr)
+            else:
+                print(f"Summarised {company['name']}", file=sys.stderr)
+
+    summaries_df = pd.DataFrame(summaries).sort_values(by='client_code') if summaries else pd.DataFrame()
+    if not summaries_df.empty:
+        summaries_df['invoice_ticket_ids'] = summaries_df['invoice_ticket_ids'].map(lambda ids: " ".join(map(str, ids)))
+    summary_path = os.path.join(args.output_dir, f"monthly_summary_{args.month}.csv")
+    summaries_df.to_csv(summary_path, index=False)
+    print(f"Wrote {summary_path}", file=sys.stderr)
+
+    if not args.no_xero:
+        territories = args.territory or ['Made Media Inc.', 'Made Media Ltd.']
+        xero_path = os.path.join(args.output_dir, f"xero_{args.month}.csv")
+        with open(xero_path, 'wb') as xero_file:
+            write_xero_csv(iter_xero_frames([selected_date.strftime("%B %Y")], territories), xero_file)
+        print(f"Wrote {xero_path}", file=sys.stderr)
+
+    return 0 if len(summaries) == len(companies) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
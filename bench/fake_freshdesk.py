@@ -0,0 +1,340 @@
+# bench/fake_freshdesk.py
+"""
+A stand-in for the FreshDesk API that serves synthetic or recorded data from localhost.
+
+It answers the endpoints api.py uses: paginated lists with `link` headers, single records, ticket search
+and time entries. It can also add latency to every response and throttle a share of requests with 429s.
+
+Usage:
+    python -m bench.fake_freshdesk --entries 10000 --port 8765 --latency 0.05
+    FRESHDESK_BASE_URL=http://127.0.0.1:8765/api/v2 FRESHDESK_API_KEY=x streamlit run app.py
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The files a directory of recorded fixtures holds, one JSON list per kind
+FIXTURE_KINDS = ["companies", "agents", "groups", "products", "contacts", "tickets", "time_entries"]
+
+
+def generate_data(num_time_entries, month="2024-05", num_companies=50, seed=0):
+    """
+    Make up a FreshDesk account with the given number of time entries in one month
+
+    Args:
+        num_time_entries (int): How many time entries to log in the month
+        month (str): The month to log them in, in the format YYYY-MM
+        num_companies (int): How many client companies there are
+        seed (int): Seeds the random choices, so every run sees the same account
+
+    Returns:
+        data (dict): Lists of records for each of `FIXTURE_KINDS`
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    month_start = datetime.datetime.strptime(month, "%Y-%m").replace(tzinfo=datetime.timezone.utc)
+
+    def timestamp(moment):
+        return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    products = [{"id": 100 + index, "name": name}
+                for index, name in enumerate(["BlocksOffice", "MonkeyWrench", "Website", "Apps", "Hosting"])]
+    groups = [{"id": 200 + index, "name": f"Group {index}"} for index in range(8)]
+    agents = [{"id": 300 + index, "contact": {"name": f"Agent {index}", "email": f"agent{index}@example.com"}}
+              for index in range(20)]
+    companies = [{
+        "id": 1000 + index,
+        "name": f"Client {index}",
+        "custom_fields": {
+            "company_code": f"C{index:03d}",
+            "inclusive_hours": rng.choice([None, 2, 5, 10]),
+            "contract_hourly_rate": rng.choice([None, 95, 120, 150]),
+            "currency": rng.choice(["GBP", "USD", "EUR"]),
+            "territory": rng.choice(["Made Media Ltd.", "Made Media Inc."]),
+            "support_contract": "Standard",
+            "paid_annually": False,
+        },
+    } for index in range(num_companies)]
+
+    num_tickets = max(num_time_entries // 5, 1)
+    contacts = [{"id": 5000 + index, "name": f"Contact {index}", "email": f"contact{index}@example.com"}
+                for index in range(max(num_tickets // 3, 1))]
+    tickets = []
+    for index in range(num_tickets):
+        created = now - datetime.timedelta(days=rng.uniform(0, 80))
+        tickets.append({
+            "id": 10000 + index,
+            "subject": f"Ticket {index}",
+            "description": "<div>" + "Lorem ipsum dolor sit amet. " * rng.randint(5, 200) + "</div>",
+            "description_text": "",
+            "status": rng.choice([2, 3, 4, 5, 6, 8]),
+            "type": rng.choice(["Question", "Incident", "Problem", "Feature Request"]),
+            "company_id": rng.choice(companies)["id"],
+            "product_id": rng.choice(products)["id"],
+            "group_id": rng.choice(groups)["id"],
+            "responder_id": rng.choice(agents)["id"],
+            "requester_id": rng.choice(contacts)["id"],
+            "tags": [],
+            "created_at": timestamp(created),
+            "updated_at": timestamp(created + datetime.timedelta(days=rng.uniform(0, 10))),
+            "custom_fields": {
+                "billing_status": rng.choice(["Billable", "Billable", "Billable", "Free", "90 days", "Invoice"]),
+                "change_request": rng.random() < 0.2,
+                "category": rng.choice(["Bug", "Question", "Configuration"]),
+                "cf_client_deadline": None,
+            },
+        })
+
+    days_in_month = ((month_start + datetime.timedelta(days=32)).replace(day=1) - month_start).days
+    time_entries = []
+    for index in range(num_time_entries):
+        ticket = rng.choice(tickets)
+        executed = month_start + datetime.timedelta(seconds=rng.uniform(0, days_in_month * 86400 - 1))
+        time_entries.append({
+            "id": 900000 + index,
+            "ticket_id": ticket["id"],
+            "company_id": ticket["company_id"],
+            "agent_id": ticket["responder_id"],
+            "billable": rng.random() < 0.8,
+            "time_spent_in_seconds": rng.choice([900, 1800, 2700, 3600, 5400]),
+            "executed_at": timestamp(executed),
+            "created_at": timestamp(executed),
+            "updated_at": timestamp(executed),
+        })
+
+    return {"companies": companies, "agents": agents, "groups": groups, "products": products,
+            "contacts": contacts, "tickets": tickets, "time_entries": time_entries}
+
+
+def send_webhook(url, event, secret=None):
+    """
+    POSTs a webhook event the way a FreshDesk automation rule would, e.g. to drive webhooks.WebhookReceiver
+
+    Returns:
+        status (int): The receiver's response status
+    """
+    request = urllib.request.Request(url, data=json.dumps(event).encode(), method="POST",
+                                     headers={"Content-Type": "application/json", "X-Webhook-Secret": secret or ""})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def load_fixtures(directory):
+    """Reads recorded responses from `<kind>.json` files, e.g. saved from the real API; missing kinds are empty"""
+    data = {}
+    for kind in FIXTURE_KINDS:
+        path = os.path.join(directory, f"{kind}.json")
+        if os.path.exists(path):
+            with open(path) as fixture_file:
+                data[kind] = json.load(fixture_file)
+        else:
+            data[kind] = []
+    return data
+
+
+class FakeFreshdesk:
+    """
+    Serves a FreshDesk account from memory on a background thread.
+
+    Every request is counted, by endpoint, so benchmarks can report how many calls a run made.
+    `latency` is added to every response, and roughly `throttle_rate` of requests get a 429 with
+    a `Retry-After` of `retry_after` seconds.
+    """
+
+    def __init__(self, data, host="127.0.0.1", port=0, latency=0.0, throttle_rate=0.0, retry_after=1, rate_limit=100000):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+        self.load(data)
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def load(self, data):
+        """Swaps in a different account, keeping the server running"""
+        self.data = data
+        self.by_id = {kind: {record["id"]: record for record in data.get(kind, [])} for kind in FIXTURE_KINDS}
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api/v2"
+
+    @property
+    def request_count(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests.clear()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def handle(self, request):
+        parsed = urllib.parse.urlsplit(request.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        path = parsed.path.rstrip("/")
+        if path.startswith("/api/v2"):
+            path = path[len("/api/v2"):]
+        endpoint = re.sub(r"/\d+(?=/|$)", "/{id}", path)
+        with self.lock:
+            self.requests[endpoint] += 1
+            throttled = self.random.random() < self.throttle_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            return self.respond(request, 429, {"message": "You have exceeded the limit of requests per minute"},
+                                {"Retry-After": str(self.retry_after)})
+
+        match = re.fullmatch(r"/(tickets|contacts|agents|groups|companies|products|time_entries)/(\d+)", path)
+        if match:
+            record = self.by_id[match.group(1)].get(int(match.group(2)))
+            if record is None:
+                return self.respond(request, 404, {"code": "invalid_value", "message": "Record not found"})
+            if match.group(1) == "tickets" and "requester" in params.get("include", "").split(","):
+                record = self.embed_requester(dict(record))
+            return self.respond(request, 200, record)
+
+        match = re.fullmatch(r"/tickets/(\d+)/time_entries", path)
+        if match:
+            ticket_id = int(match.group(1))
+            if ticket_id not in self.by_id["tickets"]:
+                return self.respond(request, 404, {"code": "invalid_value", "message": "Record not found"})
+            time_entries = [time_entry for time_entry in self.data.get("time_entries", []) if time_entry["ticket_id"] == ticket_id]
+            return self.respond_page(request, parsed, params, time_entries)
+
+        if path in ("/companies", "/agents", "/groups", "/products", "/contacts"):
+            return self.respond_page(request, parsed, params, self.data.get(path[1:], []))
+        if path == "/tickets":
+            return self.respond_page(request, parsed, params, self.list_tickets(params))
+        if path == "/time_entries":
+            return self.respond_page(request, parsed, params, self.list_time_entries(params))
+        if path == "/search/tickets":
+            # Only enough of the query language to be useful: every ticket matches, 30 to a page, up to 10 pages
+            tickets = self.data.get("tickets", [])
+            page = int(params.get("page", 1))
+            results = tickets[(page - 1) * 30:page * 30] if page <= 10 else []
+            return self.respond(request, 200, {"results": results, "total": min(len(tickets), 300)})
+        return self.respond(request, 404, {"message": "Not found"})
+
+    def list_tickets(self, params):
+        if params.get("filter") in ("deleted", "spam"):
+            return []
+        updated_since = params.get("updated_since", "")
+        include = params.get("include", "").split(",")
+        tickets = []
+        for ticket in self.data.get("tickets", []):
+            if ticket["updated_at"] < updated_since:
+                continue
+            ticket = dict(ticket)
+            # Like FreshDesk, descriptions and requesters are only included in lists on request
+            if "description" not in include:
+                ticket.pop("description", None)
+                ticket.pop("description_text", None)
+            if "requester" in include:
+                ticket = self.embed_requester(ticket)
+            tickets.append(ticket)
+        return tickets
+
+    def embed_requester(self, ticket):
+        contact = self.by_id["contacts"].get(ticket["requester_id"])
+        if contact is not None:
+            ticket["requester"] = {"id": contact["id"], "name": contact["name"], "email": contact.get("email")}
+        return ticket
+
+    def list_time_entries(self, params):
+        executed_after = params.get("executed_after", "")
+        executed_before = params.get("executed_before")
+        company_id = params.get("company_id")
+        return [
+            time_entry for time_entry in self.data.get("time_entries", [])
+            if time_entry["executed_at"] >= executed_after
+            and (executed_before is None or time_entry["executed_at"] < executed_before)
+            and (company_id is None or str(time_entry["company_id"]) == company_id)
+        ]
+
+    def respond_page(self, request, parsed, params, records):
+        per_page = min(int(params.get("per_page", 30)), 100)
+        page = int(params.get("page", 1))
+        headers = {}
+        if page * per_page < len(records):
+            next_query = urllib.parse.urlencode({**params, "page": page + 1})
+            host, port = self.server.server_address[:2]
+            headers["link"] = f'<http://{host}:{port}{parsed.path}?{next_query}>; rel="next"'
+        return self.respond(request, 200, records[(page - 1) * per_page:page * per_page], headers)
+
+    def respond(self, request, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(payload)))
+        request.send_header("X-RateLimit-Total", str(self.rate_limit))
+        request.send_header("X-RateLimit-Remaining", str(self.rate_limit))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(payload)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1000, help="how many synthetic time entries to serve")
+    parser.add_argument("--month", default="2024-05", help="the month the time entries are in, as YYYY-MM")
+    parser.add_argument("--fixtures", help="serve recorded <kind>.json files from this directory instead")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before every response")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="the share of requests to answer with a 429")
+    args = parser.parse_args(argv)
+
+    data = load_fixtures(args.fixtures) if args.fixtures else generate_data(args.entries, args.month)
+    fake = FakeFreshdesk(data, port=args.port, latency=args.latency, throttle_rate=args.throttle_rate)
+    print(f"Serving a fake FreshDesk at {fake.base_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# bench/run_benchmarks.py
+"""
+Times the ticket pipelines and the Xero export against a local fake FreshDesk, at several sizes.
+
+For each size, every benchmark is run cold (empty store and caches) and then warm (straight after),
+reporting wall time, how many requests reached the fake server, and peak Python memory.
+
+Usage:
+    python -m bench.run_benchmarks --sizes 1000 10000 100000 --output bench_output.txt
+"""
+
+import argparse
+import datetime
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench.fake_freshdesk import FakeFreshdesk, generate_data, load_fixtures
+
+
+def run(benchmark, fake):
+    fake.reset_counts()
+    tracemalloc.start()
+    started = time.perf_counter()
+    benchmark()
+    wall_time = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return wall_time, fake.request_count, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="numbers of time entries to try")
+    parser.add_argument("--month", default="2024-05", help="the month to report on, as YYYY-MM")
+    parser.add_argument("--fixtures", help="use recorded <kind>.json files from this directory instead of synthetic data")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake server waits before every response")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="the share of requests the fake server answers with a 429")
+    parser.add_argument("--output", help="also append the results to this file")
+    args = parser.parse_args(argv)
+
+    fake = FakeFreshdesk({}, latency=args.latency, throttle_rate=args.throttle_rate).start()
+
+    # config.py reads these when it's first imported, so they have to be set before the app's modules are
+    os.environ["FRESHDESK_BASE_URL"] = fake.base_url
+    os.environ.setdefault("FRESHDESK_API_KEY", "bench")
+    store_dir = tempfile.mkdtemp(prefix="support_reports_bench_")
+    os.environ["SUPPORT_REPORTS_STORE"] = os.path.join(store_dir, "store.sqlite3")
+
+    import streamlit as st
+    import store
+    from memory_cache import clear_memory_caches
+    from api import get_tickets_data, get_time_entries_data, get_products_data, get_product_options
+    from utils import prepare_tickets_details, prepare_tickets_details_from_time_entries
+    from xero import iter_xero_frames, write_xero_csv
+
+    selected_date = datetime.datetime.strptime(args.month, "%Y-%m")
+    start_date = selected_date.strftime("%Y-%m-%d")
+    end_date = (selected_date + datetime.timedelta(days=32)).replace(day=1).strftime("%Y-%m-%d")
+
+    benchmarks = {
+        "prepare_tickets_details": lambda: prepare_tickets_details(get_tickets_data(), "admin"),
+        "prepare_tickets_details_from_time_entries": lambda: prepare_tickets_details_from_time_entries(
+            get_time_entries_data(start_date, end_date), get_product_options(get_products_data())),
+        "xero_export": lambda: write_xero_csv(
+            iter_xero_frames([selected_date.strftime("%B %Y")], ["Made Media Ltd.", "Made Media Inc."]), io.BytesIO()),
+    }
+
+    lines = [f"# {datetime.datetime.now():%Y-%m-%d %H:%M} latency={args.latency}s throttle_rate={args.throttle_rate}",
+             f"{'benchmark':<45} {'entries':>8} {'run':>5} {'seconds':>9} {'requests':>9} {'peak MiB':>9}"]
+    print("\n".join(lines), flush=True)
+
+    for size in args.sizes:
+        fake.load(load_fixtures(args.fixtures) if args.fixtures else generate_data(size, args.month))
+        for name, benchmark in benchmarks.items():
+            # Start cold: an empty store and no in-process caches
+            store._store = store.EntityStore(os.path.join(store_dir, f"{name}_{size}.sqlite3"))
+            st.cache_resource.clear()
+            clear_memory_caches()
+            for label in ("cold", "warm"):
+                wall_time, requests, peak = run(benchmark, fake)
+                line = f"{name:<45} {size:>8} {label:>5} {wall_time:>9.2f} {requests:>9} {peak / 2**20:>9.1f}"
+                lines.append(line)
+                print(line, flush=True)
+        if args.fixtures:
+            break
+
+    fake.stop()
+    if args.output:
+        with open(args.output, "a") as output_file:
+            output_file.write("\n".join(lines) + "\n\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+# billing.py
+"""Works out which tracked time can be billed to clients, for a whole batch of time entries at once."""
+
+import pandas as pd
+
+from config import billing_rules
+
+
+def calculate_billable_hours(time_entries_df, tickets_df, rules=billing_rules):
+    """
+    Takes a batch of time entries and returns the number of hours that should be billed to the client for each
+
+    Args:
+        time_entries_df (pandas.DataFrame): Time entries from the FreshDesk API, with at least `ticket_id`,
+            `time_spent_in_seconds` and `billable` columns
+        tickets_df (pandas.DataFrame): One row per ticket, with `ticket_id`, `product` (the product name),
+            `billing_status` and `change_request` columns
+        rules (dict): The billing rules to apply; see `billing_rules` in config.py
+
+    Returns:
+        billable_hours (pandas.Series): Billable hours for each time entry, aligned with `time_entries_df`
+    """
+    if time_entries_df.empty:
+        return pd.Series(0.0, index=time_entries_df.index)
+
+    ticket_attributes = tickets_df.set_index("ticket_id")[["product", "billing_status", "change_request"]]
+    entries = time_entries_df[["ticket_id", "time_spent_in_seconds", "billable"]].join(
+        ticket_attributes, on="ticket_id")
+
+    hours = entries["time_spent_in_seconds"].astype(float) / 3600
+    entry_billable = entries["billable"].fillna(False).astype(bool)
+    change_request = entries["change_request"].fillna(False).astype(bool) & rules["change_requests_billable"]
+    unbillable_status = entries["billing_status"].isin(rules["unbillable_billing_statuses"])
+    saas_product = entries["product"].isin(rules["saas_products"])
+
+    billable = ~unbillable_status & (change_request | (~saas_product & entry_billable))
+    return hours.where(billable, 0.0)
+
+
+def parse_hours(value):
+    """Reads a number of hours from the client sheet, which may hold a number, a numeric string or anything else"""
+    if value is not None and str(value).replace('.', '', 1).isdigit():
+        return float(value)
+    return None
+
+
+def calculate_month_summary(tickets_details, company_data, carryover_value=None):
+    """
+    Totals up a client's month, and works out what they might owe for it
+
+    Args:
+        tickets_details (list): Ticket details from `prepare_tickets_details_from_time_entries`
+        company_data (dict): The client's company from the FreshDesk API
+        carryover_value: The hours carried over into this month, from the client sheet, if any
+
+    Returns:
+        summary (dict): Hours tracked, billable, included, carried over and over the allowance,
+            plus the hourly rate and the estimated cost of the overage
+    """
+    tickets_details_df = pd.DataFrame(tickets_details, columns=["ticket_id", "time_spent_this_month", "billable_time_this_month", "billing_status"])
+    custom_fields = company_data['custom_fields']
+
+    total_hours = float(tickets_details_df['time_spent_this_month'].sum())
+    billable_hours = float(tickets_details_df['billable_time_this_month'].sum())
+    inclusive_hours = custom_fields.get('inclusive_hours')
+    carryover_hours = parse_hours(carryover_value)
+    hourly_rate = custom_fields.get('contract_hourly_rate')
+    overage_hours = max(billable_hours - float(inclusive_hours or 0) - (carryover_hours or 0), 0.0)
+
+    invoice_tickets = tickets_details_df[tickets_details_df["billing_status"] == "Invoice"]
+
+    return {
+        "company_id": company_data['id'],
+        "company": company_data['name'],
+        "client_code": custom_fields.get('company_code'),
+        "total_hours": total_hours,
+        "billable_hours": billable_hours,
+        "inclusive_hours": inclusive_hours,
+        "carryover_hours": carryover_hours,
+        "overage_hours": overage_hours,
+        "hourly_rate": hourly_rate,
+        "currency": custom_fields.get('currency'),
+        "estimated_cost": overage_hours * hourly_rate if hourly_rate is not None else None,
+        "invoice_ticket_ids": invoice_tickets["ticket_id"].tolist(),
+        "invoice_hours": float(invoice_tickets["time_spent_this_month"].sum()),
+    }
+
+
+def calculate_overview(company_totals, companies_data, carryover_values=None):
+    """
+    Totals up every client's month at once
+
+    Args:
+        company_totals (pandas.DataFrame): `total_hours` and `billable_hours`, indexed by company ID, from
+            `prepare_company_totals` or the rollups
+        companies_data (list): Companies from the FreshDesk API
+        carryover_values (dict): The hours carried over into this month for each client code, from the client sheet
+
+    Returns:
+        overview (pandas.DataFrame): One row per client with a client code, with the same figures as
+            `calculate_month_summary`
+    """
+    overview = pd.DataFrame([
+        {
+            "company_id": company_data['id'],
+            "company": company_data['name'],
+            "client_code": company_data['custom_fields']['company_code'],
+            "inclusive_hours": company_data['custom_fields'].get('inclusive_hours'),
+            "hourly_rate": company_data['custom_fields'].get('contract_hourly_rate'),
+            "currency": company_data['custom_fields'].get('currency'),
+        }
+        for company_data in companies_data if company_data['custom_fields'].get('company_code')
+    ], columns=["company_id", "company", "client_code", "inclusive_hours", "hourly_rate", "currency"])
+
+    overview = overview.join(company_totals[["total_hours", "billable_hours"]], on="company_id")
+    overview["total_hours"] = overview["total_hours"].fillna(0.0).astype(float)
+    overview["billable_hours"] = overview["billable_hours"].fillna(0.0).astype(float)
+    overview["carryover_hours"] = overview["client_code"].map(
+        lambda client_code: parse_hours((carryover_values or {}).get(client_code))).astype(float)
+    overview["overage_hours"] = (
+        overview["billable_hours"]
+        - pd.to_numeric(overview["inclusive_hours"], errors="coerce").fillna(0)
+        - overview["carryover_hours"].fillna(0)
+    ).clip(lower=0)
+    overview["estimated_cost"] = overview["overage_hours"] * pd.to_numeric(overview["hourly_rate"], errors="coerce")
+    return overview
@@ -1,7 +1,11 @@
 # config.py
 
+import os
+import tempfile
+
 domain = 'mademedia'
-base_url = f'https://{domain}.freshdesk.com/api/v2'
+# FRESHDESK_BASE_URL points the app at another server, e.g. the benchmarks' stand-in in bench/
+base_url = os.environ.get("FRESHDESK_BASE_URL", f'https://{domain}.freshdesk.com/api/v2')
 
 status_mapping = {
     2: "Open",
@@ -24,3 +28,84 @@ status_mapping = {
     19: "19",
     20: "20"
 }
+
+# HTTP client settings for talking to FreshDesk
+request_timeout = 30  # seconds
+max_retries = 5
+backoff_base = 0.5  # seconds; doubled on each retry, with full jitter
+backoff_cap = 30  # seconds
+pool_size = 20  # keep-alive connections held open to FreshDesk
+rate_limit_per_minute = 200  # used until FreshDesk tells us the real figure via X-RateLimit-Total
+
+# Each process sends its requests in priority order: dashboards ("interactive"), then exports ("export"), then
+# the cache warmer ("background"). Lower priorities also leave this share of FreshDesk's rate limit budget,
+# which every process shares, free for higher ones
+request_priority_reserves = {"interactive": 0, "export": 0.2, "background": 0.5}
+
+# Billing rules applied by billing.calculate_billable_hours, in this order:
+# 1. time on a ticket with one of these billing statuses is never billable
+# 2. otherwise, time on a change request is billable (if change_requests_billable is set)
+# 3. otherwise, time on a SaaS product ticket is not billable
+# 4. otherwise, time is billable if the time entry is marked as billable
+billing_rules = {
+    "unbillable_billing_statuses": ["Free", "90 days", "Invoice"],
+    "saas_products": ["BlocksOffice", "MonkeyWrench"],
+    "change_requests_billable": True,
+}
+
+# How many FreshDesk requests to have in flight at once when hydrating tickets
+hydration_workers = 8
+
+# How many pages of a list to have in flight at once, for endpoints that accept a page number
+pagination_workers = 4
+
+# How many requests the asyncio client (freshdesk_async.py) has in flight at once, all on one thread
+async_concurrency = 20
+
+# FreshDesk webhooks are accepted on this port (see webhooks.py), if it's set; the receiver won't start without a secret
+webhook_port = int(os.environ.get("SUPPORT_REPORTS_WEBHOOK_PORT", 0)) or None
+webhook_path = "/webhooks/freshdesk"
+webhook_secret = os.environ.get("SUPPORT_REPORTS_WEBHOOK_SECRET")
+
+# How long cached FreshDesk data stays fresh, in seconds; with webhooks keeping tickets up to date, they can be kept for longer
+ticket_ttl = 60*60*24 if webhook_port and webhook_secret else 60*60
+reference_ttl = 60*60*24*7
+
+# Memory budgets for the in-process caches of tickets, the recent tickets list and requesters, in bytes;
+# the least recently used values are dropped once a cache outgrows its budget
+ticket_cache_max_bytes = 64 * 2**20
+tickets_list_cache_max_bytes = 128 * 2**20
+requester_cache_max_bytes = 16 * 2**20
+ticket_description_cache_max_bytes = 4 * 2**20
+
+# How many tickets the "Tickets by status" table shows at a time
+ticket_search_page_size = 100
+
+# get_tickets_data asks FreshDesk for changed tickets this often, and re-downloads the whole window this often
+tickets_sync_interval = 60*5
+tickets_full_sync_interval = 60*60*24
+
+# A month's rollups are treated as final once they've been refreshed this many days after the month ended
+rollup_close_after_days = 7
+
+# The on-disk store shared by every app process on this host
+store_path = os.environ.get(
+    "SUPPORT_REPORTS_STORE", os.path.join(tempfile.gettempdir(), "support_reports.sqlite3"))
+
+# Each process reuses the cache versions it has read from the store for this long, in seconds, so
+# invalidations made by other processes take up to this long to be seen
+cache_version_max_age = 1
+
+# The client data sheet is reloaded at least this often, and checked for edits this often, in seconds
+client_sheet_ttl = 60*60
+client_sheet_revision_check_interval = 60
+
+# If set, one process per host warms the caches for the current and previous month, for every company, on
+# startup and then this often, in seconds, at "background" priority. Off by default, as each run fetches
+# every company's month; an hour or so is plenty
+warm_interval = int(os.environ.get("SUPPORT_REPORTS_WARM_INTERVAL", 0))
+
+# Metrics for Prometheus: served at /metrics on this port, and/or written to this file every metrics_write_interval seconds
+metrics_port = int(os.environ.get("SUPPORT_REPORTS_METRICS_PORT", 0)) or None
+metrics_file = os.environ.get("SUPPORT_REPORTS_METRICS_FILE")
+metrics_write_interval = 15
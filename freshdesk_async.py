@@ -0,0 +1,299 @@
+# freshdesk_async.py
+"""
+An asyncio client for the FreshDesk API, for fanning out to hundreds of records without a thread per request.
+
+Requests take their tokens from the same `RequestScheduler` as freshdesk_client, so both clients share
+the rate limit budget and honour each other's priorities. For code that isn't async, like the Streamlit
+app and batch.py, `get_sync_client` runs the client on one background event loop per process.
+"""
+
+import asyncio
+import atexit
+import base64
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import aiohttp
+
+from api import get_next_url
+from config import base_url, request_timeout, max_retries, backoff_base, backoff_cap, pool_size, pagination_workers, async_concurrency
+from freshdesk_client import RETRYABLE_STATUS_CODES, get_client, get_request_priority, set_request_priority, parse_retry_after
+from metrics import record_request, record_rate_limit_wait
+
+
+class AsyncFreshdeskClient:
+    """
+    Sends GET requests to FreshDesk from one event loop, with at most `concurrency` in flight at once.
+
+    Retries work as in `FreshdeskClient`: connection errors, 5xx responses and 429s are retried up to
+    `max_retries` times with jittered exponential backoff, and a 429's `Retry-After` pauses every
+    request in the process. The session is opened on first use, on the loop the client is used from.
+    """
+
+    def __init__(self, api_key, base_url=base_url, concurrency=async_concurrency, max_retries=max_retries, timeout=request_timeout):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.scheduler = get_client(api_key).scheduler
+        self.session = None
+        self.semaphore = None
+
+    def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers={'Authorization': 'Basic ' + base64.b64encode(f'{self.api_key}:X'.encode()).decode()},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=pool_size))
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+    async def acquire(self):
+        """Waits for a token from the shared scheduler, at this task's priority, without blocking the loop"""
+        priority = get_request_priority()
+        waited = 0.0
+        with self.scheduler.queued(priority):
+            while True:
+                wait = self.scheduler.try_acquire(priority)
+                if wait == 0:
+                    break
+                # Nothing wakes us when a higher priority request has had its token, so check again soon
+                wait = wait if wait is not None else 0.05
+                await asyncio.sleep(wait)
+                waited += wait
+        if waited:
+            record_rate_limit_wait(waited, priority)
+
+    async def get(self, url):
+        """
+        Fetches a URL, retrying throttled and transient failures
+
+        Args:
+            url (str): The full URL to fetch
+
+        Returns:
+            data: The response's JSON, or None if the request failed
+            link_header (str or None): The response's `link` header, for paginated lists
+        """
+        session = self.open()
+        async with self.semaphore:
+            started = time.monotonic()
+            status, body, headers, retries = await self._send(session, url)
+            record_request(url, status, time.monotonic() - started, len(body), retries)
+        if status is None or not 200 <= status < 300:
+            return None, None
+        return json.loads(body), headers.get('link')
+
+    async def _send(self, session, url):
+        status, body, headers = None, b'', {}
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            await self.acquire()
+            try:
+                async with session.get(url) as response:
+                    status, body, headers = response.status, await response.read(), response.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if last_attempt:
+                    return None, b'', {}, attempt
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+
+            self.scheduler.update_from_headers(headers)
+            if status == 429 and not last_attempt:
+                retry_after = parse_retry_after(headers.get('Retry-After'))
+                self.scheduler.pause(retry_after if retry_after is not None else self.backoff(attempt))
+            elif status in RETRYABLE_STATUS_CODES and not last_attempt:
+                await asyncio.sleep(self.backoff(attempt))
+            else:
+                return status, body, headers, attempt
+        return status, body, headers, self.max_retries
+
+    async def get_all_pages(self, url, parallel=False):
+        """
+        Fetches every record from a paginated list
+
+        Pages are fetched one after another by following the `link` header. With `parallel`, the URL
+        must accept a `page` parameter, and once the first page shows there are more, `pagination_workers`
+        pages are requested at once. If a page can't be fetched, `aiohttp.ClientError` is raised rather
+        than the list ending early.
+
+        Args:
+            url (str): The first page of the list
+            parallel (bool): Whether to request several pages at once by number
+
+        Returns:
+            records (list): The records, in the order FreshDesk returned them
+        """
+        records = []
+        if not parallel:
+            while url:
+                data, link_header = await self.get(url)
+                if data is None:
+                    raise aiohttp.ClientError(f"Couldn't fetch a page of {url}")
+                records.extend(data['results'] if isinstance(data, dict) else data)
+                url = get_next_url(link_header)
+            return records
+
+        separator = '&' if '?' in url else '?'
+        # Most lists fit on one page, so only fan out once the first page says there's another
+        data, link_header = await self.get(f'{url}{separator}page=1')
+        if data is None:
+            raise aiohttp.ClientError(f"Couldn't fetch a page of {url}")
+        records.extend(data)
+        if not data or not get_next_url(link_header):
+            return records
+
+        first_page = 2
+        while True:
+            pages = await asyncio.gather(*(self.get(f'{url}{separator}page={page}')
+                                           for page in range(first_page, first_page + pagination_workers)))
+            for data, link_header in pages:
+                if data is None:
+                    raise aiohttp.ClientError(f"Couldn't fetch a page of {url}")
+                if not data:
+                    return records
+                records.extend(data)
+                if not get_next_url(link_header):
+                    return records
+            first_page += pagination_workers
+
+    async def get_many(self, path, ids, on_done=None, include=None):
+        """
+        Fetches several single records at once, e.g. `get_many('tickets', [1, 2, 3])`
+
+        Args:
+            path (str): Where to fetch each record from, e.g. "tickets" for /tickets/{id}
+            ids (iterable): The records' IDs; duplicates and falsy IDs are skipped
+            on_done (callable): Optionally called on the event loop as `on_done(id, completed, total)` after each fetch
+            include (str or None): The extra fields to embed in each record, e.g. "requester,stats"
+
+        Returns:
+            records (dict): Each record (or None if FreshDesk doesn't have it), keyed by ID
+        """
+        ids = [id_ for id_ in dict.fromkeys(ids) if id_]
+        query = f'?include={include}' if include else ''
+
+        async def get_one(id_):
+            data, _ = await self.get(f'{self.base_url}/{path}/{id_}{query}')
+            return id_, data
+
+        records = {}
+        for completed, next_done in enumerate(asyncio.as_completed([get_one(id_) for id_ in ids]), start=1):
+            id_, records[id_] = await next_done
+            if on_done:
+                on_done(id_, completed, len(ids))
+        return {id_: records[id_] for id_ in ids}
+
+    async def get_ticket(self, ticket_id, include=None):
+        url = f'{self.base_url}/tickets/{ticket_id}' + (f'?include={include}' if include else '')
+        data, _ = await self.get(url)
+        return data
+
+    async def get_tickets_by_id(self, ticket_ids, include='requester,stats'):
+        return await self.get_many('tickets', ticket_ids, include=include)
+
+    async def get_tickets(self, updated_since, per_page=100, include='stats,requester'):
+        return await self.get_all_pages(
+            f'{self.base_url}/tickets/?per_page={per_page}&include={include}&updated_since={updated_since}', parallel=True)
+
+    async def search_tickets(self, query):
+        """More information: https://developers.freshdesk.com/api/#filter_tickets"""
+        return await self.get_all_pages(f'{self.base_url}/search/tickets?query="{urllib.parse.quote(query)}"')
+
+    async def get_time_entries(self, start_date, end_date, company_id=None):
+        url = f'{self.base_url}/time_entries?per_page=100&executed_before={end_date}&executed_after={start_date}'
+        if company_id is not None:
+            url += f'&company_id={company_id}'
+        return await self.get_all_pages(url, parallel=True)
+
+    async def get_companies(self):
+        return await self.get_all_pages(f'{self.base_url}/companies?per_page=100', parallel=True)
+
+    async def get_products(self):
+        return await self.get_all_pages(f'{self.base_url}/products')
+
+    async def get_agents(self):
+        return await self.get_all_pages(f'{self.base_url}/agents?per_page=100')
+
+    async def get_groups(self):
+        return await self.get_all_pages(f'{self.base_url}/groups?per_page=100')
+
+    async def get_contact(self, contact_id):
+        data, _ = await self.get(f'{self.base_url}/contacts/{contact_id}')
+        return data
+
+    async def get_contacts_by_id(self, contact_ids):
+        return await self.get_many('contacts', contact_ids)
+
+
+class SyncFreshdeskClient:
+    """
+    Calls an `AsyncFreshdeskClient` from ordinary code: each of its methods can be called here with the
+    same arguments, and blocks until the result is ready.
+
+    The calls run on the process's background event loop, at the caller's request priority.
+    """
+
+    def __init__(self, api_key, loop):
+        self.loop = loop
+        self.client = AsyncFreshdeskClient(api_key)
+
+    def submit(self, coroutine):
+        """Schedules a coroutine on the event loop at the caller's priority, and returns its `concurrent.futures.Future`"""
+        priority = get_request_priority()
+
+        async def with_priority():
+            # Each call runs as its own task, so this doesn't leak into other callers' requests
+            set_request_priority(priority)
+            return await coroutine
+
+        return asyncio.run_coroutine_threadsafe(with_priority(), self.loop)
+
+    def run(self, coroutine):
+        return self.submit(coroutine).result()
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        return lambda *args, **kwargs: self.run(method(*args, **kwargs))
+
+
+_loops = {}
+_sync_clients = {}
+_lock = threading.Lock()
+
+
+def get_background_loop():
+    """Returns this process's background event loop, starting it on a daemon thread on first use"""
+    # Keyed by process, as the loop's thread doesn't survive a fork
+    pid = os.getpid()
+    with _lock:
+        if pid not in _loops:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True, name="freshdesk-async").start()
+            _loops[pid] = loop
+        return _loops[pid]
+
+
+def get_sync_client(api_key):
+    """Returns the process-wide sync facade for this API key, creating it on first use."""
+    loop = get_background_loop()
+    key = (os.getpid(), api_key)
+    with _lock:
+        if key not in _sync_clients:
+            _sync_clients[key] = SyncFreshdeskClient(api_key, loop)
+            # Close the connections cleanly before the loop's thread goes away with the process
+            atexit.register(_sync_clients[key].close)
+        return _sync_clients[key]
@@ -0,0 +1,248 @@
+# freshdesk_client.py
+"""A pooled, rate-limit-aware HTTP client for the FreshDesk API."""
+
+import contextlib
+import contextvars
+import email.utils
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import record_request, record_rate_limit_wait
+from config import request_timeout, max_retries, backoff_base, backoff_cap, pool_size, rate_limit_per_minute, request_priority_reserves
+
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+
+
+PRIORITIES = ("interactive", "export", "background")
+
+_request_priority = contextvars.ContextVar("request_priority", default="interactive")
+
+
+def get_request_priority():
+    """Returns the priority requests from this context are sent at: one of `PRIORITIES`"""
+    return _request_priority.get()
+
+
+def set_request_priority(priority):
+    """Sets the priority requests from this context are sent at, e.g. from a worker pool's initializer"""
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown request priority: {priority}")
+    _request_priority.set(priority)
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """Sends the requests made inside the `with` block, and by worker pools started there, at this priority"""
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown request priority: {priority}")
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+class RequestScheduler:
+    """
+    A thread-safe token bucket that keeps us under FreshDesk's per-minute rate limit, and hands out
+    tokens in priority order.
+
+    The bucket refills continuously at `capacity` tokens per minute. Whenever a response carries
+    the `X-RateLimit-Total` and `X-RateLimit-Remaining` headers we resync with FreshDesk's view of
+    the budget, which every process using the API key draws on, and a `Retry-After` pauses every
+    caller until it has passed.
+
+    Within a process, a request waits while any request of a higher priority is waiting, so dashboards
+    overtake queued exports and background work. Lower priorities also leave `request_priority_reserves`
+    of the budget untouched. As the budget is resynced from FreshDesk, that holds across processes too:
+    a dashboard loaded in the middle of an export run by batch.py still finds tokens ready, though it
+    doesn't jump the export's queue.
+    """
+
+    def __init__(self, capacity, reserves=request_priority_reserves):
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.reserves = reserves
+        self.waiting = [0] * len(PRIORITIES)
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.capacity / 60)
+        self.updated = now
+
+    def acquire(self, priority=None):
+        """
+        Blocks until a request may be sent, then takes a token for it
+
+        Args:
+            priority (str or None): One of `PRIORITIES`; None uses this context's `get_request_priority()`
+        """
+        priority = priority or get_request_priority()
+        waited = 0.0
+        with self.queued(priority), self.condition:
+            while True:
+                started = time.monotonic()
+                wait = self.try_acquire(priority)
+                if wait == 0:
+                    break
+                # With no wait given, we're woken when a higher priority request has had its token
+                self.condition.wait(wait)
+                waited += time.monotonic() - started
+        if waited:
+            record_rate_limit_wait(waited, priority)
+
+    def try_acquire(self, priority):
+        """
+        Takes a token if a request of this priority may be sent now, without blocking
+
+        Only call this while counted as waiting, with `queued`, so higher priorities are seen to be waiting too.
+
+        Returns:
+            wait (float or None): 0 if a token was taken; otherwise how long to wait before trying again,
+                or None while a higher priority request is waiting
+        """
+        rank = PRIORITIES.index(priority)
+        with self.condition:
+            now = time.monotonic()
+            self._refill(now)
+            needed = 1 + self.capacity * self.reserves.get(priority, 0)
+            if now < self.paused_until:
+                return self.paused_until - now
+            if any(self.waiting[:rank]):
+                return None
+            if self.tokens >= needed:
+                self.tokens -= 1
+                return 0
+            return (needed - self.tokens) * 60 / self.capacity
+
+    @contextlib.contextmanager
+    def queued(self, priority):
+        """Counts a request as waiting for a token while inside the `with` block"""
+        rank = PRIORITIES.index(priority)
+        with self.condition:
+            self.waiting[rank] += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.waiting[rank] -= 1
+                self.condition.notify_all()
+
+    def update_from_headers(self, headers):
+        total = headers.get('X-RateLimit-Total')
+        remaining = headers.get('X-RateLimit-Remaining')
+        with self.condition:
+            self._refill(time.monotonic())
+            if total and total.isdigit() and int(total) > 0:
+                self.capacity = int(total)
+            if remaining and remaining.isdigit():
+                self.tokens = min(self.tokens, float(remaining))
+
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def parse_retry_after(value):
+    """
+    Turns a `Retry-After` header into a number of seconds to wait
+
+    Args:
+        value (str or None): Either a number of seconds or an HTTP date
+
+    Returns:
+        seconds (float or None): How long to wait, or None if the header is missing or unreadable
+    """
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+class FreshdeskClient:
+    """
+    Sends GET requests to FreshDesk over a shared keep-alive connection pool.
+
+    Every request waits for a token from the scheduler first, at its context's priority. Connection errors, 5xx responses
+    and 429s are retried up to `max_retries` times with jittered exponential backoff; a 429 also
+    honours `Retry-After` so that every thread backs off together.
+    """
+
+    def __init__(self, api_key, max_retries=max_retries, timeout=request_timeout, pool_size=pool_size, rate_limit=rate_limit_per_minute):
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.scheduler = RequestScheduler(rate_limit)
+        self.session = requests.Session()
+        self.session.auth = (api_key, 'X')
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+    def get(self, url):
+        """
+        Fetches a URL, retrying throttled and transient failures
+
+        Args:
+            url (str): The full URL to fetch
+
+        Returns:
+            response (requests.Response or None): The final response, or None if we never got one
+        """
+        started = time.monotonic()
+        response, retries = self._send(url)
+        record_request(url, response.status_code if response is not None else None, time.monotonic() - started,
+                       len(response.content) if response is not None else 0, retries)
+        return response
+
+    def _send(self, url):
+        response = None
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            self.scheduler.acquire()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    return None, attempt
+                time.sleep(self.backoff(attempt))
+                continue
+
+            self.scheduler.update_from_headers(response.headers)
+            if response.status_code == 429 and not last_attempt:
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                self.scheduler.pause(retry_after if retry_after is not None else self.backoff(attempt))
+            elif response.status_code in RETRYABLE_STATUS_CODES and not last_attempt:
+                time.sleep(self.backoff(attempt))
+            else:
+                return response, attempt
+        return response, self.max_retries
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key):
+    """Returns the process-wide client for this API key, creating it on first use."""
+    # Keyed by process too, so that forked workers don't share the parent's pooled sockets
+    key = (os.getpid(), api_key)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = FreshdeskClient(api_key)
+        return _clients[key]
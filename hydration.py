@@ -0,0 +1,224 @@
+# hydration.py
+"""Fetches everything a batch of tickets refers to, in bulk and concurrently, before we build their details."""
+
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from api import get_api_key, get_ticket_data, get_group_data, get_agent_data, get_requester_data, get_groups_data, get_group_options, get_agents_data, get_agent_options
+from config import hydration_workers, ticket_ttl, reference_ttl
+from freshdesk_async import get_sync_client
+from freshdesk_client import get_request_priority, set_request_priority
+from metrics import record_cache_lookup
+from store import get_store
+
+# The prefetches in flight, keyed by kind and IDs: each has a progress queue per session waiting on it
+_prefetches = {}
+_prefetches_lock = threading.Lock()
+
+
+def fetch_concurrently(fetch, ids, on_done=None, max_workers=hydration_workers):
+    """
+    Calls `fetch` for each ID on a bounded pool of worker threads
+
+    The shared FreshDesk client rate-limits every request, so the pool only overlaps the waiting.
+
+    Args:
+        fetch (callable): Takes one ID and returns its data
+        ids (iterable): The IDs to fetch; duplicates and falsy IDs are skipped
+        on_done (callable): Optionally called on this thread as `on_done(id, completed, total)` after each fetch
+        max_workers (int): The most fetches to have in flight at once
+
+    Returns:
+        results (dict): The fetched data, keyed by ID
+    """
+    ids = [id_ for id_ in dict.fromkeys(ids) if id_]
+    results = {}
+    if not ids:
+        return results
+
+    # Let the worker threads use Streamlit's caches as part of this session, and send requests at our priority
+    ctx = get_script_run_ctx(suppress_warning=True)
+    priority = get_request_priority()
+
+    def init_worker():
+        # Outside Streamlit (batch.py, the benchmarks) there's no session to join, and attaching none only warns
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        set_request_priority(priority)
+
+    with ThreadPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+        futures = {executor.submit(fetch, id_): id_ for id_ in ids}
+        for completed, future in enumerate(as_completed(futures), start=1):
+            id_ = futures[future]
+            results[id_] = future.result()
+            if on_done:
+                on_done(id_, completed, len(ids))
+    return results
+
+
+def prefetch(kind, path, ids, max_age, on_done=None, include=None):
+    """
+    Fetches every record the store has no fresh copy of at once, on the asyncio client, and stores them
+
+    The accessors in api.py then find them in the store, so fanning out to hundreds of tickets or
+    contacts overlaps the requests on one event loop rather than a thread per request.
+
+    Sessions that find exactly the same records missing at the same time, e.g. two people opening the
+    same client's month, share one fetch, and each is told about every record as it arrives. Sets that
+    only overlap are fetched separately.
+
+    Args:
+        kind (str): The kind of record, e.g. "ticket"
+        path (str): Where to fetch each record from, e.g. "tickets" for /tickets/{id}
+        ids (iterable): The records' IDs; duplicates and falsy IDs are skipped
+        max_age (float): The oldest stored copy to accept, in seconds
+        on_done (callable): Optionally called on this thread as `on_done(id, completed, total)` after each fetch
+        include (str or None): The extra fields to embed in each record, as the accessor for this kind asks for them
+    """
+    missing_ids = get_store().get_missing_ids(kind, [id_ for id_ in dict.fromkeys(ids) if id_], max_age)
+    if not missing_ids:
+        return
+
+    key = (kind, tuple(sorted(missing_ids)))
+    updates = queue.Queue()
+    with _prefetches_lock:
+        batch = _prefetches.get(key)
+        leader = batch is None
+        if leader:
+            batch = _prefetches[key] = {"subscribers": [], "stored": Future()}
+        batch["subscribers"].append(updates)
+    record_cache_lookup("in_flight:prefetch", hit=not leader)
+
+    if not leader:
+        relay_progress(updates, batch["stored"], on_done)
+        batch["stored"].result()
+        return
+
+    def publish(*args):
+        with _prefetches_lock:
+            subscribers = list(batch["subscribers"])
+        for subscriber in subscribers:
+            subscriber.put(args)
+
+    client = get_sync_client(get_api_key())
+    fetched = client.submit(client.client.get_many(path, missing_ids, on_done=publish, include=include))
+    try:
+        relay_progress(updates, fetched, on_done)
+    finally:
+        # Others may be waiting on this fetch, so store it even if this session has gone away meanwhile
+        try:
+            records = fetched.result()
+            get_store().put_many(kind, [(id_, data) for id_, data in records.items() if data is not None])
+        except BaseException as error:
+            batch["stored"].set_exception(error)
+        else:
+            batch["stored"].set_result(None)
+        finally:
+            with _prefetches_lock:
+                del _prefetches[key]
+    batch["stored"].result()
+
+
+def relay_progress(updates, until, on_done=None):
+    """
+    Calls `on_done` on this thread for each update put on the queue, until the future is done and the queue is empty
+
+    The asyncio client calls back on its event loop's thread, but Streamlit elements must be updated
+    from the session's own thread.
+    """
+    while not (until.done() and updates.empty()):
+        try:
+            args = updates.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if on_done:
+            on_done(*args)
+
+
+def get_reference_names(tickets, on_done=None):
+    """
+    Get the names of the groups, agents and requesters that a set of tickets refers to
+
+    Groups and agents come from the full lists, which are fetched once and cached; anything missing from
+    them (e.g. a deleted agent) is fetched individually. Tickets from the tickets list embed their
+    requester, so those names are used as they are. FreshDesk can't look up several contacts by ID in
+    one request, so only the remaining requesters are fetched, concurrently.
+
+    Args:
+        tickets (list): Tickets from the FreshDesk API
+        on_done (callable): Optionally called as `on_done(id, completed, total)` after each requester is fetched
+
+    Returns:
+        names (dict): `groups`, `agents` and `requesters` dictionaries of IDs and names
+    """
+    group_names = dict(get_group_options(get_groups_data()))
+    agent_names = dict(get_agent_options(get_agents_data()))
+
+    missing_groups = [ticket["group_id"] for ticket in tickets if ticket["group_id"] not in group_names]
+    for group_id, group_data in fetch_concurrently(get_group_data, missing_groups).items():
+        if group_data is not None:
+            group_names[group_id] = group_data["name"]
+
+    missing_agents = [ticket["responder_id"] for ticket in tickets if ticket["responder_id"] not in agent_names]
+    for agent_id, agent_data in fetch_concurrently(get_agent_data, missing_agents).items():
+        if agent_data is not None:
+            agent_names[agent_id] = agent_data["contact"]["name"]
+
+    requester_names = {ticket["requester_id"]: ticket["requester"].get("name", "Unknown")
+                       for ticket in tickets if ticket.get("requester")}
+    missing_requesters = [ticket["requester_id"] for ticket in tickets if ticket["requester_id"] not in requester_names]
+    prefetch('contact', 'contacts', missing_requesters, reference_ttl, on_done)
+    requesters = fetch_concurrently(get_requester_data, missing_requesters)
+    for requester_id, requester_data in requesters.items():
+        if requester_data is not None:
+            requester_names[requester_id] = requester_data.get("name", "Unknown")
+
+    return {"groups": group_names, "agents": agent_names, "requesters": requester_names}
+
+
+def fetch_tickets(ticket_ids, progress=None):
+    """
+    Fetch a set of tickets, without anything they refer to
+
+    Args:
+        ticket_ids (iterable): The IDs of the tickets to fetch
+        progress (streamlit.Progress): An optional streamlit progress object, updated as fetches finish
+
+    Returns:
+        tickets_by_id (dict): Ticket data (or None if FreshDesk doesn't have the ticket), keyed by ticket ID
+    """
+    def on_ticket_done(ticket_id, completed, total):
+        if progress:
+            progress.progress(completed / total, text=f"Getting data for ticket #{ticket_id}…")
+
+    ticket_ids = list(ticket_ids)
+    if progress:
+        progress.progress(0.0, text="Getting tickets…")
+    prefetch('ticket', 'tickets', ticket_ids, ticket_ttl, on_ticket_done, include='requester,stats')
+    return fetch_concurrently(get_ticket_data, ticket_ids)
+
+
+def hydrate_tickets(ticket_ids, progress=None):
+    """
+    Fetch a set of tickets, then the names of the groups, agents and requesters they refer to
+
+    Args:
+        ticket_ids (iterable): The IDs of the tickets to fetch
+        progress (streamlit.Progress): An optional streamlit progress object, updated as fetches finish
+
+    Returns:
+        tickets_by_id (dict): Ticket data, keyed by ticket ID
+        names (dict): `groups`, `agents` and `requesters` dictionaries of IDs and names
+    """
+    tickets_by_id = fetch_tickets(ticket_ids, progress)
+    tickets = [ticket_data for ticket_data in tickets_by_id.values() if ticket_data is not None]
+
+    def on_requester_done(_, completed, total):
+        if progress:
+            progress.progress(completed / total, text="Getting requesters…")
+
+    names = get_reference_names(tickets, on_requester_done)
+    return tickets_by_id, names
@@ -0,0 +1,236 @@
+# invalidation.py
+"""
+Invalidates exactly what's changed in FreshDesk: one ticket, one contact, the companies, or one month of time entries.
+
+Every cached accessor in api.py keys its values by the version of the scopes it depends on, e.g.
+"ticket:123" or "time_entries:2024-05:456". Versions live in the shared store, so invalidating a scope
+here (or from a script on the same host) makes every app process ignore what it has cached for it, and
+marks the stored copies stale so they're fetched again. Nothing else is touched.
+
+Usage:
+    python invalidation.py ticket 123
+    python invalidation.py month 2024-05 --client ABC
+    python invalidation.py all
+"""
+
+import argparse
+import sys
+import urllib.parse
+from datetime import datetime
+
+import streamlit as st
+
+from api import get_companies_data, months_between
+from store import get_store
+
+
+def invalidate_ticket(ticket_id):
+    """Refetch one ticket, e.g. after its billing status has been corrected; the months it has time in are recalculated too"""
+    store = get_store()
+    store.expire('ticket', ticket_id)
+    store.delete('ticket_description', ticket_id)
+    store.bump_versions([f'ticket:{ticket_id}', 'tickets'])
+
+    # Its billable time may have changed, so reopen the rollups of the company months it has time in
+    for company_id, month in store.connection().execute(
+            "SELECT DISTINCT company_id, month FROM rollup_entries WHERE ticket_id = ?", (ticket_id,)).fetchall():
+        reopen_rollups(month, company_id)
+
+
+def invalidate_contact(contact_id):
+    store = get_store()
+    store.expire('contact', contact_id)
+    store.bump_versions([f'contact:{contact_id}'])
+
+
+def invalidate_list(kind, scope):
+    """Refetch every list of one kind of record, e.g. the companies"""
+    store = get_store()
+    for key in store.get_query_keys(kind):
+        store.expire_query(key)
+    store.bump_versions([scope])
+
+
+def invalidate_companies():
+    """Refetch the companies, e.g. after a client's rate or inclusive hours have changed"""
+    invalidate_list('company', 'companies')
+
+
+def invalidate_reference_data():
+    """Refetch the agents, groups and products"""
+    invalidate_list('agent', 'agents')
+    invalidate_list('group', 'groups')
+    invalidate_list('product', 'products')
+
+
+def invalidate_time_entries(month, company_id=None):
+    """
+    Refetch a month of time entries, for one company or for everyone
+
+    Only the stored lists that take in this month (and this company, if one is given) are marked stale,
+    so other months and other companies are still served from the store.
+
+    Args:
+        month (str): The month, in the format YYYY-MM
+        company_id (int or None): Only this company's time entries; None for everyone's
+    """
+    store = get_store()
+    for key in store.get_query_keys('time_entry'):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(key).query))
+        if 'executed_after' not in params or 'executed_before' not in params:
+            continue
+        if month not in months_between(params['executed_after'], params['executed_before']):
+            continue
+        if company_id is not None and params.get('company_id', str(company_id)) != str(company_id):
+            continue
+        store.expire_query(key)
+
+    if company_id is None:
+        store.bump_versions([f'time_entries:{month}'])
+    else:
+        # The lists for everyone take in this company's time entries too
+        store.bump_versions([f'time_entries:{month}:{company_id}', f'time_entries:{month}:*'])
+
+
+def reopen_rollups(month, company_id=None):
+    """Let a month's rollups be recalculated from FreshDesk next time they're asked for, even if the month is closed"""
+    store = get_store()
+    with store.connection() as connection:
+        if company_id is None:
+            connection.execute("UPDATE rollup_months SET closed = 0 WHERE month = ?", (month,))
+        else:
+            connection.execute("UPDATE rollup_months SET closed = 0 WHERE month = ? AND company_id = ?", (month, company_id))
+    store.set_meta(f"rollups_closed:{month}", False)
+
+
+def invalidate_month(month, company_id=None, include_tickets=True):
+    """
+    Refetch everything a month's figures are built from, for one company or for everyone
+
+    Args:
+        month (str): The month, in the format YYYY-MM
+        company_id (int or None): Only this company's month; None for everyone's
+        include_tickets (bool): Whether to refetch the tickets with time in the month, too
+    """
+    store = get_store()
+    invalidate_time_entries(month, company_id)
+    if include_tickets:
+        query = "SELECT DISTINCT ticket_id FROM rollup_entries WHERE month = ?"
+        params = (month,)
+        if company_id is not None:
+            query += " AND company_id = ?"
+            params += (company_id,)
+        ticket_ids = [ticket_id for ticket_id, in store.connection().execute(query, params).fetchall()]
+        for ticket_id in ticket_ids:
+            store.expire('ticket', ticket_id)
+        store.bump_versions([f'ticket:{ticket_id}' for ticket_id in ticket_ids])
+    reopen_rollups(month, company_id)
+
+
+def invalidate_all():
+    """
+    Make every process ignore everything it has cached in memory
+
+    The store is left alone, so anything still fresh there isn't fetched again.
+    """
+    get_store().bump_versions(['all'])
+
+
+def parse_month(month):
+    """
+    Read a month given as YYYY-MM, e.g. "2024-05" or "2024-5"
+
+    Returns:
+        month (str or None): The month as YYYY-MM, as the versions and rollups are keyed; None if it isn't a month
+    """
+    try:
+        return datetime.strptime(month.strip(), "%Y-%m").strftime("%Y-%m")
+    except ValueError:
+        return None
+
+
+def get_company_id(client_code):
+    for company_data in get_companies_data():
+        if company_data['custom_fields'].get('company_code') == client_code:
+            return company_data['id']
+    raise ValueError(f"No company has the client code {client_code}")
+
+
+def display_invalidation_panel():
+    st.info("Use these when something has been corrected in FreshDesk and the reports haven't caught up yet. Only what you choose is fetched again.")
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.markdown("##### A client's month")
+        companies_options = {company_data['custom_fields']['company_code']: company_data['id']
+                             for company_data in get_companies_data() if company_data['custom_fields'].get('company_code')}
+        client_code = st.selectbox("Client", ["Everyone"] + sorted(companies_options), key="invalidate_client")
+        month = st.text_input("Month (YYYY-MM)", key="invalidate_month")
+        include_tickets = st.checkbox("Refetch the month's tickets too", value=True, key="invalidate_include_tickets")
+        if st.button("Refetch this month", disabled=not month):
+            parsed_month = parse_month(month)
+            if parsed_month is None:
+                st.error(f"{month} isn't a month; enter it as YYYY-MM, e.g. 2024-05.")
+            else:
+                invalidate_month(parsed_month, companies_options.get(client_code), include_tickets)
+                st.success(f"{parsed_month} for {client_code} will be fetched again next time it's viewed.")
+
+    with col2:
+        st.markdown("##### A ticket or contact")
+        ticket_id = st.number_input("Ticket ID", min_value=0, step=1, key="invalidate_ticket")
+        if st.button("Refetch this ticket", disabled=not ticket_id):
+            invalidate_ticket(int(ticket_id))
+            st.success(f"Ticket #{ticket_id} will be fetched again next time it's needed.")
+        contact_id = st.number_input("Contact ID", min_value=0, step=1, key="invalidate_contact")
+        if st.button("Refetch this contact", disabled=not contact_id):
+            invalidate_contact(int(contact_id))
+            st.success(f"Contact {contact_id} will be fetched again next time it's needed.")
+
+        st.markdown("##### Everything else")
+        if st.button("Refetch the companies"):
+            invalidate_companies()
+            st.success("The companies will be fetched again next time they're needed.")
+        if st.button("Refetch agents, groups and products"):
+            invalidate_reference_data()
+            st.success("Agents, groups and products will be fetched again next time they're needed.")
+        if st.button("Clear every in-memory cache"):
+            invalidate_all()
+            st.success("Every cached value will be read again from the local store.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='scope', required=True)
+    subparsers.add_parser('ticket', help="refetch one ticket").add_argument('ticket_id', type=int)
+    subparsers.add_parser('contact', help="refetch one contact").add_argument('contact_id', type=int)
+    month_parser = subparsers.add_parser('month', help="refetch a month of time entries, and its tickets")
+    month_parser.add_argument('month', help="the month, as YYYY-MM")
+    month_parser.add_argument('--client', help="only this client code's month")
+    month_parser.add_argument('--no-tickets', action='store_true', help="don't refetch the month's tickets")
+    subparsers.add_parser('companies', help="refetch the companies")
+    subparsers.add_parser('reference', help="refetch agents, groups and products")
+    subparsers.add_parser('all', help="make every app process drop what it has cached in memory")
+    args = parser.parse_args(argv)
+
+    if args.scope == 'ticket':
+        invalidate_ticket(args.ticket_id)
+    elif args.scope == 'contact':
+        invalidate_contact(args.contact_id)
+    elif args.scope == 'month':
+        month = parse_month(args.month)
+        if month is None:
+            parser.error(f"{args.month} isn't a month; give it as YYYY-MM, e.g. 2024-05")
+        company_id = get_company_id(args.client) if args.client else None
+        invalidate_month(month, company_id, include_tickets=not args.no_tickets)
+    elif args.scope == 'companies':
+        invalidate_companies()
+    elif args.scope == 'reference':
+        invalidate_reference_data()
+    elif args.scope == 'all':
+        invalidate_all()
+    print(f"Invalidated {args.scope}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
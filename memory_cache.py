@@ -0,0 +1,160 @@
+# memory_cache.py
+"""In-process caches with a memory budget, for the accessors whose results would otherwise pile up for days."""
+
+import functools
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import record_cache_lookup, record_cache_eviction, record_cache_size
+
+_memory_caches = []
+
+
+def approximate_size(value):
+    """
+    Estimates how many bytes a value takes up, including everything it contains
+
+    Only dicts, lists, tuples and sets are looked inside, which covers the JSON we get from FreshDesk.
+    Objects referred to more than once are only counted once.
+
+    Args:
+        value: The value to measure
+
+    Returns:
+        size (int): The approximate size in bytes
+    """
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return size
+
+
+class MemoryCache:
+    """
+    A thread-safe LRU cache that evicts the least recently used values once they take up more than `max_bytes`.
+
+    Each value is measured once, when it's stored. A value bigger than the whole budget isn't stored at
+    all. Values older than `ttl` seconds, or stored under a different version, are treated as missing,
+    and dropped when next looked up.
+    """
+
+    def __init__(self, name, max_bytes, ttl=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        _memory_caches.append(self)
+        self.report()
+
+    def get(self, key, version=None):
+        """
+        Returns:
+            found (bool): Whether the cache had a fresh value for the key, at this version
+            value: The value, or None if it wasn't found
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[3] != version or self.ttl is not None and time.monotonic() - entry[2] > self.ttl):
+                self._remove(key)
+                record_cache_eviction(self.name)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        record_cache_lookup(self.name, hit=entry is not None)
+        return (True, entry[0]) if entry is not None else (False, None)
+
+    def put(self, key, value, version=None):
+        size = approximate_size(value)
+        evicted = 0
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size <= self.max_bytes:
+                self.entries[key] = (value, size, time.monotonic(), version)
+                self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                evicted += 1
+        if evicted:
+            record_cache_eviction(self.name, evicted)
+        self.report()
+
+    def _remove(self, key):
+        _, size, _, _ = self.entries.pop(key)
+        self.size -= size
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+        self.report()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        self.report()
+
+    def report(self):
+        record_cache_size(self.name, self.size, len(self.entries), self.max_bytes)
+
+
+def memory_cache(max_bytes, ttl=None, version=None):
+    """
+    Caches a function's results in a `MemoryCache`, keyed by its arguments
+
+    Args:
+        max_bytes (int): The cache's memory budget
+        ttl (float or None): How long results stay fresh, in seconds; None keeps them until they're evicted
+        version (callable or None): Called with the function's arguments, returns the current version of
+            what they refer to; a cached value from another version is ignored
+    """
+    def decorator(func):
+        cache = MemoryCache(func.__name__, max_bytes, ttl)
+
+        def make_key(*args, **kwargs):
+            return repr((args, sorted(kwargs.items())))
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(*args, **kwargs)
+            current_version = version(*args, **kwargs) if version else None
+            found, value = cache.get(key, current_version)
+            if not found:
+                value = func(*args, **kwargs)
+                cache.put(key, value, current_version)
+            return value
+
+        def clear(*args, **kwargs):
+            # Like st.cache_resource's clear: with arguments, only that call's value is dropped
+            if args or kwargs:
+                cache.delete(make_key(*args, **kwargs))
+            else:
+                cache.clear()
+
+        wrapper.clear = clear
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def clear_memory_caches():
+    """Empties every memory cache in this process"""
+    for cache in _memory_caches:
+        cache.clear()
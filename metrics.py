@@ -0,0 +1,342 @@
+# metrics.py
+"""Counts FreshDesk requests and cache hits, for the admin metrics panel and for Prometheus."""
+
+import functools
+import os
+import re
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import streamlit as st
+
+from config import metrics_file, metrics_port, metrics_write_interval
+
+# Upper bounds of the request latency histogram's buckets, in seconds
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# How many argument lists (and the version each was computed at) to remember per cache, for caches with no
+# `max_entries`, to spot evictions
+CACHED_KEYS_MAX_ENTRIES = 1000
+
+_lock = threading.Lock()
+_requests = defaultdict(lambda: {"count": 0, "seconds": 0.0, "bytes": 0, "retries": 0})
+_latency_buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+_rate_limit_wait = defaultdict(float)
+_caches = defaultdict(lambda: {"hits": 0, "misses": 0, "evictions": 0})
+_cached_keys = defaultdict(OrderedDict)
+_cache_sizes = {}
+
+
+def endpoint_template(url):
+    """
+    Turns a FreshDesk URL into the endpoint it calls, so requests for different records are counted together
+
+    Args:
+        url (str): e.g. "https://mademedia.freshdesk.com/api/v2/tickets/123?include=stats"
+
+    Returns:
+        endpoint (str): e.g. "/tickets/{id}"
+    """
+    path = urllib.parse.urlsplit(url).path
+    path = path.split("/api/v2", 1)[-1].rstrip("/") or "/"
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+def record_request(url, status, seconds, num_bytes, retries):
+    """
+    Counts one call to FreshDesk
+
+    Args:
+        url (str): The URL that was fetched
+        status (int or None): The final response's status code, or None if we never got a response
+        seconds (float): How long the call took, including retries and backoff
+        num_bytes (int): The size of the final response's body
+        retries (int): How many times the request was retried
+    """
+    key = (endpoint_template(url), str(status) if status is not None else "error")
+    with _lock:
+        request = _requests[key]
+        request["count"] += 1
+        request["seconds"] += seconds
+        request["bytes"] += num_bytes
+        request["retries"] += retries
+        buckets = _latency_buckets[key[0]]
+        for index, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                buckets[index] += 1
+
+
+def record_rate_limit_wait(seconds, priority):
+    with _lock:
+        _rate_limit_wait[priority] += seconds
+
+
+def record_cache_lookup(cache, hit, evicted=False):
+    """
+    Counts one lookup in a cache
+
+    Args:
+        cache (str): The cache's name, e.g. "get_ticket_data" or "store:ticket"
+        hit (bool): Whether the cache had the value
+        evicted (bool): Whether the cache had the value once, but has since dropped it
+    """
+    with _lock:
+        stats = _caches[cache]
+        stats["hits" if hit else "misses"] += 1
+        if evicted:
+            stats["evictions"] += 1
+
+
+def record_cache_eviction(cache, count=1):
+    with _lock:
+        _caches[cache]["evictions"] += count
+
+
+def record_cache_size(cache, num_bytes, entries, max_bytes):
+    """Notes how full a memory-bounded cache is"""
+    with _lock:
+        _cache_sizes[cache] = {"bytes": num_bytes, "entries": entries, "max_bytes": max_bytes}
+
+
+def cache_resource(version=None, **cache_kwargs):
+    """
+    `st.cache_resource`, counting hits, misses and evictions under the function's name
+
+    Streamlit doesn't say whether a call was served from its cache, so every call is counted here, and
+    the ones that reach the function are misses. A miss for arguments the function has already been
+    called with means Streamlit has dropped the value (it expired, the cache was cleared or its version
+    changed), which is counted as an eviction. Only the most recent `max_entries` argument lists (or
+    `CACHED_KEYS_MAX_ENTRIES`, if the cache has no limit) are remembered for this, so memory stays bounded
+    at the cost of missing the odd eviction.
+
+    When a value is computed at a new version, the one cached at the version before is cleared, rather than
+    being left for Streamlit to drop once it expires.
+
+    Args:
+        version (callable or None): Called with the function's arguments, returns the current version of
+            what they refer to, which becomes part of the cache key
+    """
+    def decorator(func):
+        name = func.__name__
+        max_keys = cache_kwargs.get("max_entries") or CACHED_KEYS_MAX_ENTRIES
+
+        @functools.wraps(func)
+        def compute(current_version, *args, **kwargs):
+            key = repr((args, sorted(kwargs.items())))
+            with _lock:
+                cached_keys = _cached_keys[name]
+                evicted = key in cached_keys
+                previous_version = cached_keys.get(key, current_version)
+                cached_keys[key] = current_version
+                cached_keys.move_to_end(key)
+                if len(cached_keys) > max_keys:
+                    cached_keys.popitem(last=False)
+                stats = _caches[name]
+                stats["misses"] += 1
+                stats["hits"] -= 1
+                if evicted:
+                    stats["evictions"] += 1
+            if previous_version != current_version:
+                cached.clear(previous_version, *args, **kwargs)
+            return func(*args, **kwargs)
+
+        cached = st.cache_resource(**cache_kwargs)(compute)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Counted as a hit up front; `compute` turns it into a miss if it runs
+            with _lock:
+                _caches[name]["hits"] += 1
+            return cached(version(*args, **kwargs) if version else None, *args, **kwargs)
+
+        def clear(*args, **kwargs):
+            if args or kwargs:
+                cached.clear(version(*args, **kwargs) if version else None, *args, **kwargs)
+            else:
+                cached.clear()
+
+        wrapper.clear = clear
+        return wrapper
+
+    return decorator
+
+
+def get_request_stats():
+    """
+    Returns:
+        request_stats (pandas.DataFrame): One row per endpoint and status, with the number of calls, total
+            and mean seconds, bytes received and retries, busiest endpoints first
+    """
+    with _lock:
+        rows = [{"endpoint": endpoint, "status": status, **request} for (endpoint, status), request in _requests.items()]
+    request_stats = pd.DataFrame(rows, columns=["endpoint", "status", "count", "seconds", "bytes", "retries"])
+    request_stats["mean_seconds"] = request_stats["seconds"] / request_stats["count"]
+    return request_stats.sort_values(by="seconds", ascending=False).reset_index(drop=True)
+
+
+def get_cache_stats():
+    """
+    Returns:
+        cache_stats (pandas.DataFrame): One row per cache, with hits, misses, evictions and the hit rate, plus
+            the number of entries, bytes used and memory budget for memory-bounded caches
+    """
+    with _lock:
+        rows = [{"cache": cache, **_caches.get(cache, {"hits": 0, "misses": 0, "evictions": 0}), **_cache_sizes.get(cache, {})}
+                for cache in set(_caches) | set(_cache_sizes)]
+    cache_stats = pd.DataFrame(rows, columns=["cache", "hits", "misses", "evictions", "entries", "bytes", "max_bytes"])
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    cache_stats["hit_rate"] = (cache_stats["hits"] / lookups.where(lookups > 0)).fillna(0.0)
+    return cache_stats.sort_values(by="cache").reset_index(drop=True)
+
+
+def render_prometheus():
+    """Returns every metric in Prometheus's text exposition format"""
+    def labels(**values):
+        return "{" + ",".join(f'{name}="{value}"' for name, value in values.items()) + "}"
+
+    with _lock:
+        requests = {key: dict(request) for key, request in _requests.items()}
+        latency_buckets = {endpoint: list(buckets) for endpoint, buckets in _latency_buckets.items()}
+        rate_limit_wait = dict(_rate_limit_wait)
+        caches = {cache: dict(stats) for cache, stats in _caches.items()}
+        cache_sizes = {cache: dict(sizes) for cache, sizes in _cache_sizes.items()}
+
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{sample_name}{sample_labels} {value}" for sample_name, sample_labels, value in samples)
+
+    metric("freshdesk_requests_total", "counter", "FreshDesk API calls, by endpoint and final status.",
+           [("freshdesk_requests_total", labels(endpoint=endpoint, status=status), request["count"])
+            for (endpoint, status), request in requests.items()])
+    metric("freshdesk_response_bytes_total", "counter", "Bytes received from FreshDesk, by endpoint and status.",
+           [("freshdesk_response_bytes_total", labels(endpoint=endpoint, status=status), request["bytes"])
+            for (endpoint, status), request in requests.items()])
+    metric("freshdesk_retries_total", "counter", "Retried FreshDesk requests, by endpoint and final status.",
+           [("freshdesk_retries_total", labels(endpoint=endpoint, status=status), request["retries"])
+            for (endpoint, status), request in requests.items()])
+
+    histogram = []
+    for endpoint, buckets in latency_buckets.items():
+        for upper_bound, count in zip(LATENCY_BUCKETS, buckets):
+            histogram.append(("freshdesk_request_duration_seconds_bucket", labels(endpoint=endpoint, le=upper_bound), count))
+        endpoint_requests = [request for (request_endpoint, _), request in requests.items() if request_endpoint == endpoint]
+        count = sum(request["count"] for request in endpoint_requests)
+        histogram.append(("freshdesk_request_duration_seconds_bucket", labels(endpoint=endpoint, le="+Inf"), count))
+        histogram.append(("freshdesk_request_duration_seconds_sum", labels(endpoint=endpoint),
+                          sum(request["seconds"] for request in endpoint_requests)))
+        histogram.append(("freshdesk_request_duration_seconds_count", labels(endpoint=endpoint), count))
+    metric("freshdesk_request_duration_seconds", "histogram",
+           "Time taken by FreshDesk API calls, including retries and backoff.", histogram)
+    metric("freshdesk_rate_limit_wait_seconds_total", "counter", "Time spent waiting for the request scheduler, by priority.",
+           [("freshdesk_rate_limit_wait_seconds_total", labels(priority=priority), seconds) for priority, seconds in rate_limit_wait.items()])
+
+    for counter in ("hits", "misses", "evictions"):
+        metric(f"cache_{counter}_total", "counter", f"Cache {counter}, by cache.",
+               [(f"cache_{counter}_total", labels(cache=cache), stats[counter]) for cache, stats in caches.items()])
+    metric("cache_entries", "gauge", "Values held by memory-bounded caches.",
+           [("cache_entries", labels(cache=cache), sizes["entries"]) for cache, sizes in cache_sizes.items()])
+    metric("cache_bytes", "gauge", "Approximate memory used by memory-bounded caches.",
+           [("cache_bytes", labels(cache=cache), sizes["bytes"]) for cache, sizes in cache_sizes.items()])
+    metric("cache_max_bytes", "gauge", "Memory budgets of memory-bounded caches.",
+           [("cache_max_bytes", labels(cache=cache), sizes["max_bytes"]) for cache, sizes in cache_sizes.items()])
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_file(path=metrics_file):
+    """Writes the metrics to a file for Prometheus's textfile collector, replacing it atomically"""
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as output_file:
+        output_file.write(render_prometheus())
+    # os.replace so the collector never sees a half-written file
+    os.replace(temporary_path, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_exporter_started = False
+
+
+def start_exporter():
+    """
+    Starts exporting metrics as configured, once per process: serving `/metrics` on `metrics_port`,
+    and rewriting `metrics_file` every `metrics_write_interval` seconds. Either can be left unset.
+    """
+    global _exporter_started
+    with _lock:
+        if _exporter_started:
+            return
+        _exporter_started = True
+
+    if metrics_port:
+        server = ThreadingHTTPServer(("0.0.0.0", metrics_port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+
+    if metrics_file:
+        def write_periodically():
+            while True:
+                write_prometheus_file(metrics_file)
+                time.sleep(metrics_write_interval)
+
+        threading.Thread(target=write_periodically, daemon=True, name="metrics-writer").start()
+
+
+def display_metrics_panel():
+    st.info("These figures are for this server process since it started.")
+
+    request_stats = get_request_stats()
+    display_stats = {
+        "FreshDesk calls": f"{request_stats['count'].sum():,}",
+        "Time in FreshDesk calls": f"{request_stats['seconds'].sum():,.1f} s",
+        "Data received": f"{request_stats['bytes'].sum() / 2**20:,.1f} MiB",
+        "Retries": f"{request_stats['retries'].sum():,}",
+    }
+    cols = st.columns(len(display_stats))
+    for col, (label, value) in zip(cols, display_stats.items()):
+        col.metric(label, value)
+
+    st.markdown("##### FreshDesk calls by endpoint")
+    st.dataframe(
+        request_stats,
+        column_config={
+            "seconds": st.column_config.NumberColumn("Total seconds", format="%.2f"),
+            "mean_seconds": st.column_config.NumberColumn("Mean seconds", format="%.3f"),
+            "bytes": st.column_config.NumberColumn("Bytes", format="%d"),
+        },
+        hide_index=True
+    )
+
+    st.markdown("##### Caches")
+    st.dataframe(
+        get_cache_stats(),
+        column_config={
+            "hit_rate": st.column_config.ProgressColumn("Hit rate", format="percent", min_value=0, max_value=1),
+            "bytes": st.column_config.NumberColumn("Bytes", format="%d"),
+            "max_bytes": st.column_config.NumberColumn("Budget", format="%d"),
+        },
+        hide_index=True
+    )
+
+    with st.expander("Prometheus metrics"):
+        st.code(render_prometheus(), language="text")
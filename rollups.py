@@ -0,0 +1,249 @@
+# rollups.py
+"""Monthly time totals per company and per ticket, kept in the local store so past months don't need recomputing."""
+
+import json
+import time
+
+import pandas as pd
+
+from api import get_time_entries_data, get_products_data, get_product_options, get_companies_data, month_is_final
+from billing import calculate_billable_hours
+from store import get_store
+from utils import prepare_tickets_details_from_time_entries, prepare_company_totals
+
+
+def update_rollups(month, time_entries_data, tickets_details, company_ids=None, closed=False):
+    """
+    Fold a batch of time entries into the month's rollups
+
+    Entries are compared with the ones already rolled up, and only those that are new or whose hours
+    have changed (including billable hours, e.g. after a ticket's billing status changes) are written.
+    Only the ticket and company totals those entries touch are recalculated. When `company_ids` is given,
+    the batch is taken to be every entry for those companies this month, so entries that have since been
+    deleted are dropped and companies with no entries get zero totals.
+
+    Args:
+        month (str): The month, in the format YYYY-MM
+        time_entries_data (list): Time entries from the FreshDesk API
+        tickets_details (list): Ticket details for the entries, from `prepare_tickets_details_from_time_entries`
+        company_ids (list or None): The companies this batch is complete for, if any
+        closed (bool): Whether the month's rollups for these companies are now final
+    """
+    connection = get_store().connection()
+    entries_df = pd.DataFrame(time_entries_data, columns=["id", "company_id", "ticket_id", "time_spent_in_seconds", "billable", "updated_at"])
+    entries_df["hours"] = entries_df["time_spent_in_seconds"] / 3600
+    entries_df["billable_hours"] = calculate_billable_hours(entries_df, pd.DataFrame(tickets_details, columns=["ticket_id", "product", "billing_status", "change_request"]))
+    entries = {
+        int(entry.id): (None if pd.isna(entry.company_id) else int(entry.company_id), int(entry.ticket_id),
+                        float(entry.hours), float(entry.billable_hours), entry.updated_at)
+        for entry in entries_df.itertuples()
+    }
+
+    # What we rolled up last time, for the companies this batch is complete for and the entries in it
+    scope = set(company_ids or [])
+    existing = {}
+    for company_id in scope:
+        for entry_id, *entry in connection.execute(
+                "SELECT entry_id, company_id, ticket_id, hours, billable_hours, updated_at FROM rollup_entries "
+                "WHERE month = ? AND company_id = ?", (month, company_id)):
+            existing[entry_id] = tuple(entry)
+    for entry_id in set(entries) - set(existing):
+        row = connection.execute(
+            "SELECT company_id, ticket_id, hours, billable_hours, updated_at FROM rollup_entries WHERE entry_id = ?",
+            (entry_id,)).fetchone()
+        if row is not None:
+            existing[entry_id] = tuple(row)
+
+    changed = {entry_id: entry for entry_id, entry in entries.items() if existing.get(entry_id) != entry}
+    removed = [entry_id for entry_id, entry in existing.items() if entry_id not in entries and entry[0] in scope]
+    touched_companies = scope | {entry[0] for entry in changed.values()}
+    touched_companies |= {existing[entry_id][0] for entry_id in list(changed) + removed if entry_id in existing}
+    touched_companies.discard(None)
+
+    with connection:
+        connection.executemany("DELETE FROM rollup_entries WHERE entry_id = ?", [(entry_id,) for entry_id in removed])
+        connection.executemany(
+            "INSERT OR REPLACE INTO rollup_entries (entry_id, company_id, ticket_id, hours, billable_hours, updated_at, month) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(entry_id, *entry, month) for entry_id, entry in changed.items()])
+
+        for company_id in touched_companies:
+            recalculate_company_month(connection, company_id, month, closed and company_id in scope)
+
+        connection.executemany(
+            "UPDATE rollup_tickets SET details = ? WHERE month = ? AND ticket_id = ?",
+            [(json.dumps({key: value for key, value in ticket_details.items()
+                          if key not in ("time_spent_this_month", "billable_time_this_month")}), month, ticket_details["ticket_id"])
+             for ticket_details in tickets_details])
+
+
+def recalculate_company_month(connection, company_id, month, closed=False):
+    """Recalculate a company's ticket and month totals from its rolled-up entries, keeping details we already have"""
+    connection.execute(
+        "DELETE FROM rollup_tickets WHERE company_id = ? AND month = ? AND ticket_id NOT IN "
+        "(SELECT ticket_id FROM rollup_entries WHERE company_id = ? AND month = ?)",
+        (company_id, month, company_id, month))
+    connection.execute(
+        "INSERT INTO rollup_tickets (company_id, month, ticket_id, total_hours, billable_hours) "
+        "SELECT company_id, month, ticket_id, SUM(hours), SUM(billable_hours) FROM rollup_entries "
+        "WHERE company_id = ? AND month = ? GROUP BY ticket_id "
+        "ON CONFLICT (company_id, month, ticket_id) DO UPDATE SET "
+        "total_hours = excluded.total_hours, billable_hours = excluded.billable_hours",
+        (company_id, month))
+    # Once closed, a month stays closed: later corrections (e.g. from webhooks) are folded in as they come
+    connection.execute(
+        "INSERT INTO rollup_months (company_id, month, total_hours, billable_hours, refreshed_at, closed) "
+        "SELECT ?, ?, COALESCE(SUM(total_hours), 0), COALESCE(SUM(billable_hours), 0), ?, ? "
+        "FROM rollup_tickets WHERE company_id = ? AND month = ? "
+        "ON CONFLICT (company_id, month) DO UPDATE SET total_hours = excluded.total_hours, "
+        "billable_hours = excluded.billable_hours, refreshed_at = excluded.refreshed_at, "
+        "closed = MAX(rollup_months.closed, excluded.closed)",
+        (company_id, month, time.time(), int(closed), company_id, month))
+
+
+def remove_rollup_entries(entry_ids):
+    """
+    Take time entries back out of the rollups, e.g. after they've been deleted or moved to another month
+
+    Args:
+        entry_ids (iterable): The IDs of the time entries
+
+    Returns:
+        removed (list): (company ID, month) for each company month that changed
+    """
+    connection = get_store().connection()
+    removed = set()
+    with connection:
+        for entry_id in entry_ids:
+            row = connection.execute("SELECT company_id, month FROM rollup_entries WHERE entry_id = ?", (entry_id,)).fetchone()
+            if row is None:
+                continue
+            connection.execute("DELETE FROM rollup_entries WHERE entry_id = ?", (entry_id,))
+            removed.add(tuple(row))
+        for company_id, month in removed:
+            if company_id is not None:
+                recalculate_company_month(connection, company_id, month)
+    return sorted(removed, key=str)
+
+
+def get_rolled_up_tickets_details(month, company_id=None):
+    """
+    Read a month's ticket details back out of the rollups
+
+    Args:
+        month (str): The month, in the format YYYY-MM
+        company_id (int or None): Only include this company's time; None includes every company
+
+    Returns:
+        tickets_details (list): Ticket details in the same shape as `prepare_tickets_details_from_time_entries` returns
+    """
+    query = "SELECT ticket_id, details, total_hours, billable_hours FROM rollup_tickets WHERE month = ?"
+    params = (month,)
+    if company_id is not None:
+        query += " AND company_id = ?"
+        params += (company_id,)
+    tickets_details = []
+    for ticket_id, details, total_hours, billable_hours in get_store().connection().execute(query + " ORDER BY rowid", params):
+        ticket_details = json.loads(details) if details else {"ticket_id": ticket_id}
+        ticket_details["time_spent_this_month"] = total_hours
+        ticket_details["billable_time_this_month"] = billable_hours
+        tickets_details.append(ticket_details)
+    return tickets_details
+
+
+def get_company_month_totals(month):
+    """
+    Get every company's tracked and billable hours for a month, as far as the rollups know them
+
+    Args:
+        month (str): The month, in the format YYYY-MM
+
+    Returns:
+        totals (pandas.DataFrame): One row per company, with `company_id`, `total_hours`, `billable_hours` and `closed`
+    """
+    return pd.read_sql_query(
+        "SELECT company_id, total_hours, billable_hours, closed FROM rollup_months WHERE month = ?",
+        get_store().connection(), params=(month,))
+
+
+def rollups_are_closed(month, company_id=None):
+    store = get_store()
+    if company_id is None:
+        return store.get_meta(f"rollups_closed:{month}", False)
+    row = store.connection().execute(
+        "SELECT closed FROM rollup_months WHERE company_id = ? AND month = ?", (company_id, month)).fetchone()
+    return bool(row and row[0])
+
+
+def close_month_if_complete(month, company_ids):
+    """
+    Mark a month's rollups closed for everyone once every company's are, without fetching the month again
+
+    Args:
+        month (str): The month, in the format YYYY-MM
+        company_ids (list): Every company's ID
+
+    Returns:
+        closed (bool): Whether the month's rollups are now closed for everyone
+    """
+    company_ids = set(company_ids)
+    closed_ids = {company_id for company_id, in get_store().connection().execute(
+        "SELECT company_id FROM rollup_months WHERE month = ? AND closed = 1", (month,))}
+    if not company_ids <= closed_ids:
+        return False
+    get_store().set_meta(f"rollups_closed:{month}", True)
+    return True
+
+
+def get_month_tickets_details(start_date, end_date, company_id=None, progress=None):
+    """
+    Get the details of the tickets with time tracked in a month, reading closed months from the rollups
+
+    Months that are still open are fetched and computed as usual, and the result is folded into the
+    rollups on the way out. Once a month is final, later calls are served from the rollups alone.
+
+    Args:
+        start_date (str): The first day of the month, in the format YYYY-MM-DD
+        end_date (str): The first day of the next month, in the format YYYY-MM-DD
+        company_id (int or None): Only include this company's time; None includes every company
+        progress (streamlit.Progress): An optional streamlit progress object
+
+    Returns:
+        tickets_details (list): See `prepare_tickets_details_from_time_entries`
+    """
+    month = start_date[:7]
+    if rollups_are_closed(month, company_id):
+        return get_rolled_up_tickets_details(month, company_id)
+
+    time_entries_data = get_time_entries_data(start_date, end_date, company_id)
+    product_options = get_product_options(get_products_data())
+    tickets_details = prepare_tickets_details_from_time_entries(time_entries_data, product_options, progress=progress)
+
+    closed = month_is_final(month)
+    company_ids = [company_id] if company_id is not None else [company['id'] for company in get_companies_data()]
+    update_rollups(month, time_entries_data, tickets_details, company_ids, closed)
+    if company_id is None:
+        get_store().set_meta(f"rollups_closed:{month}", closed)
+    return tickets_details
+
+
+def get_month_company_totals(start_date, end_date, progress=None):
+    """
+    Get every company's tracked and billable hours for a month, for the admin overview
+
+    Closed months come straight from the rollups. Open months are worked out from the month's time
+    entries and their tickets' billing fields, without touching the rollups.
+
+    Args:
+        start_date (str): The first day of the month, in the format YYYY-MM-DD
+        end_date (str): The first day of the next month, in the format YYYY-MM-DD
+        progress (streamlit.Progress): An optional streamlit progress object
+
+    Returns:
+        totals (pandas.DataFrame): `total_hours` and `billable_hours`, indexed by company ID
+    """
+    month = start_date[:7]
+    if rollups_are_closed(month):
+        return get_company_month_totals(month).set_index("company_id")[["total_hours", "billable_hours"]]
+    time_entries_data = get_time_entries_data(start_date, end_date)
+    product_options = get_product_options(get_products_data())
+    return prepare_company_totals(time_entries_data, product_options, progress=progress)
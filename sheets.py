@@ -0,0 +1,79 @@
+# sheets.py
+"""A cached copy of the client data kept in Google Sheets, indexed by client code."""
+
+import threading
+import time
+
+import streamlit as st
+
+from config import client_sheet_ttl, client_sheet_revision_check_interval
+from utils import setup_google_sheets, open_google_sheet
+
+
+class ClientSheet:
+    """
+    Holds the rows of the client data worksheet in memory, keyed by `client_code`.
+
+    The worksheet is read in one batch. It is read again after `client_sheet_ttl` seconds, or sooner
+    if the spreadsheet's last-updated time has changed; that is checked at most once every
+    `client_sheet_revision_check_interval` seconds, so most lookups don't touch the Sheets API at all.
+    """
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.lock = threading.Lock()
+        self.headers = []
+        self.rows_by_code = {}
+        self.revision = None
+        self.loaded_at = None
+        self.checked_at = None
+
+    def load(self):
+        self.revision = self.spreadsheet.get_lastUpdateTime()
+        # get_all_records reads the whole worksheet in a single request
+        records = self.spreadsheet.get_worksheet(0).get_all_records()
+        self.headers = list(records[0].keys()) if records else []
+        self.rows_by_code = {}
+        for row in records:
+            # Keep the first row for each client code, as the old linear scan did
+            self.rows_by_code.setdefault(row['client_code'], row)
+        self.loaded_at = self.checked_at = time.monotonic()
+
+    def refresh_if_needed(self):
+        with self.lock:
+            now = time.monotonic()
+            # time.monotonic() can start near 0, e.g. just after boot, so don't count from 0 for the first load
+            if self.loaded_at is None or now - self.loaded_at > client_sheet_ttl:
+                self.load()
+            elif now - self.checked_at > client_sheet_revision_check_interval:
+                self.checked_at = now
+                if self.spreadsheet.get_lastUpdateTime() != self.revision:
+                    self.load()
+
+    def get_client_data(self, client_code):
+        """
+        Get a client's row from the sheet
+
+        Args:
+            client_code (str): The client's code, e.g. "LAP"
+
+        Returns:
+            client_data (dict): The client's row, keyed by column header, or an empty dict if there isn't one
+        """
+        self.refresh_if_needed()
+        return dict(self.rows_by_code.get(client_code, {}))
+
+    def get_contract_renews_date(self, client_code):
+        self.refresh_if_needed()
+        row = self.rows_by_code.get(client_code)
+        if row is None or len(self.headers) < 2:
+            return None
+        # Assuming contract_renews is in the second column
+        return row.get(self.headers[1])
+
+
+@st.cache_resource(show_spinner=False)
+def get_client_sheet(url):
+    """Returns the process-wide copy of the client data sheet, authorising with Google on first use."""
+    client = setup_google_sheets()
+    return ClientSheet(open_google_sheet(client, url))
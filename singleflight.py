@@ -0,0 +1,66 @@
+# singleflight.py
+"""Makes concurrent callers asking for the same thing share one fetch, instead of each sending their own."""
+
+import functools
+import threading
+from concurrent.futures import Future
+
+from metrics import record_cache_lookup
+
+
+class SingleFlight:
+    """
+    Tracks the calls in flight, by key.
+
+    The first caller for a key does the work; anyone who asks for the same key before it finishes waits
+    for that call and gets the same result (or exception). Once it finishes, the key is forgotten, so
+    the next caller starts afresh; caching the result is left to the caller.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call `func(*args, **kwargs)`, unless a call for this key is already in flight, in which case wait for it
+
+        Args:
+            key (hashable): Identifies the call; callers with equal keys share a result
+            func (callable): Does the work
+
+        Returns:
+            result: Whatever `func` returned for the caller that ran it
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        record_cache_lookup(f"in_flight:{self.name}", hit=not leader)
+        if not leader:
+            return call.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+def single_flight(func):
+    """Coalesces concurrent calls to `func` that have the same arguments"""
+    calls = SingleFlight(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return calls.do(repr((args, sorted(kwargs.items()))), func, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,299 @@
+# store.py
+"""A local SQLite store for FreshDesk data, shared by every app process on the host."""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from config import store_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+CREATE TABLE IF NOT EXISTS queries (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    ids TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rollup_entries (
+    entry_id INTEGER PRIMARY KEY,
+    company_id INTEGER,
+    month TEXT NOT NULL,
+    ticket_id INTEGER NOT NULL,
+    hours REAL NOT NULL,
+    billable_hours REAL NOT NULL,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS rollup_entries_by_month ON rollup_entries (month, company_id, ticket_id);
+CREATE TABLE IF NOT EXISTS rollup_tickets (
+    company_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    ticket_id INTEGER NOT NULL,
+    details TEXT,
+    total_hours REAL NOT NULL,
+    billable_hours REAL NOT NULL,
+    PRIMARY KEY (company_id, month, ticket_id)
+);
+CREATE TABLE IF NOT EXISTS rollup_months (
+    company_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    total_hours REAL NOT NULL,
+    billable_hours REAL NOT NULL,
+    refreshed_at REAL NOT NULL,
+    closed INTEGER NOT NULL,
+    PRIMARY KEY (company_id, month)
+);
+"""
+
+
+class EntityStore:
+    """
+    Keeps FreshDesk records on disk, each with the time it was fetched.
+
+    Records live in `entities`, keyed by kind (e.g. "ticket") and ID. List endpoints are remembered in
+    `queries` as the IDs they returned, so a list and the single-record lookups share the same rows.
+    The database runs in WAL mode, so several processes can read while one writes. The `rollup_*`
+    tables hold the monthly totals maintained by rollups.py.
+    """
+
+    def __init__(self, path=store_path):
+        self.path = path
+        self.local = threading.local()
+        self.versions = {}
+        self.versions_lock = threading.Lock()
+        with self.connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, or with processes forked from this one,
+        # so each thread in each process gets its own
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, kind, entity_id, max_age=None):
+        """
+        Get one record, if we have a fresh enough copy
+
+        Args:
+            kind (str): The kind of record, e.g. "ticket"
+            entity_id (int or str): The record's ID
+            max_age (float or None): The oldest copy to accept, in seconds; None accepts any age
+
+        Returns:
+            data (dict or None): The record, or None if it's missing or stale
+        """
+        row = self.connection().execute(
+            "SELECT data, fetched_at FROM entities WHERE kind = ? AND id = ?", (kind, str(entity_id))).fetchone()
+        if row is None or (max_age is not None and time.time() - row[1] > max_age):
+            return None
+        return json.loads(row[0])
+
+    def get_missing_ids(self, kind, entity_ids, max_age=None):
+        """
+        Find which of some records we don't have a fresh enough copy of, in one query
+
+        Args:
+            kind (str): The kind of record, e.g. "ticket"
+            entity_ids (list): The records' IDs
+            max_age (float or None): The oldest copy to accept, in seconds; None accepts any age
+
+        Returns:
+            missing_ids (list): The IDs of the records that are missing or stale, in the order given
+        """
+        fresh_ids = set()
+        oldest = 0 if max_age is None else time.time() - max_age
+        # SQLite limits how many values one query can bind
+        for start in range(0, len(entity_ids), 500):
+            chunk = [str(entity_id) for entity_id in entity_ids[start:start + 500]]
+            placeholders = ",".join("?" * len(chunk))
+            fresh_ids.update(entity_id for entity_id, in self.connection().execute(
+                f"SELECT id FROM entities WHERE kind = ? AND fetched_at >= ? AND id IN ({placeholders})", (kind, oldest, *chunk)))
+        return [entity_id for entity_id in entity_ids if str(entity_id) not in fresh_ids]
+
+    def put(self, kind, entity_id, data, fetched_at=None):
+        self.put_many(kind, [(entity_id, data)], fetched_at)
+
+    def put_many(self, kind, items, fetched_at=None):
+        """
+        Save several records of one kind
+
+        Args:
+            kind (str): The kind of record, e.g. "ticket"
+            items (iterable): (ID, data) pairs
+            fetched_at (float or None): When the records were fetched; defaults to now
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        with self.connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO entities (kind, id, data, fetched_at) VALUES (?, ?, ?, ?)",
+                [(kind, str(entity_id), json.dumps(data), fetched_at) for entity_id, data in items])
+
+    def delete(self, kind, entity_id):
+        with self.connection() as connection:
+            connection.execute("DELETE FROM entities WHERE kind = ? AND id = ?", (kind, str(entity_id)))
+
+    def expire(self, kind, entity_id):
+        """Marks a record as stale, so it's fetched again when next asked for, while lists that include it keep working"""
+        with self.connection() as connection:
+            connection.execute("UPDATE entities SET fetched_at = 0 WHERE kind = ? AND id = ?", (kind, str(entity_id)))
+
+    def get_query(self, key, max_age=None):
+        """
+        Get the records a list endpoint returned, if we have a fresh enough copy
+
+        Args:
+            key (str): The query's key, usually its URL
+            max_age (float or None): The oldest copy to accept, in seconds; None accepts any age
+
+        Returns:
+            records (list or None): The records, in their original order, or None if the query is missing or stale
+        """
+        connection = self.connection()
+        row = connection.execute("SELECT kind, ids, fetched_at FROM queries WHERE key = ?", (key,)).fetchone()
+        if row is None or (max_age is not None and time.time() - row[2] > max_age):
+            return None
+        kind, ids = row[0], json.loads(row[1])
+        records = {}
+        # Stay well under SQLite's limit on the number of bound parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for entity_id, data in connection.execute(
+                    f"SELECT id, data FROM entities WHERE kind = ? AND id IN ({placeholders})", (kind, *chunk)):
+                records[entity_id] = json.loads(data)
+        if len(records) < len(set(ids)):
+            # Some of the records have been deleted since, so the query needs fetching again
+            return None
+        return [records[entity_id] for entity_id in ids]
+
+    def put_query(self, key, kind, records, id_field="id"):
+        """
+        Save the records a list endpoint returned, and remember which ones they were
+
+        Args:
+            key (str): The query's key, usually its URL
+            kind (str): The kind of record, e.g. "ticket"
+            records (list): The records, in order
+            id_field (str): The field that holds each record's ID
+        """
+        fetched_at = time.time()
+        self.put_many(kind, [(record[id_field], record) for record in records], fetched_at)
+        ids = [str(record[id_field]) for record in records]
+        with self.connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO queries (key, kind, ids, fetched_at) VALUES (?, ?, ?, ?)",
+                (key, kind, json.dumps(ids), fetched_at))
+
+    def get_query_keys(self, kind):
+        """Returns the keys of every saved query for a kind of record"""
+        return [key for key, in self.connection().execute("SELECT key FROM queries WHERE kind = ?", (kind,))]
+
+    def delete_query(self, key):
+        with self.connection() as connection:
+            connection.execute("DELETE FROM queries WHERE key = ?", (key,))
+
+    def expire_query(self, key):
+        with self.connection() as connection:
+            connection.execute("UPDATE queries SET fetched_at = 0 WHERE key = ?", (key,))
+
+    def get_meta(self, key, default=None):
+        row = self.connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_meta(self, key, value):
+        with self.connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get_versions(self, scopes, max_age=0):
+        """
+        Get the cache versions of some scopes, e.g. "ticket:123"; see invalidation.py
+
+        Args:
+            scopes (list): The scopes' names
+            max_age (float): Reuse versions this process read for the same scopes this recently, in seconds
+
+        Returns:
+            versions (tuple): Each scope's version, in the same order; 0 for scopes never invalidated
+        """
+        scopes = tuple(scopes)
+        now = time.monotonic()
+        if max_age:
+            with self.versions_lock:
+                versions, read_at = self.versions.get(scopes, (None, 0))
+            if versions is not None and now - read_at < max_age:
+                return versions
+
+        keys = [f"cache_version:{scope}" for scope in scopes]
+        placeholders = ",".join("?" * len(keys))
+        stored = dict(self.connection().execute(f"SELECT key, value FROM meta WHERE key IN ({placeholders})", keys))
+        versions = tuple(int(stored.get(key, 0)) for key in keys)
+        if max_age:
+            with self.versions_lock:
+                # Only keep what's still fresh, so scopes asked for once don't pile up
+                if len(self.versions) >= 1000:
+                    self.versions = {key: value for key, value in self.versions.items() if now - value[1] < max_age}
+                self.versions[scopes] = (versions, now)
+        return versions
+
+    def bump_versions(self, scopes):
+        """Gives some scopes new cache versions, so every process's cached values for them are ignored"""
+        version = time.time_ns()
+        with self.connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(f"cache_version:{scope}", json.dumps(version)) for scope in scopes])
+        # This process sees its own invalidations straight away
+        with self.versions_lock:
+            self.versions.clear()
+
+    def acquire_lease(self, name, owner, seconds):
+        """
+        Take or renew a lease, so that only one process on the host does some job at a time
+
+        Args:
+            name (str): The job's name
+            owner (str): Who's asking, unique to the process
+            seconds (float): How long the lease lasts unless it's renewed
+
+        Returns:
+            acquired (bool): Whether `owner` now holds the lease; False if someone else's hasn't expired
+        """
+        now = time.time()
+        value = json.dumps({"owner": owner, "expires": now + seconds})
+        with self.connection() as connection:
+            cursor = connection.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value "
+                "WHERE json_extract(meta.value, '$.owner') = ? OR json_extract(meta.value, '$.expires') < ?",
+                (f"lease:{name}", value, owner, now))
+            return cursor.rowcount > 0
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Returns this process's handle on the shared store, opening it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = EntityStore()
+        return _store
@@ -0,0 +1,40 @@
+# tests/conftest.py
+"""
+Runs the app's modules against a local fake FreshDesk and a throwaway store.
+
+config.py reads its settings when it's first imported, so the environment is set up here, before any
+test module imports the app.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_freshdesk import FakeFreshdesk, generate_data
+
+_fake = FakeFreshdesk({}).start()
+_store_dir = tempfile.mkdtemp(prefix="support_reports_tests_")
+os.environ["FRESHDESK_BASE_URL"] = _fake.base_url
+os.environ["FRESHDESK_API_KEY"] = "test"
+os.environ["SUPPORT_REPORTS_STORE"] = os.path.join(_store_dir, "store.sqlite3")
+
+
+@pytest.fixture
+def fake(tmp_path):
+    """The fake FreshDesk, with a fresh account of 500 time entries in May 2024, and an empty store and caches"""
+    import streamlit as st
+    import store
+    from memory_cache import clear_memory_caches
+
+    _fake.load(generate_data(500))
+    _fake.throttle_rate = 0.0
+    _fake.retry_after = 0
+    _fake.reset_counts()
+    store._store = store.EntityStore(str(tmp_path / "store.sqlite3"))
+    st.cache_resource.clear()
+    clear_memory_caches()
+    yield _fake
@@ -0,0 +1,56 @@
+# tests/test_api.py
+
+import datetime
+
+import pytest
+import requests
+import streamlit as st
+
+import api
+from bench.fake_freshdesk import generate_data
+from config import base_url, reference_ttl, tickets_sync_interval
+from store import get_store
+
+TIME_ENTRIES_URL = f"{base_url}/time_entries?per_page=100&executed_after=2024-05-01&executed_before=2024-06-01"
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_a_list_with_a_failed_page_is_not_stored(fake, monkeypatch, parallel):
+    get_data_from_api = api.get_data_from_api
+
+    def fail_third_page(url, api_key):
+        return (None, None) if "page=3" in url else get_data_from_api(url, api_key)
+
+    monkeypatch.setattr(api, "get_data_from_api", fail_third_page)
+    with pytest.raises(requests.RequestException):
+        api.get_stored_list("time_entry", TIME_ENTRIES_URL, reference_ttl, parallel)
+    assert get_store().get_query(TIME_ENTRIES_URL) is None
+
+    monkeypatch.setattr(api, "get_data_from_api", get_data_from_api)
+    assert len(api.get_stored_list("time_entry", TIME_ENTRIES_URL, reference_ttl, parallel)) == len(fake.data["time_entries"])
+
+
+def age_stored_lists(seconds):
+    with get_store().connection() as connection:
+        connection.execute("UPDATE queries SET fetched_at = fetched_at - ?", (seconds,))
+    st.cache_resource.clear()
+
+
+@pytest.mark.parametrize("open_month", [False, True])
+def test_time_entries_for_open_months_are_refetched_sooner(fake, open_month):
+    month_start = datetime.date.today().replace(day=1) if open_month else datetime.date(2024, 5, 1)
+    month_end = (month_start + datetime.timedelta(days=32)).replace(day=1)
+    fake.load(generate_data(100, month=month_start.strftime("%Y-%m")))
+
+    api.get_time_entries_data(month_start.isoformat(), month_end.isoformat())
+    fetched = fake.requests["/time_entries"]
+    age_stored_lists(tickets_sync_interval + 1)
+    api.get_time_entries_data(month_start.isoformat(), month_end.isoformat())
+
+    assert (fake.requests["/time_entries"] > fetched) == open_month
+
+
+def test_parallel_pagination_fetches_a_one_page_list_once(fake):
+    fake.load(generate_data(3))
+    assert len(api.get_all_pages(TIME_ENTRIES_URL, parallel=True)) == 3
+    assert fake.requests["/time_entries"] == 1
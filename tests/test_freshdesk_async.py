@@ -0,0 +1,73 @@
+# tests/test_freshdesk_async.py
+
+import pytest
+
+from bench.fake_freshdesk import generate_data
+from config import base_url
+from freshdesk_async import get_sync_client
+from freshdesk_client import get_client
+
+
+@pytest.fixture
+def client(fake):
+    # Throttle some requests, so retries go through the scheduler too
+    fake.throttle_rate = 0.2
+    return get_sync_client("test")
+
+
+def test_get_many_returns_none_for_missing_ids(fake, client):
+    ids = [ticket["id"] for ticket in fake.data["tickets"][:10]]
+    records = client.get_many("tickets", ids + [999999, ids[0], None])
+
+    assert list(records) == ids + [999999]
+    assert records[999999] is None
+    assert all(records[ticket_id]["id"] == ticket_id for ticket_id in ids)
+
+
+def test_get_many_reports_each_record(fake, client):
+    ids = [ticket["id"] for ticket in fake.data["tickets"][:10]]
+    done = []
+    client.get_many("tickets", ids, on_done=lambda *args: done.append(args))
+
+    assert sorted(ticket_id for ticket_id, _, _ in done) == sorted(ids)
+    assert [completed for _, completed, _ in done] == list(range(1, len(ids) + 1))
+    assert {total for _, _, total in done} == {len(ids)}
+
+
+def test_get_all_pages_in_parallel(fake, client):
+    records = client.get_all_pages(
+        f"{base_url}/time_entries?per_page=100&executed_after=2024-05-01&executed_before=2024-06-01", parallel=True)
+
+    assert len(records) == len(fake.data["time_entries"])
+    assert len({record["id"] for record in records}) == len(records)
+
+
+def test_get_all_pages_fetches_a_one_page_list_once(fake, client):
+    fake.throttle_rate = 0.0
+    fake.load(generate_data(3))
+    records = client.get_all_pages(
+        f"{base_url}/time_entries?per_page=100&executed_after=2024-05-01&executed_before=2024-06-01", parallel=True)
+
+    assert len(records) == 3
+    assert fake.requests["/time_entries"] == 1
+
+
+def test_requests_take_tokens_from_the_shared_scheduler(fake, client, monkeypatch):
+    scheduler = get_client("test").scheduler
+    assert client.client.scheduler is scheduler
+
+    try_acquire = scheduler.try_acquire
+    granted = []
+
+    def counting_try_acquire(priority):
+        wait = try_acquire(priority)
+        if wait == 0:
+            granted.append(priority)
+        return wait
+
+    monkeypatch.setattr(scheduler, "try_acquire", counting_try_acquire)
+    client.get_companies()
+
+    assert fake.request_count > 0
+    assert len(granted) == fake.request_count
+    assert set(granted) == {"interactive"}
@@ -0,0 +1,53 @@
+# tests/test_hydration.py
+
+import threading
+import time
+
+import hydration
+from api import get_ticket_data
+from config import ticket_ttl
+from hydration import hydrate_tickets
+from store import get_store
+
+
+def test_fetched_tickets_embed_their_requesters(fake):
+    ticket_ids = [ticket["id"] for ticket in fake.data["tickets"][:20]]
+    tickets_by_id, names = hydrate_tickets(ticket_ids)
+
+    assert all(get_store().get("ticket", ticket_id)["requester"] for ticket_id in ticket_ids)
+    assert all(tickets_by_id[ticket_id]["requester"]["id"] == tickets_by_id[ticket_id]["requester_id"] for ticket_id in ticket_ids)
+    # Every requester's name came with its ticket
+    assert fake.requests["/contacts/{id}"] == 0
+    assert set(names["requesters"]) == {tickets_by_id[ticket_id]["requester_id"] for ticket_id in ticket_ids}
+
+
+def test_a_ticket_fetched_on_its_own_embeds_its_requester(fake):
+    ticket = fake.data["tickets"][0]
+    assert get_ticket_data(ticket["id"])["requester"]["id"] == ticket["requester_id"]
+    assert get_store().get("ticket", ticket["id"])["requester"]["id"] == ticket["requester_id"]
+
+
+def test_sessions_prefetching_the_same_tickets_share_the_fetch_and_its_progress(fake):
+    fake.latency = 0.02
+    ticket_ids = [ticket["id"] for ticket in fake.data["tickets"][:40]]
+    progress = {"leader": [], "follower": []}
+
+    def prefetch(session):
+        hydration.prefetch("ticket", "tickets", ticket_ids, ticket_ttl,
+                           lambda ticket_id, completed, total: progress[session].append(completed), include="requester,stats")
+
+    try:
+        leader = threading.Thread(target=prefetch, args=("leader",))
+        leader.start()
+        while not hydration._prefetches:
+            time.sleep(0.001)
+        prefetch("follower")
+        leader.join()
+    finally:
+        fake.latency = 0.0
+
+    assert fake.requests["/tickets/{id}"] == len(ticket_ids)
+    assert progress["leader"] == list(range(1, len(ticket_ids) + 1))
+    # The follower joined part way through, and hears about everything from then on
+    assert progress["follower"] and progress["follower"][-1] == len(ticket_ids)
+    assert progress["follower"] == sorted(progress["follower"])
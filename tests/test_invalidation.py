@@ -0,0 +1,22 @@
+# tests/test_invalidation.py
+
+import pytest
+
+from invalidation import main
+from store import get_store
+
+
+@pytest.mark.parametrize("month", ["2024-5-1", "May 2024", "2024-13"])
+def test_month_must_be_given_as_year_and_month(fake, month):
+    versions = get_store().get_versions([f"time_entries:{month}"])
+    with pytest.raises(SystemExit) as exit_info:
+        main(["month", month])
+    assert exit_info.value.code == 2
+    assert get_store().get_versions([f"time_entries:{month}"]) == versions
+
+
+@pytest.mark.parametrize("month", ["2024-05", "2024-5"])
+def test_month_is_invalidated(fake, month):
+    versions = get_store().get_versions(["time_entries:2024-05"])
+    assert main(["month", month, "--no-tickets"]) == 0
+    assert get_store().get_versions(["time_entries:2024-05"]) != versions
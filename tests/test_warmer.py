@@ -0,0 +1,26 @@
+# tests/test_warmer.py
+
+import warmer
+from api import get_api_key, get_companies_data
+from freshdesk_client import get_client
+from rollups import get_company_month_totals, rollups_are_closed
+from store import get_store
+
+
+def test_warming_closes_a_final_month_without_fetching_it_for_everyone(fake, monkeypatch):
+    monkeypatch.setattr(warmer, "get_warm_months", lambda: [("2024-05-01", "2024-06-01")])
+    # The fake's rate limit is so high that the "background" reserve would take a while to fill
+    monkeypatch.setattr(get_client(get_api_key()).scheduler, "reserves", {})
+    num_companies = len(get_companies_data())
+
+    assert warmer.warm_caches() == num_companies
+    # One list of time entries per company, and none for everyone
+    time_entries_lists = get_store().get_query_keys("time_entry")
+    assert len(time_entries_lists) == num_companies
+    assert all("company_id=" in key for key in time_entries_lists)
+    assert rollups_are_closed("2024-05")
+
+    totals = get_company_month_totals("2024-05")
+    entries = fake.data["time_entries"]
+    assert len(totals) == num_companies
+    assert totals["total_hours"].sum() == sum(entry["time_spent_in_seconds"] for entry in entries) / 3600
@@ -0,0 +1,142 @@
+# tests/test_webhooks.py
+
+import pytest
+
+from bench.fake_freshdesk import send_webhook
+from rollups import get_company_month_totals, get_month_tickets_details
+from store import get_store
+from webhooks import WebhookReceiver
+
+SECRET = "test-secret"
+
+
+@pytest.fixture
+def receiver(fake):
+    receiver = WebhookReceiver(host="127.0.0.1", port=0, secret=SECRET).start()
+    yield receiver
+    receiver.stop()
+
+
+def send(receiver, event):
+    status = send_webhook(receiver.url, event, SECRET)
+    receiver.events.join()
+    return status
+
+
+def company_totals(company_id, month="2024-05"):
+    return get_company_month_totals(month).set_index("company_id").loc[company_id]
+
+
+def billable_ticket(fake):
+    """A billable ticket on a non-SaaS product, with billable time logged against it"""
+    entries = fake.data["time_entries"]
+    return next(ticket for ticket in fake.data["tickets"]
+                if ticket["product_id"] >= 102 and not ticket["custom_fields"]["change_request"]
+                and ticket["custom_fields"]["billing_status"] == "Billable"
+                and any(entry["ticket_id"] == ticket["id"] and entry["billable"] for entry in entries))
+
+
+def test_ticket_updated_refreshes_store_versions_and_rollups(fake, receiver):
+    get_month_tickets_details("2024-05-01", "2024-06-01")
+    ticket = billable_ticket(fake)
+    before = company_totals(ticket["company_id"])
+    versions = get_store().get_versions([f"ticket:{ticket['id']}", "tickets"])
+
+    ticket["custom_fields"]["billing_status"] = "Free"
+    assert send(receiver, {"event": "ticket_updated", "ticket_id": ticket["id"]}) == 202
+
+    assert get_store().get("ticket", ticket["id"])["custom_fields"]["billing_status"] == "Free"
+    assert all(new != old for new, old in zip(get_store().get_versions([f"ticket:{ticket['id']}", "tickets"]), versions))
+    after = company_totals(ticket["company_id"])
+    assert after["billable_hours"] < before["billable_hours"]
+    assert after["total_hours"] == before["total_hours"]
+
+
+def test_time_entry_created_updates_rollups(fake, receiver):
+    get_month_tickets_details("2024-05-01", "2024-06-01")
+    ticket = billable_ticket(fake)
+    company_id = ticket["company_id"]
+    before = company_totals(company_id)
+    version = get_store().get_versions([f"time_entries:2024-05:{company_id}"])
+
+    time_entry = {"id": 999999, "ticket_id": ticket["id"], "company_id": company_id, "agent_id": 300, "billable": True,
+                  "time_spent_in_seconds": 7200, "executed_at": "2024-05-10T10:00:00Z", "created_at": "2024-05-10T10:00:00Z",
+                  "updated_at": "2024-05-10T10:00:00Z"}
+    fake.data["time_entries"].append(time_entry)
+    fake.load(fake.data)
+    assert send(receiver, {"event": "time_entry_created", "ticket_id": ticket["id"], "time_entry_id": 999999}) == 202
+
+    assert get_store().get("time_entry", 999999) == time_entry
+    assert get_store().get_versions([f"time_entries:2024-05:{company_id}"]) != version
+    after = company_totals(company_id)
+    assert after["total_hours"] == pytest.approx(before["total_hours"] + 2)
+    assert after["billable_hours"] == pytest.approx(before["billable_hours"] + 2)
+
+
+def test_time_entry_on_a_missing_ticket_is_rolled_up_against_an_unknown_ticket(fake, receiver):
+    get_month_tickets_details("2024-05-01", "2024-06-01")
+    company_id = fake.data["companies"][0]["id"]
+    time_entry = {"id": 999998, "ticket_id": 888888, "company_id": company_id, "agent_id": 300, "billable": True,
+                  "time_spent_in_seconds": 3600, "executed_at": "2024-05-10T10:00:00Z", "created_at": "2024-05-10T10:00:00Z",
+                  "updated_at": "2024-05-10T10:00:00Z"}
+    fake.data["time_entries"].append(time_entry)
+    fake.load(fake.data)
+    assert send(receiver, {"event": "time_entry_created", "ticket_id": 888888, "time_entry_id": 999998}) == 202
+
+    assert company_totals(company_id)["closed"]
+    ticket_details = next(ticket_details for ticket_details in get_month_tickets_details("2024-05-01", "2024-06-01", company_id)
+                          if ticket_details["ticket_id"] == 888888)
+    assert ticket_details["title"] == "Unknown ticket"
+    assert ticket_details["requester_name"] == "Unknown"
+    assert ticket_details["time_spent_this_month"] == pytest.approx(1)
+
+
+def test_time_entry_events_without_an_entry_id_refetch_the_tickets_entries(fake, receiver):
+    get_month_tickets_details("2024-05-01", "2024-06-01")
+    ticket = billable_ticket(fake)
+    company_id = ticket["company_id"]
+    before = company_totals(company_id)
+
+    time_entry = {"id": 999997, "ticket_id": ticket["id"], "company_id": company_id, "agent_id": 300, "billable": True,
+                  "time_spent_in_seconds": 3600, "executed_at": "2024-05-10T10:00:00Z", "created_at": "2024-05-10T10:00:00Z",
+                  "updated_at": "2024-05-10T10:00:00Z"}
+    fake.data["time_entries"].append(time_entry)
+    fake.load(fake.data)
+    assert send(receiver, {"event": "time_entry_created", "ticket_id": ticket["id"]}) == 202
+    assert fake.requests["/tickets/{id}/time_entries"] == 1
+    assert get_store().get("time_entry", 999997) == time_entry
+    assert company_totals(company_id)["total_hours"] == pytest.approx(before["total_hours"] + 1)
+
+    fake.data["time_entries"].remove(time_entry)
+    fake.load(fake.data)
+    assert send(receiver, {"event": "time_entry_deleted", "ticket_id": ticket["id"]}) == 202
+    assert get_store().get("time_entry", 999997) is None
+    assert company_totals(company_id)["total_hours"] == pytest.approx(before["total_hours"])
+
+
+def test_ticket_deleted_takes_its_time_out_of_closed_months(fake, receiver):
+    get_month_tickets_details("2024-05-01", "2024-06-01")
+    time_entry = fake.data["time_entries"][0]
+    ticket_hours = sum(entry["time_spent_in_seconds"] for entry in fake.data["time_entries"]
+                       if entry["ticket_id"] == time_entry["ticket_id"] and entry["company_id"] == time_entry["company_id"]) / 3600
+    before = company_totals(time_entry["company_id"])
+    assert before["closed"]
+
+    assert send(receiver, {"event": "ticket_deleted", "ticket_id": time_entry["ticket_id"]}) == 202
+
+    after = company_totals(time_entry["company_id"])
+    assert after["total_hours"] == pytest.approx(before["total_hours"] - ticket_hours)
+    assert after["closed"]
+
+
+@pytest.mark.parametrize("secret", ["wrong-secret", None])
+def test_bad_or_missing_secret_is_rejected(fake, receiver, secret):
+    ticket = fake.data["tickets"][0]
+    assert send_webhook(receiver.url, {"event": "ticket_updated", "ticket_id": ticket["id"]}, secret) == 401
+    receiver.events.join()
+    assert fake.request_count == 0
+
+
+def test_receiver_needs_a_secret():
+    with pytest.raises(ValueError):
+        WebhookReceiver(host="127.0.0.1", port=0, secret=None)
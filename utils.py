@@ -1,59 +1,21 @@
 # utils.py
 
 import datetime
+import sys
 from datetime import timedelta
 import calendar
+import pandas as pd
 import streamlit as st
 import requests
 import gspread
 from google.oauth2.service_account import Credentials
-from api import get_data_from_api, get_paginated, get_ticket_data, get_tickets_data, get_group_data, get_agent_data, get_requester_data, get_products_data, get_product_options, get_companies_data
+from api import get_data_from_api, get_paginated, get_ticket_data, get_tickets_data, get_group_data, get_agent_data, get_requester_data, get_products_data, get_product_options, get_companies_data, get_companies_by_id
 from config import base_url, status_mapping
+from billing import calculate_billable_hours
+from hydration import fetch_tickets, hydrate_tickets, get_reference_names
 
 
-def calculate_billable_time(time_entry):
-    """
-    Takes a time entry and returns the number of hours that should be billed to the client for it
-
-    Args:
-        time_entry (dict): A time entry from the FreshDesk API
-    
-    Returns:
-        billable_time (float): The number of hours that should be billed to the client for this time entry
-    """
-
-    # Here's the data we need:
-    ticket_data = get_ticket_data(time_entry["ticket_id"])
-    product_id = ticket_data["product_id"]
-    product_name = get_product_options(get_products_data()).get(product_id, "Unknown product")
-    change_request = ticket_data["custom_fields"].get("change_request", False)
-    time_spent = time_entry["time_spent_in_seconds"] / 3600
-    billing_status = ticket_data["custom_fields"].get("billing_status")
-
-    # And here's some config:
-    saas_products = ["BlocksOffice", "MonkeyWrench"]
-    unbillable_billing_statuses = ["Free", "90 days", "Invoice"]
-
-    # Now we can work out whether the time entry is billable or not:
-    if billing_status in unbillable_billing_statuses:
-        return 0
-        # If the ticket is has one of these billing statuses in FreshDesk, it's definitely not billable
-    elif change_request:
-        return time_spent
-        # Otherwise, if the ticket is marked as a change request, it's billable
-    elif product_name in saas_products:
-        return 0
-        # Then, if it's a SaaS product, it's not billable
-    elif time_entry["billable"]:
-        return time_spent
-        # If it's not a SaaS product, and the time entry is marked as billable, it's billable
-    else:
-        return 0
-        # Otherwise, it's not billable
-
-
-
-def date_range_selector(label, start_date, end_date):
+def date_range_selector(label, start_date, end_date, key=None):
     """
     A  widget for selecting a month and year, and returning the start and end dates of the selected month
 
@@ -61,6 +23,7 @@ def date_range_selector(label, start_date, end_date):
         label (str): The label for the widget
         start_date (str): The start date of the range, in the format YYYY-MM-DD
         end_date (str): The end date of the range, in the format YYYY-MM-DD
+        key (str): An optional widget key, for when more than one selector is on the page
     
     Returns:
         start_date (str): The start date of the range, in the format YYYY-MM-DD
@@ -69,7 +32,7 @@ def date_range_selector(label, start_date, end_date):
     default_date = datetime.datetime.now().replace(day=1)
     month_options = [(datetime.datetime.now() - timedelta(days=30*i)
                       ).replace(day=1).strftime('%B %Y') for i in range(48)]
-    selected_date = st.selectbox(label=label, options=month_options, index=0)
+    selected_date = st.selectbox(label=label, options=month_options, index=0, key=key)
     selected_date = datetime.datetime.strptime(
         selected_date, '%B %Y').replace(day=1)
     start_date = selected_date.strftime('%Y-%m-%d')
@@ -109,29 +72,6 @@ def open_google_sheet(client, url):
     return sheet
 
 
-def get_client_data(worksheet, client_code):
-    headers = worksheet.row_values(1)
-    client_data = {}
-
-    for row in worksheet.get_all_records():
-        if row['client_code'] == client_code:
-            client_data = row
-            break
-
-    return client_data
-
-
-def get_contract_renews_date(worksheet, client_code):
-    # Assuming client_code is in the first column
-    client_codes = worksheet.col_values(1)
-    for idx, code in enumerate(client_codes):
-        if code == client_code:
-            # Assuming contract_renews is in the second column
-            contract_renews_date = worksheet.cell(idx + 1, 2).value
-            return contract_renews_date
-    return None
-
-
 def display_columns(time_summary_contents):
     num_columns = len(time_summary_contents)
     max_columns_per_row = 4 if num_columns == 4 else 3
@@ -150,34 +90,41 @@ def display_columns(time_summary_contents):
 
 
 
+def filter_tickets_by_client(tickets_data, client_code):
+    """
+    Keep only the tickets that belong to a client's company, before any work is done on them
+
+    Args:
+        tickets_data (list): Tickets from the FreshDesk API
+        client_code (str): The client's code, or "admin" to keep every ticket
+
+    Returns:
+        tickets_data (list): The client's tickets, in the same order
+    """
+    if client_code == "admin":
+        return tickets_data
+    company_ids = {company_data["id"] for company_data in get_companies_data()
+                   if company_data["custom_fields"].get("company_code") == client_code}
+    return [ticket for ticket in tickets_data if ticket["company_id"] in company_ids]
+
+
 def prepare_tickets_details(tickets_data, client_code, progress=None, progress_text=None):
+    # Filter first, so a client only pays for looking up their own tickets
+    tickets_data = filter_tickets_by_client(tickets_data, client_code)
     product_options = get_product_options(get_products_data())
-    companies_data = get_companies_data()
+    companies_by_id = get_companies_by_id(get_companies_data())
+    names = get_reference_names(tickets_data)
     tickets_details = []
     for ticket in tickets_data:
-        agent_name, group_name, requester_name, company_name, company_code = "Unknown", "Unknown", "Unknown", "Unknown", "Unknown"
-        if ticket["company_id"]:
-            company_id = ticket.get("company_id", None)
-            company_data = next(
-                (item for item in companies_data if item["id"] == company_id), None)
+        company_name, company_code = "Unknown", "Unknown"
+        company_data = companies_by_id.get(ticket["company_id"])
+        if company_data is not None:
             company_name = company_data["name"]
             company_code = company_data["custom_fields"].get("company_code", "—")
-            hourly_rate = company_data["custom_fields"].get("contract_hourly_rate", "—")
-            currency = company_data["custom_fields"].get("currency", "—")
-            territory = company_data["custom_fields"].get("territory", "—")
-        if ticket["group_id"]:
-            group_id = ticket.get("group_id", None)
-            group_data = get_group_data(ticket["group_id"])
-            group_name = group_data["name"]
-        if ticket["responder_id"]:
-            responder_id = ticket.get("responder_id", None)
-            agent_data = get_agent_data(responder_id)
-            agent_name = agent_data["contact"]["name"]
-        if ticket["requester_id"]:
-            requester_data = get_requester_data(ticket["requester_id"])
-            if requester_data is not None:
-                requester_name = requester_data.get("name", "Unknown")
-        tickets_details.append({
+        group_name = names["groups"].get(ticket["group_id"], "Unknown")
+        agent_name = names["agents"].get(ticket["responder_id"], "Unknown")
+        requester_name = names["requesters"].get(ticket["requester_id"], "Unknown")
+        ticket_details = {
             "Ticket ID": ticket["id"],
             "Status": status_mapping.get(ticket["status"], "Unknown"),
             "Organization": company_name,
@@ -195,11 +142,11 @@ def prepare_tickets_details(tickets_data, client_code, progress=None, progress_t
             "Billing status": ticket["custom_fields"].get("billing_status", "Unknown"),
             "Client deadline": ticket["custom_fields"].get("cf_client_deadline", None),
             "Tags": ticket["tags"]
-        })
-    if client_code != "admin":
-        tickets_details = [ticket for ticket in tickets_details if ticket["Client code"] == client_code]
-        # drop "Client code" column and "Organization" column
-        tickets_details = [{key: value for key, value in ticket.items() if key not in ["Client code", "Organization"]} for ticket in tickets_details]
+        }
+        if client_code != "admin":
+            # clients only see their own tickets, so leave out "Client code" and "Organization"
+            del ticket_details["Client code"], ticket_details["Organization"]
+        tickets_details.append(ticket_details)
     return tickets_details
 
 
@@ -214,96 +161,221 @@ def prepare_tickets_details_from_time_entries(time_entries_data, product_options
         progress_text (str or None): An optional streamlit progress text object
     
     Returns:
-        tickets_details (list): A list of ticket details
+        tickets_details (list): A list of ticket details, one per ticket, in the order the tickets first appear in the time entries
     """
-    tickets_details = []
+    if not time_entries_data:
+        return []
 
-    total_entries = len(time_entries_data)
-    completed_entries = 0
-
-    companies_data = get_companies_data()
-
-    for time_entry in time_entries_data:
-        ticket_id = time_entry['ticket_id']
-        found_ticket = next(
-            (item for item in tickets_details if item["ticket_id"] == ticket_id), None)
-
-        if not found_ticket:
-            progress_text = f"Getting data for ticket #{ticket_id}…"
-            ticket_data = get_ticket_data(ticket_id)
-            product_name = product_options.get(
-                ticket_data["product_id"], "Unknown")
-            company_name = "—"
-            company_code = "—"
-            hourly_rate = "—"
-            currency = "—"
-            territory = "—"
-            if ticket_data["company_id"]:
-                company_id = ticket_data.get("company_id", None)
-                company_data = next(
-                    (item for item in companies_data if item["id"] == company_id), None)
-                company_name = company_data["name"]
-                company_code = company_data["custom_fields"].get("company_code", "—")
-                hourly_rate = company_data["custom_fields"].get("contract_hourly_rate", "—")
-                currency = company_data["custom_fields"].get("currency", "—")
-                territory = company_data["custom_fields"].get("territory", "—")
-            status_name = status_mapping.get(ticket_data["status"], "Unknown")
-            group_name = "Unknown"
-            if ticket_data["group_id"]:
-                group_id = ticket_data.get("group_id", None)
-                group_data = get_group_data(ticket_data["group_id"])
-                group_name = group_data["name"]
-            agent_name = "Unknown"
-            if ticket_data["responder_id"]:
-                agent_data = get_agent_data(ticket_data["responder_id"])
-                agent_name = agent_data["contact"]["name"]
-            requester_name = "Unknown"
-            if ticket_data["requester_id"]:
-                requester_data = get_requester_data(ticket_data["requester_id"])
-                if requester_data is not None:
-                    requester_name = requester_data.get("name", "Unknown")
-            change_request = ticket_data["custom_fields"].get(
-                "change_request", False)
-            ticket_category = ticket_data["custom_fields"].get(
-                "category", "Unknown")
-            ticket_type = ticket_data.get("type", "Unknown")
-            billing_status = ticket_data["custom_fields"].get(
-                "billing_status", "Unknown")
-            cf_client_deadline = ticket_data["custom_fields"].get(
-                "cf_client_deadline", None)
-            tags = ticket_data.get("tags", [])
-
-            tickets_details.append({
-                "ticket_id": ticket_id,
-                "status": status_name,
-                "company": company_name,
-                "company_code": company_code,
-                "currency": currency,
-                "hourly_rate": hourly_rate,
-                "territory": territory,
-                "title": ticket_data["subject"],
-                "requester_name": requester_name,
-                "category": ticket_category,
-                "type": ticket_type,
-                "product": product_name,
-                "change_request": change_request,
-                "assigned_agent": agent_name,
-                "group": group_name,
-                "billing_status": billing_status,
-                "cf_client_deadline": cf_client_deadline,
-                "tags": tags,
-                "time_spent_this_month": time_entry["time_spent_in_seconds"] / 3600,
-                "billable_time_this_month": calculate_billable_time(time_entry)
-            })
-        else:
-            change_request = found_ticket.get("change_request", False)
-            found_ticket["time_spent_this_month"] += time_entry["time_spent_in_seconds"] / 3600
-            found_ticket["billable_time_this_month"] += calculate_billable_time(
-                time_entry)
+    time_entries_df, tickets_details = get_billable_time_entries(time_entries_data, product_options, progress=progress)
+    totals = time_entries_df.groupby("ticket_id", sort=False)[["hours", "billable_hours"]].sum()
 
-    
-        completed_entries += 1
-        if progress:
-            progress.progress(completed_entries / total_entries, text=progress_text)
+    for ticket_id, ticket_details in tickets_details.items():
+        ticket_details["time_spent_this_month"] = float(totals.at[ticket_id, "hours"])
+        ticket_details["billable_time_this_month"] = float(totals.at[ticket_id, "billable_hours"])
+
+    return list(tickets_details.values())
+
+
+def prepare_monthly_trend(time_entries_data, product_options, start_date, end_date, progress=None):
+    """
+    Total up tracked and billable time per month, from one batch of time entries covering several months
+
+    Only the tickets' billing fields are needed, so their requesters, agents and groups aren't fetched.
+
+    Args:
+        time_entries_data (list): A list of time entries
+        product_options (dict): A dictionary of product IDs and names
+        start_date (str): The first day of the first month, in the format YYYY-MM-DD
+        end_date (str): The first day after the last month, in the format YYYY-MM-DD
+        progress (streamlit.Progress): An optional streamlit progress object
+
+    Returns:
+        trend (pandas.DataFrame): `total_hours` and `billable_hours`, indexed by month (YYYY-MM), with
+            a row for every month in the range even if no time was tracked in it
+    """
+    months = pd.period_range(start_date, pd.Timestamp(end_date) - pd.Timedelta(days=1), freq="M").strftime("%Y-%m")
+    if not time_entries_data:
+        return pd.DataFrame(0.0, index=pd.Index(months, name="month"), columns=["total_hours", "billable_hours"])
+
+    # Each ticket is fetched once however many months it has time in
+    time_entries_df = get_billable_hours(time_entries_data, product_options, progress=progress)
+    time_entries_df["month"] = time_entries_df["executed_at"].str[:7]
+    trend = time_entries_df.groupby("month")[["hours", "billable_hours"]].sum()
+    trend = trend.rename(columns={"hours": "total_hours"}).reindex(months, fill_value=0.0)
+    trend.index.name = "month"
+    return trend
+
+
+def prepare_company_totals(time_entries_data, product_options, progress=None):
+    """
+    Total up tracked and billable time per company, from one batch of time entries for every company
+
+    Time counts towards the company each time entry was logged against, whichever company its ticket
+    belongs to. Only the tickets' billing fields are needed, so their requesters, agents and groups
+    aren't fetched.
 
-    return tickets_details
\ No newline at end of file
+    Args:
+        time_entries_data (list): A list of time entries
+        product_options (dict): A dictionary of product IDs and names
+        progress (streamlit.Progress): An optional streamlit progress object
+
+    Returns:
+        totals (pandas.DataFrame): `total_hours` and `billable_hours`, indexed by company ID
+    """
+    if not time_entries_data:
+        return pd.DataFrame(columns=["total_hours", "billable_hours"], index=pd.Index([], name="company_id"), dtype=float)
+
+    time_entries_df = get_billable_hours(time_entries_data, product_options, progress=progress)
+    time_entries_df = time_entries_df.rename(columns={"hours": "total_hours"})
+    return time_entries_df.groupby("company_id")[["total_hours", "billable_hours"]].sum()
+
+
+def get_billable_hours(time_entries_data, product_options, progress=None):
+    """
+    Work out the billable time for every entry from its ticket's billing fields alone
+
+    Unlike `get_billable_time_entries`, the tickets' requesters, agents and groups aren't fetched, and
+    no ticket details are built, for totals that don't show the tickets.
+
+    Args:
+        time_entries_data (list): A list of time entries
+        product_options (dict): A dictionary of product IDs and names
+        progress (streamlit.Progress): An optional streamlit progress object
+
+    Returns:
+        time_entries_df (pandas.DataFrame): The time entries, with `hours` and `billable_hours` columns added
+    """
+    ticket_ids = list(dict.fromkeys(time_entry["ticket_id"] for time_entry in time_entries_data))
+    tickets_by_id = fetch_tickets(ticket_ids, progress=progress)
+    tickets_df = pd.DataFrame([
+        {
+            "ticket_id": ticket_id,
+            "product": product_options.get(ticket_data["product_id"], "Unknown"),
+            "billing_status": ticket_data["custom_fields"].get("billing_status", "Unknown"),
+            "change_request": ticket_data["custom_fields"].get("change_request", False),
+        }
+        for ticket_id, ticket_data in tickets_by_id.items() if ticket_data is not None
+    ], columns=["ticket_id", "product", "billing_status", "change_request"])
+
+    time_entries_df = pd.DataFrame(time_entries_data)
+    time_entries_df["hours"] = time_entries_df["time_spent_in_seconds"] / 3600
+    time_entries_df["billable_hours"] = calculate_billable_hours(time_entries_df, tickets_df)
+    return time_entries_df
+
+
+def get_billable_time_entries(time_entries_data, product_options, progress=None):
+    """
+    Work out the billable time for every entry in one pass
+
+    Args:
+        time_entries_data (list): A list of time entries
+        product_options (dict): A dictionary of product IDs and names
+        progress (streamlit.Progress): An optional streamlit progress object
+
+    Returns:
+        time_entries_df (pandas.DataFrame): The time entries, with `hours` and `billable_hours` columns added
+        tickets_details (dict): Ticket details for each ticket ID, in the order the tickets first appear in the time entries
+    """
+    # Fetch every ticket (and whatever it refers to) up front, concurrently
+    ticket_ids = list(dict.fromkeys(time_entry["ticket_id"] for time_entry in time_entries_data))
+    tickets_by_id, names = hydrate_tickets(ticket_ids, progress=progress)
+
+    companies_by_id = get_companies_by_id(get_companies_data())
+
+    # Keyed by ticket ID so that each ticket is flattened only once
+    tickets_details = {}
+    for ticket_id in ticket_ids:
+        ticket_data = tickets_by_id.get(ticket_id)
+        if ticket_data is None:
+            # e.g. deleted, or still failing after retries; its time is still counted, against an unknown ticket
+            print(f"Couldn't get ticket #{ticket_id}, so its time is shown against an unknown ticket", file=sys.stderr)
+            ticket_data = get_unknown_ticket(ticket_id)
+        tickets_details[ticket_id] = build_ticket_details(ticket_id, ticket_data, companies_by_id, product_options, names)
+
+    tickets_df = pd.DataFrame(list(tickets_details.values()))
+    time_entries_df = pd.DataFrame(time_entries_data)
+    time_entries_df["hours"] = time_entries_df["time_spent_in_seconds"] / 3600
+    time_entries_df["billable_hours"] = calculate_billable_hours(time_entries_df, tickets_df)
+    return time_entries_df, tickets_details
+
+
+def get_unknown_ticket(ticket_id):
+    """A stand-in for a ticket FreshDesk couldn't give us, with every field `build_ticket_details` reads"""
+    return {
+        "id": ticket_id,
+        "subject": "Unknown ticket",
+        "status": None,
+        "product_id": None,
+        "company_id": None,
+        "group_id": None,
+        "responder_id": None,
+        "requester_id": None,
+        "custom_fields": {},
+    }
+
+
+def build_ticket_details(ticket_id, ticket_data, companies_by_id, product_options, names):
+    """
+    Flatten a ticket and the company, group, agent and requester it refers to into one row
+
+    Args:
+        ticket_id (int): The ID of the ticket
+        ticket_data (dict): The ticket from the FreshDesk API
+        companies_by_id (dict): A dictionary of company IDs and company data
+        product_options (dict): A dictionary of product IDs and names
+        names (dict): `groups`, `agents` and `requesters` dictionaries of IDs and names, from `hydrate_tickets`
+
+    Returns:
+        ticket_details (dict): The ticket details, with no time counted against it yet
+    """
+    product_name = product_options.get(
+        ticket_data["product_id"], "Unknown")
+    company_name = "—"
+    company_code = "—"
+    hourly_rate = "—"
+    currency = "—"
+    territory = "—"
+    company_data = companies_by_id.get(ticket_data.get("company_id"))
+    if company_data is not None:
+        company_name = company_data["name"]
+        company_code = company_data["custom_fields"].get("company_code", "—")
+        hourly_rate = company_data["custom_fields"].get("contract_hourly_rate", "—")
+        currency = company_data["custom_fields"].get("currency", "—")
+        territory = company_data["custom_fields"].get("territory", "—")
+    status_name = status_mapping.get(ticket_data["status"], "Unknown")
+    group_name = names["groups"].get(ticket_data["group_id"], "Unknown")
+    agent_name = names["agents"].get(ticket_data["responder_id"], "Unknown")
+    requester_name = names["requesters"].get(ticket_data["requester_id"], "Unknown")
+    change_request = ticket_data["custom_fields"].get(
+        "change_request", False)
+    ticket_category = ticket_data["custom_fields"].get(
+        "category", "Unknown")
+    ticket_type = ticket_data.get("type", "Unknown")
+    billing_status = ticket_data["custom_fields"].get(
+        "billing_status", "Unknown")
+    cf_client_deadline = ticket_data["custom_fields"].get(
+        "cf_client_deadline", None)
+    tags = ticket_data.get("tags", [])
+
+    return {
+        "ticket_id": ticket_id,
+        "status": status_name,
+        "company": company_name,
+        "company_code": company_code,
+        "currency": currency,
+        "hourly_rate": hourly_rate,
+        "territory": territory,
+        "title": ticket_data["subject"],
+        "requester_name": requester_name,
+        "category": ticket_category,
+        "type": ticket_type,
+        "product": product_name,
+        "change_request": change_request,
+        "assigned_agent": agent_name,
+        "group": group_name,
+        "billing_status": billing_status,
+        "cf_client_deadline": cf_client_deadline,
+        "tags": tags,
+        "time_spent_this_month": 0,
+        "billable_time_this_month": 0
+    }
@@ -0,0 +1,94 @@
+# warmer.py
+"""
+Warms the caches for the current and previous month in the background, so dashboards load from cache.
+
+One process per host holds the warmer's lease in the store and does the warming; the others only check
+now and then whether the lease has expired. The FreshDesk data it fetches lands in the shared store, so
+every process on the host loads it from there rather than from FreshDesk.
+"""
+
+import datetime
+import os
+import socket
+import sys
+import threading
+import time
+
+from api import get_companies_data, get_companies_options
+from config import warm_interval
+from freshdesk_client import request_priority
+from rollups import close_month_if_complete, get_month_tickets_details
+from store import get_store
+
+LEASE_NAME = "warmer"
+
+
+def get_warm_months(today=None):
+    """
+    The months to warm: the current one and the one before
+
+    Returns:
+        months (list): (start_date, end_date) pairs in the format YYYY-MM-DD, as `date_range_selector` returns them
+    """
+    start = (today or datetime.date.today()).replace(day=1)
+    previous_start = (start - datetime.timedelta(days=1)).replace(day=1)
+    next_start = (start + datetime.timedelta(days=32)).replace(day=1)
+    return [(start.isoformat(), next_start.isoformat()), (previous_start.isoformat(), start.isoformat())]
+
+
+def warm_caches(owner=None, lease_seconds=None):
+    """
+    Loads what the monthly dashboard needs for the current and previous month, for every company
+
+    Requests are sent at "background" priority, so people loading dashboards in this process go first,
+    and those in other processes still find its share of `request_priority_reserves` free. If `owner` is
+    given, the warmer's lease is renewed as it goes, and warming stops if the lease has been lost.
+
+    Returns:
+        warmed (int): How many company months were warmed
+    """
+    with request_priority("background"):
+        companies_ids = list(get_companies_options(get_companies_data()).values())
+        warmed = 0
+        for start_date, end_date in get_warm_months():
+            for company_id in companies_ids:
+                if owner is not None and not get_store().acquire_lease(LEASE_NAME, owner, lease_seconds):
+                    return warmed
+                try:
+                    get_month_tickets_details(start_date, end_date, company_id)
+                    warmed += 1
+                except Exception as error:
+                    print(f"Couldn't warm {start_date[:7]} for company {company_id}: {error}", file=sys.stderr)
+            # Rather than fetching the month again for everyone, close it for everyone once every company's is closed
+            close_month_if_complete(start_date[:7], companies_ids)
+        return warmed
+
+
+def run_warmer(interval=warm_interval):
+    """Warms the caches every `interval` seconds for as long as this process holds the lease"""
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    # Long enough to cover a slow run, short enough that another process soon takes over if this one dies
+    lease_seconds = interval * 2
+    while True:
+        if get_store().acquire_lease(LEASE_NAME, owner, lease_seconds):
+            started = time.monotonic()
+            try:
+                warmed = warm_caches(owner, lease_seconds)
+                print(f"Warmed {warmed} company months in {time.monotonic() - started:.1f} s", file=sys.stderr)
+            except Exception as error:
+                print(f"Couldn't warm the caches: {error}", file=sys.stderr)
+        time.sleep(interval)
+
+
+_warmer_started = False
+_warmer_lock = threading.Lock()
+
+
+def start_warmer():
+    """Starts this process's cache warmer, if `warm_interval` is set, once"""
+    global _warmer_started
+    with _warmer_lock:
+        if _warmer_started or not warm_interval:
+            return
+        _warmer_started = True
+    threading.Thread(target=run_warmer, daemon=True, name="cache-warmer").start()
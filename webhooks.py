@@ -0,0 +1,294 @@
+# webhooks.py
+"""
+Receives FreshDesk webhooks, and refreshes only the tickets, time entries and monthly rollups they affect.
+
+Set up a FreshDesk automation rule for each event, with a webhook that POSTs JSON to `webhook_path` on
+`webhook_port`, with the `X-Webhook-Secret` header set to `webhook_secret`:
+
+    {"event": "ticket_updated", "ticket_id": {{ticket.id}}}
+    {"event": "time_entry_created", "ticket_id": {{ticket.id}}}
+
+Ticket events are ticket_created, ticket_updated and ticket_deleted; time entry events are
+time_entry_created, time_entry_updated and time_entry_deleted. FreshDesk's automations have no placeholder
+for a time entry's ID, so a time entry event refetches every time entry on its ticket. Anything else that
+sends these events can add a "time_entry_id", and then only that time entry is refetched.
+"""
+
+import hmac
+import json
+import queue
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from api import get_api_key, get_all_pages, get_data_from_api, get_ticket_data, get_products_data, get_product_options, get_companies_data, get_companies_by_id
+from config import base_url, webhook_port, webhook_path, webhook_secret
+from hydration import get_reference_names
+from rollups import update_rollups, remove_rollup_entries
+from store import get_store
+from utils import build_ticket_details, get_unknown_ticket
+
+TICKET_EVENTS = {"ticket_created", "ticket_updated", "ticket_deleted"}
+TIME_ENTRY_EVENTS = {"time_entry_created", "time_entry_updated", "time_entry_deleted"}
+
+
+def handle_event(event):
+    """
+    Apply one webhook event
+
+    Args:
+        event (dict): The webhook's JSON body; see the module docstring
+
+    Returns:
+        changed (dict): What was refreshed, for logging: `tickets`, `time_entries` and `rollups`
+            (company ID and month pairs)
+
+    Raises:
+        ValueError: If the event isn't one we know about, or is missing an ID
+    """
+    name = event.get("event")
+    try:
+        if name in TICKET_EVENTS:
+            return refresh_ticket(int(event["ticket_id"]), deleted=name == "ticket_deleted")
+        if name in TIME_ENTRY_EVENTS:
+            if event.get("time_entry_id") is not None:
+                return refresh_time_entry(int(event["time_entry_id"]), deleted=name == "time_entry_deleted")
+            return refresh_ticket_time_entries(int(event["ticket_id"]))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Webhook event {name} is missing an ID: {event}")
+    raise ValueError(f"Unknown webhook event: {name}")
+
+
+def refresh_ticket(ticket_id, deleted=False):
+    """
+    Fetch a ticket afresh, drop every cached copy of it, and recalculate the rollups of the months it has time in
+
+    A deleted ticket's time entries are taken out of the rollups, even for closed months, and out of the
+    stored time entry lists. The ticket itself is left in the store; the next sync of the tickets list
+    drops it from there.
+    """
+    store = get_store()
+    ticket_data = None
+    if not deleted:
+        # Ask for the requester too, so the stored copy matches the ones from the tickets list
+        ticket_data, _ = get_data_from_api(f'{base_url}/tickets/{ticket_id}?include=requester,stats', get_api_key())
+    if ticket_data is not None:
+        ticket_data.pop('description', None)
+        ticket_data.pop('description_text', None)
+        store.put('ticket', ticket_id, ticket_data)
+    store.delete('ticket_description', ticket_id)
+    # Every process drops its cached copies; the tickets list picks the change up with a cheap sync of
+    # tickets changed since last time
+    store.bump_versions([f'ticket:{ticket_id}', 'tickets'])
+
+    rollups = []
+    connection = store.connection()
+    if deleted:
+        # FreshDesk deletes the ticket's time entries with it
+        entry_ids = [entry_id for entry_id, in connection.execute(
+            "SELECT entry_id FROM rollup_entries WHERE ticket_id = ?", (ticket_id,))]
+        for entry_id in entry_ids:
+            time_entry = store.get('time_entry', entry_id)
+            if time_entry is not None:
+                invalidate_time_entry_lists(time_entry)
+                store.delete('time_entry', entry_id)
+        rollups.extend(remove_rollup_entries(entry_ids))
+    elif ticket_data is not None:
+        # The ticket's billing status or product may have changed what its time is billable at
+        ticket_details = get_ticket_details(ticket_id)
+        months = [month for month, in connection.execute(
+            "SELECT DISTINCT month FROM rollup_entries WHERE ticket_id = ?", (ticket_id,))]
+        for month in months:
+            entry_ids = [entry_id for entry_id, in connection.execute(
+                "SELECT entry_id FROM rollup_entries WHERE ticket_id = ? AND month = ?", (ticket_id, month))]
+            time_entries_data = [time_entry for time_entry in (store.get('time_entry', entry_id) for entry_id in entry_ids)
+                                 if time_entry is not None]
+            update_rollups(month, time_entries_data, [ticket_details])
+            rollups.extend((time_entry['company_id'], month) for time_entry in time_entries_data)
+    return {"tickets": [ticket_id], "time_entries": [], "rollups": sorted(set(rollups), key=str)}
+
+
+def refresh_time_entry(time_entry_id, deleted=False):
+    """
+    Fetch a time entry afresh, drop the stored time entry lists it belongs (or belonged) in, and fold it into the rollups
+    """
+    new_entry = None
+    if not deleted:
+        new_entry, _ = get_data_from_api(f'{base_url}/time_entries/{time_entry_id}', get_api_key())
+    rollups = apply_time_entry(time_entry_id, new_entry)
+    return {"tickets": [], "time_entries": [time_entry_id], "rollups": sorted(set(rollups), key=str)}
+
+
+def refresh_ticket_time_entries(ticket_id):
+    """
+    Fetch every time entry on a ticket afresh, for time entry events that don't say which entry changed
+
+    Only the entries that have changed since we stored them are applied, so lists the others are in stay
+    cached. Entries the ticket no longer has, e.g. after a time_entry_deleted event, are taken out of the rollups.
+    """
+    store = get_store()
+    time_entries_data = get_all_pages(f'{base_url}/tickets/{ticket_id}/time_entries')
+    new_entries = {time_entry['id']: time_entry for time_entry in time_entries_data}
+    old_entry_ids = [entry_id for entry_id, in store.connection().execute(
+        "SELECT entry_id FROM rollup_entries WHERE ticket_id = ?", (ticket_id,))]
+
+    changed = [time_entry_id for time_entry_id, time_entry in new_entries.items() if store.get('time_entry', time_entry_id) != time_entry]
+    changed += [entry_id for entry_id in old_entry_ids if entry_id not in new_entries]
+    rollups = []
+    for time_entry_id in changed:
+        rollups.extend(apply_time_entry(time_entry_id, new_entries.get(time_entry_id)))
+    return {"tickets": [], "time_entries": changed, "rollups": sorted(set(rollups), key=str)}
+
+
+def apply_time_entry(time_entry_id, new_entry):
+    """
+    Store a time entry as FreshDesk now has it (None if it's gone), and update the lists and rollups it's in
+
+    Returns:
+        rollups (list): (company ID, month) for each company month that changed
+    """
+    store = get_store()
+    old_entry = store.get('time_entry', time_entry_id)
+    if new_entry is not None:
+        store.put('time_entry', time_entry_id, new_entry)
+    else:
+        store.delete('time_entry', time_entry_id)
+
+    for time_entry in (old_entry, new_entry):
+        if time_entry is not None:
+            invalidate_time_entry_lists(time_entry)
+
+    rollups = []
+    old_month = old_entry['executed_at'][:7] if old_entry is not None else None
+    new_month = new_entry['executed_at'][:7] if new_entry is not None else None
+    if new_entry is None or (old_month is not None and old_month != new_month):
+        rollups.extend(remove_rollup_entries([time_entry_id]))
+    if new_entry is not None:
+        update_rollups(new_month, [new_entry], [get_ticket_details(new_entry['ticket_id'])])
+        rollups.append((new_entry['company_id'], new_month))
+    return rollups
+
+
+def invalidate_time_entry_lists(time_entry):
+    """Forget every stored and cached time entries list whose date range and company take in this entry"""
+    store = get_store()
+    executed_on = time_entry['executed_at'][:10]
+    for key in store.get_query_keys('time_entry'):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(key).query))
+        if (params.get('executed_after', '') <= executed_on
+                and ('executed_before' not in params or executed_on < params['executed_before'])
+                and params.get('company_id', str(time_entry['company_id'])) == str(time_entry['company_id'])):
+            store.delete_query(key)
+    # Lists the entry isn't in are still cached, so this only costs refetching the affected ones
+    month = time_entry['executed_at'][:7]
+    store.bump_versions([f"time_entries:{month}:{time_entry['company_id']}", f"time_entries:{month}:*"])
+
+
+def get_ticket_details(ticket_id):
+    ticket_data = get_ticket_data(ticket_id)
+    if ticket_data is None:
+        # As on the dashboard, its time is still counted, against an unknown ticket
+        print(f"Couldn't get ticket #{ticket_id}, so its time is rolled up against an unknown ticket", file=sys.stderr)
+        ticket_data = get_unknown_ticket(ticket_id)
+    companies_by_id = get_companies_by_id(get_companies_data())
+    product_options = get_product_options(get_products_data())
+    return build_ticket_details(ticket_id, ticket_data, companies_by_id, product_options, get_reference_names([ticket_data]))
+
+
+class WebhookReceiver:
+    """
+    Accepts webhooks over HTTP on a background thread, and applies them one at a time on another.
+
+    Requests are answered with 202 as soon as they're queued, so FreshDesk never waits on our API calls.
+    Requests without the right secret get a 401, and bodies that aren't JSON objects get a 400.
+
+    Raises:
+        ValueError: If there's no secret, as anyone who can reach the port could then make us refetch
+            tickets and rewrite rollups
+    """
+
+    def __init__(self, host="0.0.0.0", port=webhook_port, path=webhook_path, secret=webhook_secret):
+        if not secret:
+            raise ValueError("Webhooks need a secret: set SUPPORT_REPORTS_WEBHOOK_SECRET")
+        self.path = path
+        self.secret = secret
+        self.events = queue.Queue()
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{self.path}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="webhook-server").start()
+        threading.Thread(target=self.work, daemon=True, name="webhook-worker").start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def work(self):
+        while True:
+            event = self.events.get()
+            try:
+                changed = handle_event(event)
+                print(f"Webhook {event.get('event')}: refreshed {changed}", file=sys.stderr)
+            except Exception as error:
+                print(f"Couldn't apply webhook {event}: {error}", file=sys.stderr)
+            finally:
+                self.events.task_done()
+
+    def make_handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.split("?")[0] != receiver.path:
+                    self.send_error(404)
+                    return
+                if not hmac.compare_digest(self.headers.get("X-Webhook-Secret", ""), receiver.secret):
+                    self.send_error(401)
+                    return
+                try:
+                    event = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                except ValueError:
+                    event = None
+                if not isinstance(event, dict):
+                    self.send_error(400)
+                    return
+                receiver.events.put(event)
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+_receiver = None
+_receiver_started = False
+_receiver_lock = threading.Lock()
+
+
+def start_webhook_receiver():
+    """
+    Starts this process's webhook receiver, if `webhook_port` is set, once
+
+    Only one process on the host can listen on the port. In the others, or if there's no secret, the
+    reason is logged once and the app carries on without webhooks.
+    """
+    global _receiver, _receiver_started
+    with _receiver_lock:
+        if not _receiver_started and webhook_port:
+            _receiver_started = True
+            try:
+                _receiver = WebhookReceiver().start()
+            except (OSError, ValueError) as error:
+                print(f"Not receiving webhooks in this process: {error}", file=sys.stderr)
+        return _receiver
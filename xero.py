@@ -2,27 +2,114 @@
 
 import pandas as pd
 import streamlit as st
-import base64
+import io
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 from api import get_companies_options, get_companies_data, get_time_entries_data, get_tickets_data
-from utils import prepare_tickets_details_from_time_entries, get_product_options, get_products_data
+from rollups import get_month_tickets_details
+from freshdesk_client import request_priority
+
+
+# The columns of Xero's sales invoice import template, in order
+columns_for_xero = ['ContactName', 'EmailAddress', 'POAddressLine1', 'POAddressLine2', 'POAddressLine3', 'POAddressLine4', 'POCity', 'PORegion', 'POPostalCode', 'POCountry', 'InvoiceNumber', 'InvoiceDate', 'DueDate', 'Total', 'InventoryItemCode', 'Description', 'Quantity', 'UnitAmount', 'Discount', 'AccountCode', 'TaxType', 'TaxAmount', 'TrackingName1', 'TrackingOption1', 'TrackingName2', 'TrackingOption2', 'Currency']
 
 
 def display_month_selector():
     now = datetime.now()
     months = [(now - relativedelta(months=i)).strftime("%B %Y") for i in range(5)]
-    selected_month = st.selectbox("Choose a month", months)
-    selected_date = datetime.strptime(selected_month, "%B %Y")
-    formatted_selected_date = selected_date.strftime("%Y-%m")
-    return selected_month
+    selected_months = st.multiselect("Choose one or more months", months, default=months[:1])
+    return selected_months
 
 def display_territory_selector():
     territories = ['Made Media Inc.', 'Made Media Ltd.']
     selected_territory = st.multiselect("Filter by territory", territories, default=territories)
     return selected_territory
-    
+
+
+def build_xero_frame(tickets_details, selected_date, selected_territory):
+    """
+    Turn a month's ticket details into invoice lines for Xero
+
+    Args:
+        tickets_details (list): Ticket details from `prepare_tickets_details_from_time_entries`
+        selected_date (datetime): The first day of the month being invoiced
+        selected_territory (list): The territories to include
+
+    Returns:
+        data_for_xero (pandas.DataFrame): One invoice line per ticket, with the columns Xero expects
+    """
+    if not tickets_details:
+        return pd.DataFrame(columns=columns_for_xero)
+
+    tickets_details_df = pd.DataFrame(tickets_details)
+
+    # skip tickets without a client code or hourly rate, and tickets from other territories
+    tickets_details_df = tickets_details_df[
+        (tickets_details_df['company_code'] != "—")
+        & tickets_details_df['hourly_rate'].notnull()
+        & tickets_details_df['territory'].isin(selected_territory)
+    ]
+
+    ticket_ids = tickets_details_df['ticket_id'].astype(str)
+    description = ticket_ids + ' - ' + tickets_details_df['title'] + ' [' + tickets_details_df['product'] + ']'
+    change_request = tickets_details_df['change_request'].fillna(False).astype(bool)
+    description = description.where(~change_request, description + ' [Change Request]')
+
+    data_for_xero = pd.DataFrame({
+        'ContactName': tickets_details_df['company'],
+        'InvoiceNumber': "S-" + tickets_details_df['company_code'] + selected_date.strftime("%y%-m"),
+        # invoice is dated this month...
+        'InvoiceDate': (selected_date + relativedelta(months=1) - timedelta(days=1)).strftime("%Y-%m-%d"),
+        # ...and due next month
+        'DueDate': (selected_date + relativedelta(months=2) - timedelta(days=1)).strftime("%Y-%m-%d"),
+        'Description': description,
+        'Quantity': tickets_details_df['billable_time_this_month'],
+        'UnitAmount': tickets_details_df['hourly_rate'],
+        'AccountCode': '4010',
+        'TaxType': 'Tax Exempt (0%)',
+        'Currency': tickets_details_df['currency'],
+        'ticket_id': ticket_ids,
+    })
+    data_for_xero = data_for_xero.sort_values(by=['InvoiceNumber', 'ticket_id']).reset_index(drop=True)
+    # every other column in Xero's template is left blank
+    return data_for_xero.reindex(columns=columns_for_xero)
+
+
+def iter_xero_frames(selected_months, selected_territory, progress=None):
+    """
+    Build the invoice lines for each month in turn, so only one month is held in memory at a time
+
+    Args:
+        selected_months (list): Months in the format "%B %Y", e.g. "May 2024"
+        selected_territory (list): The territories to include
+        progress (streamlit.Progress): An optional streamlit progress object
+
+    Yields:
+        data_for_xero (pandas.DataFrame): The invoice lines for one month
+    """
+    for selected_month in selected_months:
+        # Define start and end dates for the selected month, the same way the dashboard does
+        selected_date = datetime.strptime(selected_month, "%B %Y")
+        start_date = selected_date.strftime("%Y-%m-%d")  # Start of the month
+        end_date = (selected_date + relativedelta(months=1)).strftime("%Y-%m-%d")  # Start of the next month
+
+        # Past months come straight from the rollups; the open month is fetched and rolled up
+        tickets_details = get_month_tickets_details(start_date, end_date, progress=progress)
+        yield build_xero_frame(tickets_details, selected_date, selected_territory)
+
+
+def write_xero_csv(frames, output):
+    """
+    Write invoice lines to a binary file as one CSV, frame by frame
+
+    Args:
+        frames (iterable): DataFrames of invoice lines, e.g. from `iter_xero_frames`
+        output (file): A binary file-like object to write to
+    """
+    for index, frame in enumerate(frames):
+        output.write(frame.to_csv(index=False, header=index == 0).encode())
+
 
 def display_xero_exporter():
     st.info('''
@@ -33,119 +120,32 @@ def display_xero_exporter():
             For the moment, please deal with these things manually.
             ''')
     
-    selected_month = display_month_selector()
+    selected_months = display_month_selector()
     selected_territory = display_territory_selector()
 
-    # Define start and end dates for the selected month
-    selected_date = datetime.strptime(selected_month, "%B %Y")
-    start_date = selected_date.strftime("%Y-%m-%d")  # Start of the month
-    end_date = (selected_date + relativedelta(months=1) - timedelta(days=1)).strftime("%Y-%m-%d")  # End of the month
-
-    if st.button("Generate CSV for Xero"):
-        time_entries_data = get_time_entries_data(start_date, end_date)
-
-        products_data = get_products_data()
-        product_options = get_product_options(products_data)
-
-        tickets_details = prepare_tickets_details_from_time_entries(time_entries_data, product_options)
-
-        for ticket_detail in tickets_details:
-            if ticket_detail['company_code']:
-                ticket_detail['InvoiceNumber'] = "S-" + ticket_detail['company_code'] + selected_date.strftime("%y%-m")
-
-        tickets_details_df = pd.DataFrame(tickets_details)
-
-        # remove tickets where company code is "—"
-        tickets_details_df = tickets_details_df[tickets_details_df['company_code'] != "—"]
-
-        # remove tickets where hourly_rate is null
-        tickets_details_df = tickets_details_df[tickets_details_df['hourly_rate'].notnull()]
-
-        # filter by territory
-        tickets_details_df = tickets_details_df[tickets_details_df['territory'].isin(selected_territory)]
-
-        # prepare data for Xero
-        data_for_xero = tickets_details_df[[
-            'ticket_id',
-            'company',
-            'company_code',
-            'currency',
-            'hourly_rate',
-            'InvoiceNumber',
-            'title',
-            'change_request',
-            'product',
-            'billable_time_this_month'
-        ]]
-        data_for_xero['ticket_id'] = data_for_xero['ticket_id'].astype(str)
-        data_for_xero['Description'] = data_for_xero['ticket_id'] + ' - ' + data_for_xero['title']
-        data_for_xero['Description'] = data_for_xero['Description'] + ' [' + data_for_xero['product'] + ']'
-
-        def add_tags(row):
-            if row['change_request']:
-                return row['Description'] + ' [Change Request]'
-            else:
-                return row['Description']
-        
-        data_for_xero['Description'] = data_for_xero.apply(add_tags, axis=1)
-
-        #rename columns
-        data_for_xero = data_for_xero.rename(columns={
-            'company': 'ContactName',
-            'company_code': 'ContactCode',
-            'hourly_rate': 'UnitAmount',
-            'billable_time_this_month': 'Quantity',
-            'currency': 'Currency'
-        })
-        # invoice is dated this month...
-        data_for_xero['InvoiceDate'] = (selected_date + relativedelta(months=1) - timedelta(days=1)).strftime("%Y-%m-%d")
-        # ...and due next month
-        data_for_xero['DueDate'] = (selected_date + relativedelta(months=2) - timedelta(days=1)).strftime("%Y-%m-%d")
-        data_for_xero = data_for_xero.sort_values(by=['InvoiceNumber', 'ticket_id'])
-        data_for_xero = data_for_xero.drop(columns=['ticket_id', 'title', 'change_request', 'product'])
-        # reindex
-        data_for_xero = data_for_xero.reset_index(drop=True)
-        
+    if st.button("Generate CSV for Xero", disabled=not selected_months):
+        progress_bar = st.progress(0, text="Getting time entries…")
+        csv_file = io.BytesIO()
+
         # add an expander
         with st.expander("Peek at what's in the CSV"):
             st.write("Here's a preview of the data that will be exported to Xero:")
-            st.write(data_for_xero)
-
-        # prep for CSV
-        data_for_xero.insert(2, 'EmailAddress', None)
-        data_for_xero.insert(3, 'POAddressLine1', None)
-        data_for_xero.insert(3, 'POAddressLine2', None)
-        data_for_xero.insert(3, 'POAddressLine3', None)
-        data_for_xero.insert(3, 'POAddressLine4', None)
-        data_for_xero.insert(3, 'POCity', None)
-        data_for_xero.insert(3, 'PORegion', None)
-        data_for_xero.insert(3, 'POPostalCode', None)
-        data_for_xero.insert(3, 'POCountry', None)
-        data_for_xero.insert(3, 'Total', None)
-        data_for_xero.insert(3, 'InventoryItemCode', None)
-        data_for_xero.insert(3, 'Discount', None)
-        data_for_xero.insert(3, 'AccountCode', '4010')
-        data_for_xero.insert(3, 'TaxType', 'Tax Exempt (0%)')
-        data_for_xero.insert(3, 'TaxAmount', None)
-        data_for_xero.insert(3, 'TrackingName1', None)
-        data_for_xero.insert(3, 'TrackingOption1', None)
-        data_for_xero.insert(3, 'TrackingName2', None)
-        data_for_xero.insert(3, 'TrackingOption2', None)
-        columns_for_xero = ['ContactName', 'EmailAddress', 'POAddressLine1', 'POAddressLine2', 'POAddressLine3', 'POAddressLine4', 'POCity', 'PORegion', 'POPostalCode', 'POCountry', 'InvoiceNumber', 'InvoiceDate', 'DueDate', 'Total', 'InventoryItemCode', 'Description', 'Quantity', 'UnitAmount', 'Discount', 'AccountCode', 'TaxType', 'TaxAmount', 'TrackingName1', 'TrackingOption1', 'TrackingName2', 'TrackingOption2', 'Currency']
-        data_for_xero = data_for_xero[columns_for_xero]
-
-        # Generate CSV
-        csv = data_for_xero.to_csv(index=False)
-
-        # Create a download link
-        b64 = base64.b64encode(csv.encode()).decode()
-        href = f'<a href="data:file/csv;base64,{b64}" download="upload_me_to_xero_for_a_good_time.csv">Your CSV is ready! Click here to download it.</a>'
-        st.markdown(href, unsafe_allow_html=True)
-
-        # companies_data = get_companies_data()
-        # companies_data_df = pd.DataFrame(companies_data)
-        # st.write(companies_data_df)
-    
-    if st.button("Clear caches"):
-        st.cache_data.clear()
+
+            def previewed(frames):
+                for frame in frames:
+                    st.write(frame)
+                    yield frame
+
+            # Dashboards loaded while the export runs go first
+            with request_priority("export"):
+                write_xero_csv(previewed(iter_xero_frames(selected_months, selected_territory, progress_bar)), csv_file)
+        progress_bar.empty()
+
+        st.download_button(
+            "Your CSV is ready! Click here to download it.",
+            data=csv_file.getvalue(),
+            file_name="upload_me_to_xero_for_a_good_time.csv",
+            mime="text/csv",
+            on_click="ignore"
+        )
 